@@ -12,31 +12,30 @@
 """
 
 from __future__ import unicode_literals, absolute_import
-import argcomplete
-import argparse
-import sys
-import os
-import re
-import shutil
-import logging
-import json
-import uuid
-import pprint
-import time
-import pytz
-import datetime
-import verboselogs
-from choppy.config import init_config, get_global_config
-from choppy import exit_code
+from choppy.import_profiler import install_import_profiler
+install_import_profiler()  # noqa: Only when CHOPPY_PROFILE_IMPORTS is set.
+
+import argparse  # noqa
+import sys  # noqa
+import os  # noqa
+import re  # noqa
+import shutil  # noqa
+import logging  # noqa
+import json  # noqa
+import time  # noqa
+import datetime  # noqa
+import verboselogs  # noqa
+from choppy.config import init_config, LazyConfig  # noqa
+from choppy import exit_code  # noqa
 from choppy.check_utils import (is_valid_label, is_valid_project_name, is_valid,
                                 is_valid_oss_link, check_dir, check_identifier,
-                                is_valid_zip_or_dir, is_valid_app_name)
-from choppy.version import get_version
-from choppy.utils import (clean_temp, set_logger)
-from choppy.exceptions import NotFoundApp
+                                is_valid_zip_or_dir, is_valid_app_name)  # noqa
+from choppy.version import get_version  # noqa
+from choppy.utils import (clean_temp, set_logger)  # noqa
+from choppy.exceptions import NotFoundApp  # noqa
 
-init_config()
-global_config = get_global_config()
+# Resolved when it's used for the first time, init_config is called in main.
+global_config = LazyConfig()
 logging.setLoggerClass(verboselogs.VerboseLogger)
 logger = logging.getLogger('choppy')
 
@@ -48,12 +47,12 @@ def call_submit(args):
     :return: JSON response with Cromwell workflow ID.
     """
     from choppy.core.json_checker import check_json
-    from choppy.core.cromwell import Cromwell
-    from choppy.core.app_utils import generate_dependencies_zip, kv_list_to_dict
+    from choppy.core.cromwell import get_cromwell
+    from choppy.core.app_utils import get_dependencies_zip, kv_list_to_dict
 
     dependencies = args.dependencies
     if dependencies and os.path.isdir(dependencies):
-        dependencies = generate_dependencies_zip(dependencies)
+        dependencies = get_dependencies_zip(dependencies)
 
     check_json(json_file=args.json)
 
@@ -63,9 +62,7 @@ def call_submit(args):
     # prep labels and add user
     labels_dict = kv_list_to_dict(args.label) if kv_list_to_dict(args.label) is not None else {}
     labels_dict['username'] = args.username.lower()
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
+    cromwell = get_cromwell(args.server)
     result = cromwell.jstart_workflow(wdl_file=args.wdl, json_file=args.json,
                                       dependencies=dependencies,
                                       disable_caching=args.disable_caching,
@@ -102,12 +99,10 @@ def call_query(args):
     :param args:  query subparser arguments.
     :return: A list of json responses based on queries selected by the user.
     """
-    from choppy.core.cromwell import Cromwell
+    from choppy.core.cromwell import get_cromwell
     from choppy.core.app_utils import kv_list_to_dict, parse_json
 
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
+    cromwell = get_cromwell(args.server)
     responses = []
     if args.workflow_id is None or args.workflow_id == "None" and not args.label:
         return call_list(args)
@@ -121,7 +116,7 @@ def call_query(args):
         responses.append(status)
     if args.metadata:
         logger.debug("Metadata requested.")
-        metadata = cromwell.query_metadata(args.workflow_id)
+        metadata = cromwell.query_metadata_cached(args.workflow_id)
         responses.append(metadata)
     if args.logs:
         logger.debug("Logs requested.")
@@ -159,11 +154,9 @@ def call_abort(args):
     :param args: abort subparser args.
     :return: JSON containing abort response.
     """
-    from choppy.core.cromwell import Cromwell
+    from choppy.core.cromwell import get_cromwell
 
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
+    cromwell = get_cromwell(args.server)
     logger.info("Abort requested")
     return cromwell.stop_workflow(workflow_id=args.workflow_id)
 
@@ -203,12 +196,10 @@ def call_restart(args):
     :param args: restart subparser arguments.
     :return:
     """
-    from choppy.core.cromwell import Cromwell
+    from choppy.core.cromwell import get_cromwell
 
     logger.info("Restart requested")
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
+    cromwell = get_cromwell(args.server)
     result = cromwell.restart_workflow(workflow_id=args.workflow_id,
                                        disable_caching=args.disable_caching)
 
@@ -233,12 +224,12 @@ def get_cromwell_links(server, workflow_id, port):
 
 
 def call_explain(args):
-    from choppy.core.cromwell import Cromwell
+    from choppy.core.cromwell import get_cromwell
+
+    import pprint
 
     logger.info("Explain requested")
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
+    cromwell = get_cromwell(args.server)
     (result, additional_res, stdout_res) = cromwell.explain_workflow(workflow_id=args.workflow_id,
                                                                      include_inputs=args.input)
 
@@ -285,6 +276,8 @@ def call_explain(args):
 
 
 def call_list(args):
+    import pprint
+    import pytz
     from choppy.core.monitor import Monitor
     from choppy.core.app_utils import parse_json
 
@@ -331,12 +324,10 @@ def call_label(args):
     :param args: label subparser arguments
     :return:
     """
-    from choppy.core.cromwell import Cromwell
+    from choppy.core.cromwell import get_cromwell
     from choppy.core.app_utils import kv_list_to_dict
 
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
+    cromwell = get_cromwell(args.server)
     labels_dict = kv_list_to_dict(args.label)
     response = cromwell.label_workflow(workflow_id=args.workflow_id, labels=labels_dict)
     if response.status_code == 200:
@@ -351,40 +342,35 @@ def call_log(args):
     :param args: log subparser arguments.
     :return:
     """
-    from choppy.core.cromwell import Cromwell
-    from choppy.core.oss import run_copy_files
+    from collections import OrderedDict
+    from choppy.core.cromwell import get_cromwell
+    from choppy.core.oss import read_remote_files
     from choppy.core.app_utils import parse_json
 
     matchedWorkflowId = re.match(r'^[0-9a-f]{8}\b-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-\b[0-9a-f]{12}$',
                                  args.workflow_id, re.M | re.I)
 
     if matchedWorkflowId:
-        section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-        host, port, auth = global_config.get_conn_info(args.server, section_name)
-
-        cromwell = Cromwell(host, port, auth)
+        cromwell = get_cromwell(args.server)
         res = cromwell.get('logs', args.workflow_id)
         if res.get('calls'):
             logger.info("\n%s\n" % json.dumps(parse_json(res["calls"]), indent=2, sort_keys=True))
 
             logger.info("-------------Commands-------------")
             # for each task, extract the command used
+            scripts = OrderedDict()
             for key in res["calls"]:
                 stderr = res["calls"][key][0]["stderr"]
-                script = "/".join(stderr.split("/")[:-1]) + "/script"
-                fuuid = uuid.uuid1()
-                dest_script = os.path.join(global_config.get_path('general', 'tmp_dir'),
-                                           "%s/%s" % (fuuid, "script"))
-                run_copy_files(script, dest_script, recursive=False, silent=True)
-                with open(dest_script, 'r') as f:
-                    command_log = f.read()
+                scripts[key] = "/".join(stderr.split("/")[:-1]) + "/script"
 
+            command_logs = read_remote_files(list(scripts.values()))
+            for key, script in scripts.items():
                 logger.info(key + ":")
-                logger.info("\n" + command_log)
+                logger.info("\n%s" % command_logs.get(script))
 
             return None
         else:
-            metadata = cromwell.query_metadata(args.workflow_id)
+            metadata = cromwell.query_metadata_cached(args.workflow_id)
             print("\n%s\n" % json.dumps(parse_json(metadata), indent=2, sort_keys=True))
     else:
         project_logs = os.path.join(global_config.get_path('general', 'log_dir'), "project_logs")
@@ -398,20 +384,14 @@ def call_log(args):
 
 
 def call_cat_remote_file(args):
-    from choppy.core.oss import run_copy_files
-
-    remote_file = args.oss_link
-    fuuid = uuid.uuid1()
-    dest_file = os.path.join(global_config.get_path('general', 'tmp_dir'), str(fuuid))
-    run_copy_files(remote_file, dest_file, recursive=False, silent=True)
+    from choppy.core.oss import read_remote_lines
 
-    if os.path.isfile(dest_file):
-        with open(dest_file, 'r') as f:
-            for line in f.readlines():
-                print(line.strip('\n'))
-                sys.stdout.flush()
-    else:
-        logger.warn("Not a file.")
+    try:
+        for line in read_remote_lines(args.oss_link, head=args.head, tail=args.tail):
+            print(line)
+            sys.stdout.flush()
+    except (IOError, OSError, ValueError) as err:
+        logger.warn("Unable to read %s: %s" % (args.oss_link, str(err)))
 
 
 def call_email(args):
@@ -450,7 +430,9 @@ def call_batch(args):
     username = args.username.lower()
     force = args.force
     is_valid_app(app_dir)
-    run_batch(project_name, app_dir, samples, label, server, username, dry_run, force)
+    run_batch(project_name, app_dir, samples, label, server, username, dry_run, force,
+              jobs=args.jobs, rate=args.rate, resume=args.resume,
+              save_files=args.save_files, batch_size=args.batch_size, keep_samples=False)
 
 
 def call_test(args):
@@ -470,7 +452,8 @@ def call_test(args):
     dry_run = args.dry_run
     username = args.username.lower()
     force = args.force
-    run_batch(project_name, app_dir, samples, label, server, username, dry_run, force)
+    run_batch(project_name, app_dir, samples, label, server, username, dry_run, force,
+              jobs=args.jobs, rate=args.rate, resume=args.resume)
 
 
 def call_testapp(args):
@@ -485,7 +468,8 @@ def call_testapp(args):
     dry_run = args.dry_run
     username = args.username.lower()
     force = args.force
-    run_batch(project_name, app_dir, samples, label, server, username, dry_run, force=force)
+    run_batch(project_name, app_dir, samples, label, server, username, dry_run, force=force,
+              jobs=args.jobs, rate=args.rate, resume=args.resume)
 
 
 def call_installapp(args):
@@ -529,39 +513,29 @@ def call_uninstallapp(args):
 
 
 def call_list_files(args):
-    from subprocess import CalledProcessError, check_output
+    from choppy.core.oss import iter_oss_objects, filter_oss_objects, ListingSummary
 
     oss_link = args.oss_link
-    recursive = args.recursive
     long_format = args.long_format
+    # The long format always lists recursively.
+    recursive = args.recursive or long_format
 
-    oss_bin = global_config.get('oss', 'oss_bin')
-    if not oss_bin:
-        oss_bin_name = 'ossutil64' if os.uname().sysname == 'Linux' else 'ossutilmac64'
-        oss_bin = os.path.join(global_config.resource_dir, 'lib', oss_bin_name)
-
-    access_key = global_config.get('oss', 'access_key')
-    access_secret = global_config.get('oss', 'access_secret')
-    endpoint = global_config.get('oss', 'endpoint')
-
+    summary = ListingSummary()
     try:
-        shell_cmd = [oss_bin, "ls", oss_link, "-i", access_key, "-k",
-                     access_secret, "-e", endpoint]
-
-        if not long_format:
-            if not recursive:
-                shell_cmd.append('-d')
+        entries = iter_oss_objects(oss_link, recursive=recursive)
+        entries = filter_oss_objects(entries, include=args.include, exclude=args.exclude)
+        for entry in summary.watch(entries):
+            if args.summary:
+                continue
+            if long_format and not entry.is_dir:
+                print("%s\t%s\t%s" % (entry.last_modified, entry.size, entry.link))
             else:
-                shell_cmd.append('-s')
-
-        logger.debug('Running command: %s' % ' '.join(shell_cmd))
-        output = check_output(shell_cmd).decode().splitlines()
+                print("%s" % entry.link)
+            sys.stdout.flush()
 
-        if len(output) > 2:
-            for i in output[0:-2]:
-                print("%s" % i)
-                sys.stdout.flush()
-    except (CalledProcessError, TypeError) as err:
+        if args.summary:
+            print(summary.report())
+    except (IOError, OSError, ValueError) as err:
         logger.critical("access_key/access_secret or oss_link is not valid.")
         logger.debug("Error msg: %s" % str(err))
 
@@ -573,7 +547,8 @@ def call_upload_files(args):
     local_path = args.local_path
     include = args.include
     exclude = args.exclude
-    run_copy_files(local_path, oss_link, include, exclude)
+    run_copy_files(local_path, oss_link, include, exclude,
+                   part_size=args.part_size, parallel=args.parallel)
 
 
 def call_download_files(args):
@@ -588,11 +563,17 @@ def call_download_files(args):
 
     if oss_link_file:
         with open(oss_link_file, 'r') as f:
-            oss_links = [line.strip() for line in f.readlines() if line.strip()]
+            # Skip the comments, e.g. the errors in a failed manifest.
+            oss_links = [line.strip() for line in f.readlines()
+                         if line.strip() and not line.startswith('#')]
     else:
         is_valid_oss_link(oss_link)
         oss_links = oss_link
-    run_copy_files(oss_links, local_path, include, exclude, recursive=recursive)
+    failed = run_copy_files(oss_links, local_path, include, exclude, recursive=recursive,
+                            jobs=args.jobs, retries=args.retries, part_size=args.part_size,
+                            parallel=args.parallel, manifest=args.failed_manifest)
+    if failed:
+        sys.exit(exit_code.GENERAL_ERROR)
 
 
 def call_cp_remote_files(args):
@@ -602,43 +583,33 @@ def call_cp_remote_files(args):
     dest_oss_link = args.dest_oss_link
     include = args.include
     exclude = args.exclude
-    run_copy_files(src_oss_link, dest_oss_link, include, exclude)
+    run_copy_files(src_oss_link, dest_oss_link, include, exclude,
+                   part_size=args.part_size, parallel=args.parallel)
 
 
 def call_search(args):
-    from choppy.core.cromwell import Cromwell
+    from choppy.core.cromwell import get_cromwell
     from choppy.core.app_utils import parse_json
 
     status = args.status
     project_name = args.project_name
     username = args.username.lower()
     short_format = args.short_format
-    query_dict = {
-        "label": [
-            "username:%s" % username.lower()
-        ],
-        "name": project_name,
-        "additionalQueryResultFields": ["labels"]
-    }
-
-    if status:
-        query_dict.update({"status": status})
-
-    section_name = 'remote_%s' % args.server if args.server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(args.server, section_name)
-    cromwell = Cromwell(host, port, auth)
-    res = cromwell.query(query_dict)
+    cromwell = get_cromwell(args.server)
+    results = cromwell.query_many(labels={'username': username.lower()},
+                                  names=[project_name], statuses=status,
+                                  additional_fields=['labels'])
 
     if short_format:
         print("workflow-id\tsample-id")
-        for result in res['results']:
+        for result in results:
             sample_id = result.get('labels').get('sample-id')
             if not sample_id:
                 sample_id = ""
 
             print("%s\t%s" % (result.get('id'), sample_id.upper()))
     else:
-        results = parse_json(res['results'])
+        results = parse_json(list(results))
         if len(results) > 0:
             print(json.dumps(results, indent=2, sort_keys=True))
         else:
@@ -1038,6 +1009,17 @@ def parse_args():
                        help='Force to overwrite files.')
     batch.add_argument('-u', '--username', action='store', default=global_config.getuser(),
                        type=is_valid_label, help=argparse.SUPPRESS)
+    batch.add_argument('-j', '--jobs', action='store', default=1, type=int,
+                       help='The number of samples submitted concurrently.')
+    batch.add_argument('--rate', action='store', default=None, type=float,
+                       help='The maximum number of submissions per second to the cromwell server.')
+    batch.add_argument('--resume', action='store_true', default=False,
+                       help='Skip the submitted samples of the project, retry the failed or missing ones.')
+    batch.add_argument('--no-project-files', action='store_false', default=True, dest='save_files',
+                       help="Don't save the rendered files of every sample in the project directory.")
+    batch.add_argument('--batch-size', action='store', default=1, type=int,
+                       help='Submit up to N samples sharing the same WDL in one request '
+                            'by the batch endpoint of cromwell, 1 to submit samples one by one.')
     batch.set_defaults(func=call_batch)
 
     test = sub.add_parser(name="test",
@@ -1058,6 +1040,12 @@ def parse_args():
                       help='Force to overwrite files.')
     test.add_argument('-u', '--username', action='store', default=global_config.getuser(),
                       type=is_valid_label, help=argparse.SUPPRESS)
+    test.add_argument('-j', '--jobs', action='store', default=1, type=int,
+                      help='The number of samples submitted concurrently.')
+    test.add_argument('--rate', action='store', default=None, type=float,
+                      help='The maximum number of submissions per second to the cromwell server.')
+    test.add_argument('--resume', action='store_true', default=False,
+                      help='Skip the submitted samples of the project, retry the failed or missing ones.')
     test.set_defaults(func=call_test)
 
     testapp = sub.add_parser(name="testapp",
@@ -1078,6 +1066,12 @@ def parse_args():
                          default=False, help='Force to overwrite files.')
     testapp.add_argument('-u', '--username', action='store', default=global_config.getuser(),
                          type=is_valid_label, help=argparse.SUPPRESS)
+    testapp.add_argument('-j', '--jobs', action='store', default=1, type=int,
+                         help='The number of samples submitted concurrently.')
+    testapp.add_argument('--rate', action='store', default=None, type=float,
+                         help='The maximum number of submissions per second to the cromwell server.')
+    testapp.add_argument('--resume', action='store_true', default=False,
+                         help='Skip the submitted samples of the project, retry the failed or missing ones.')
     testapp.set_defaults(func=call_testapp)
 
     installapp = sub.add_parser(name="install",
@@ -1113,6 +1107,10 @@ def parse_args():
                            help="Show by long format, if the option is not specified, show short format by default.")
     listfiles.add_argument('-r', '--recursive', action='store_true',
                            default=False, help='Recursively list subdirectories encountered.')
+    listfiles.add_argument('--include', action='store', help='Include Pattern of key, e.g., *.jpg')
+    listfiles.add_argument('--exclude', action='store', help='Exclude Pattern of key, e.g., *.txt')
+    listfiles.add_argument('--summary', action='store_true', default=False,
+                           help='Only print the number of objects and bytes, grouped by extension.')
     listfiles.set_defaults(func=call_list_files)
 
     upload_files = sub.add_parser(name="upload",
@@ -1123,6 +1121,10 @@ def parse_args():
     upload_files.add_argument('oss_link', action='store', type=is_valid_oss_link, help='OSS Link.')
     upload_files.add_argument('--include', action='store', help='Include Pattern of key, e.g., *.jpg')
     upload_files.add_argument('--exclude', action='store', help='Exclude Pattern of key, e.g., *.txt')
+    upload_files.add_argument('--part-size', action='store', type=int,
+                              help='The part size (bytes) of a multipart transfer, passed to ossutil.')
+    upload_files.add_argument('--parallel', action='store', type=int,
+                              help='The number of parts transferred concurrently per file, passed to ossutil.')
     upload_files.set_defaults(func=call_upload_files)
 
     download_files = sub.add_parser(name="download",
@@ -1135,6 +1137,16 @@ def parse_args():
     download_files.add_argument('--include', action='store', help='Include Pattern of key, e.g., *.jpg')
     download_files.add_argument('--exclude', action='store', help='Exclude Pattern of key, e.g., *.txt')
     download_files.add_argument('-r', '--recursive', action='store_true', default=False, help='Operate recursively')
+    download_files.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                                help='The number of links downloaded concurrently.')
+    download_files.add_argument('--retries', action='store', type=int, default=2,
+                                help='The number of retries for a failed link.')
+    download_files.add_argument('--failed-manifest', action='store',
+                                help='Save the failed links to the file, default: <log_dir>/oss_failed_<time>.txt')
+    download_files.add_argument('--part-size', action='store', type=int,
+                                help='The part size (bytes) of a multipart transfer, passed to ossutil.')
+    download_files.add_argument('--parallel', action='store', type=int,
+                                help='The number of parts transferred concurrently per file, passed to ossutil.')
     download_files.set_defaults(func=call_download_files)
 
     copy_files = sub.add_parser(name="copy",
@@ -1145,13 +1157,20 @@ def parse_args():
     copy_files.add_argument('dest_oss_link', action='store', type=is_valid_oss_link, help='OSS Link.')
     copy_files.add_argument('--include', action='store', help='Include Pattern of key, e.g., *.jpg')
     copy_files.add_argument('--exclude', action='store', help='Exclude Pattern of key, e.g., *.txt')
+    copy_files.add_argument('--part-size', action='store', type=int,
+                            help='The part size (bytes) of a multipart transfer, passed to ossutil.')
+    copy_files.add_argument('--parallel', action='store', type=int,
+                            help='The number of parts transferred concurrently per file, passed to ossutil.')
     copy_files.set_defaults(func=call_cp_remote_files)
 
     cat_file = sub.add_parser(name="catlog",
                               description="Cat log file.",
-                              usage="choppy catlog <oss_link>",
+                              usage="choppy catlog <oss_link> [<args>]",
                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     cat_file.add_argument('oss_link', action='store', type=is_valid_oss_link, help='OSS Link.')
+    cat_range = cat_file.add_mutually_exclusive_group()
+    cat_range.add_argument('--head', action='store', type=int, help='Only print the first N lines.')
+    cat_range.add_argument('--tail', action='store', type=int, help='Only print the last N lines.')
     cat_file.set_defaults(func=call_cat_remote_file)
 
     config = sub.add_parser(name="config",
@@ -1253,7 +1272,10 @@ def parse_args():
                           help='Template name that you want to generate')
     scaffold.set_defaults(func=call_scaffold)
 
-    argcomplete.autocomplete(parser)
+    if '_ARGCOMPLETE' in os.environ:
+        # Only import argcomplete when bash completion is running.
+        import argcomplete
+        argcomplete.autocomplete(parser)
     args = parser.parse_args()
     # Fix bug1: user need to set choppy.conf before running choppy.
     # Fix bug2: Python argparse args has no attribute func
@@ -1273,8 +1295,13 @@ def parse_args():
 
 
 def main():
+    init_config()
     args = parse_args()
 
+    if args.func is call_version:
+        # Don't pay for the logger and the config validation.
+        return call_version(args)
+
     if args.debug:
         loglevel = logging.DEBUG
     elif args.verbose:
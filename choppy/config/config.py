@@ -15,10 +15,10 @@ import re
 import logging
 import getpass
 from os.path import expanduser
-from threading import local
+from threading import local, Lock
+from types import MappingProxyType
 from choppy import exit_code
 from choppy import exceptions
-from choppy.core.choppy_store import ChoppyStore
 
 logger = logging.getLogger(__name__)
 g = local()
@@ -55,9 +55,13 @@ class ChoppyConfig:
         schema_dir = os.path.join(self.conf_dir, 'schemas')
         self.schemas = self._load_schemas(schema_dir)
         self.logger.debug("Load schema files: %s" % str(self.schemas))
+        # Compiled validators keyed by schema file.
+        self._validators = {}
+        self._reload_lock = Lock()
         if config_file is not None:
             self._replace_conf_file('tempconf', config_file)
 
+        self.chosen_conf_key = chosen_conf_key
         self._init_config(chosen_conf_key)
 
     def _init_config(self, chosen_conf_key):
@@ -75,6 +79,42 @@ class ChoppyConfig:
             with open(conf_path, 'r') as f:
                 self.config = json.load(f)
 
+        self.conf_path = conf_path
+        self.conf_mtime = os.path.getmtime(conf_path)
+        self._load_sections()
+
+    def _load_sections(self):
+        """Reset the section cache, every section is validated once when it is
+        accessed for the first time and the later lookups read the frozen cache.
+
+        An invalid section only raises an error when it is accessed.
+        """
+        self._typed_values = {}
+        self._section_errors = {}
+        self._sections = {}
+
+    def reload(self):
+        """Reload the config file and validate it again.
+        """
+        self._init_config(self.chosen_conf_key)
+
+    def reload_if_changed(self):
+        """Reload the config file when it is modified, it's cheap enough
+        (a stat) to be called in every loop of a long-running process.
+
+        :return: True when the config file is reloaded.
+        """
+        with self._reload_lock:
+            try:
+                changed = os.path.getmtime(self.conf_path) != self.conf_mtime
+            except OSError:
+                changed = False
+
+            if changed:
+                self.logger.info("Reload config file: %s" % self.conf_path)
+                self.reload()
+        return changed
+
     def register_prefix(self, prefix):
         if prefix not in self.prefixes:
             self.prefixes.append(prefix)
@@ -82,6 +122,8 @@ class ChoppyConfig:
 
     @property
     def choppy_store(self):
+        from choppy.core.choppy_store import ChoppyStore
+
         store_config = self.get_section('repo')
         choppy_store = ChoppyStore(store_config.base_url,
                                    username=store_config.username,
@@ -100,8 +142,7 @@ class ChoppyConfig:
     def raw_config(self):
         return self.config
 
-    def get_section(self, section_name, is_dict=False):
-        section_dict = self._convert2dict(section_name)
+    def _validate_section(self, section_name, section_dict):
         try:
             self._check_schema(section_dict, name=section_name)
         except exceptions.NoSuchSchema:
@@ -109,6 +150,36 @@ class ChoppyConfig:
             valid_name = self._get_prefix_name(section_name)
             self._check_schema(section_dict, name=valid_name)
 
+    def _get_frozen_section(self, section_name):
+        section = self._sections.get(section_name)
+        if section is not None:
+            return section
+
+        if section_name in self._section_errors:
+            raise self._section_errors[section_name]
+
+        # Raise NoSuchSection.
+        section_dict = self._convert2dict(section_name)
+        try:
+            self._validate_section(section_name, section_dict)
+        except Exception as err:
+            self._section_errors[section_name] = err
+            raise
+
+        section = self._sections[section_name] = MappingProxyType(dict(section_dict))
+        return section
+
+    def _get_typed(self, section_name, attr_name, convert):
+        """Memoize the converted value of an attribute.
+        """
+        key = (section_name, attr_name, convert)
+        if key not in self._typed_values:
+            section = self._get_frozen_section(section_name)
+            self._typed_values[key] = convert(section, section_name, attr_name)
+        return self._typed_values[key]
+
+    def get_section(self, section_name, is_dict=False):
+        section_dict = dict(self._get_frozen_section(section_name))
         if is_dict:
             return section_dict
         else:
@@ -132,6 +203,20 @@ class ChoppyConfig:
             if prefix in section_name:
                 return prefix
 
+    def _get_validator(self, filename):
+        """Load and compile a schema file once.
+        """
+        validator = self._validators.get(filename)
+        if validator is None:
+            import json
+            from choppy.config.schema import ChoppyValidator
+
+            with open(filename, 'r') as f:
+                schema = json.load(f)
+            ChoppyValidator.check_schema(schema)
+            validator = self._validators[filename] = ChoppyValidator(schema)
+        return validator
+
     def _check_schema(self, data, name):
         """Check the data whether satisfy the specified schema file.
 
@@ -140,10 +225,6 @@ class ChoppyConfig:
         :param: name: schema index.
         :type: str
         """
-        import json
-        from jsonschema import validate
-        from choppy.config.schema import ChoppyValidator
-
         valid_name = 'config_%s.json' % name
         fname_lst = [x for x in self.schemas if x == valid_name or valid_name in x]
         self.logger.debug('Matched %s-th schema file: %s' % (len(fname_lst), fname_lst))
@@ -151,9 +232,7 @@ class ChoppyConfig:
         filename = fname_lst[0] if len(fname_lst) > 0 else None
         if filename:
             self.logger.debug("Validate choppy config file.")
-            with open(filename, 'r') as f:
-                schema = json.load(f)
-                validate(data, schema, cls=ChoppyValidator)
+            self._get_validator(filename).validate(data)
         else:
             raise exceptions.NoSuchSchema("No such schema file: %s" % valid_name)
 
@@ -169,40 +248,20 @@ class ChoppyConfig:
         return ['localhost', ] + servers
 
     def get(self, section_name, attr_name):
-        section = self.get_section(section_name, is_dict=True)
+        section = self._get_frozen_section(section_name)
         return section.get(attr_name, None)
 
     def get_path(self, section_name, attr_name):
-        section = self.get_section(section_name, is_dict=True)
-        return os.path.expanduser(section.get(attr_name, ''))
+        return self._get_typed(section_name, attr_name, _to_path)
 
     def get_int(self, section_name, attr_name):
-        section = self.get_section(section_name, is_dict=True)
-        try:
-            return int(section.get(attr_name))
-        except ValueError:
-            msg = '%s in %s section of config file must be integer.' % (section_name, attr_name)
-            raise exceptions.ConfigValueError(msg)
+        return self._get_typed(section_name, attr_name, _to_int)
 
     def get_float(self, section_name, attr_name):
-        section = self.get_section(section_name, is_dict=True)
-        try:
-            return float(section.get(attr_name))
-        except ValueError:
-            msg = '%s in %s section of config file must be float.' % (section_name, attr_name)
-            raise exceptions.ConfigValueError(msg)
+        return self._get_typed(section_name, attr_name, _to_float)
 
     def get_boolean(self, section_name, attr_name):
-        section = self.get_section(section_name, is_dict=True)
-        try:
-            value = str(section.get(attr_name))
-            if value.upper() in ('T', 'TRUE'):
-                return True
-            else:
-                return False
-        except ValueError:
-            msg = '%s in %s section of config file must be float.' % (section_name, attr_name)
-            raise exceptions.ConfigValueError(msg)
+        return self._get_typed(section_name, attr_name, _to_boolean)
 
     def get_loglevel(self, section_name, attr_name):
         log_level = self.get(section_name, attr_name)
@@ -222,12 +281,19 @@ class ChoppyConfig:
             log_level = logging.DEBUG
         return log_level
 
+    def get_server_section(self, server):
+        return 'remote_%s' % server if server != 'localhost' else 'local'
+
+    def get_pool_info(self, section_name):
+        """Get the http connection pool settings of a cromwell server.
+        """
+        return dict(self._get_typed(section_name, None, _to_pool_info))
+
     def get_conn_info(self, server, section_name):
-        section = self.get_section(section_name)
-        if server == 'localhost':
-            return 'localhost', section.port, (section.username, section.password)
-        else:
-            return section.host, section.port, (section.username, section.password)
+        section = self._get_frozen_section(section_name)
+        # The schema of remote sections names the host `server`.
+        host = 'localhost' if server == 'localhost' else section.get('host') or section['server']
+        return host, section['port'], (section['username'], section['password'])
 
     @property
     def sections(self):
@@ -318,6 +384,17 @@ class ChoppyConfig:
             with open(example_file_path, 'r') as f:
                 return f.read()
 
+    def get_cache_dir(self, subdir=''):
+        """Get the cache directory which survives the clean of tmp_dir.
+        """
+        try:
+            cache_dir = self.get_path('general', 'cache_dir')
+        except exceptions.NoSuchSection:
+            cache_dir = ''
+        cache_dir = os.path.join(cache_dir or expanduser('~/.choppy/cache'), subdir)
+        self._check_dir(cache_dir)
+        return cache_dir
+
     def _check_dir(self, path):
         if not os.path.isdir(path):
             os.makedirs(path)
@@ -333,6 +410,44 @@ class ChoppyConfig:
             sys.exit(exit_code.USERNAME_NOT_VALID)
 
 
+def _to_path(section, section_name, attr_name):
+    return os.path.expanduser(section.get(attr_name, ''))
+
+
+def _to_int(section, section_name, attr_name):
+    try:
+        return int(section.get(attr_name))
+    except (TypeError, ValueError):
+        msg = '%s in %s section of config file must be integer.' % (section_name, attr_name)
+        raise exceptions.ConfigValueError(msg)
+
+
+def _to_float(section, section_name, attr_name):
+    try:
+        return float(section.get(attr_name))
+    except (TypeError, ValueError):
+        msg = '%s in %s section of config file must be float.' % (section_name, attr_name)
+        raise exceptions.ConfigValueError(msg)
+
+
+def _to_boolean(section, section_name, attr_name):
+    value = str(section.get(attr_name))
+    return value.upper() in ('T', 'TRUE')
+
+
+def _to_pool_info(section, section_name, attr_name):
+    try:
+        return {
+            'pool_size': int(section.get('pool_size') or 10),
+            'max_retries': int(section.get('max_retries') or 3),
+            'backoff_factor': float(section.get('backoff_factor') or 0.5)
+        }
+    except ValueError:
+        msg = 'pool_size/max_retries/backoff_factor in %s section of config file ' \
+              'must be number.' % section_name
+        raise exceptions.ConfigValueError(msg)
+
+
 def init_config(config_file=None, chosen_conf_key=None, format='ini'):
     """Initialize config object.
 
@@ -349,6 +464,16 @@ def init_config(config_file=None, chosen_conf_key=None, format='ini'):
         pass
 
 
+class LazyConfig:
+    """A proxy of the global config, which is resolved when an attribute is
+    accessed for the first time. So a module can keep a module level
+    `global_config` before `init_config` is called.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_global_config(), name)
+
+
 def get_global_config():
     global g
     if hasattr(g, 'config'):
@@ -12,22 +12,28 @@
 from __future__ import unicode_literals
 import json
 import os
+import errno
 import sys
 import re
 import csv
+import gzip
 import uuid
+import time
 import shutil
+import hashlib
 import zipfile
 import logging
+import threading
 import verboselogs
+from types import MappingProxyType
 from choppy.config import get_global_config
 from markdown2 import Markdown
 from subprocess import Popen, PIPE, check_output
 from jinja2 import Environment, FileSystemLoader, meta
-from choppy.core.cromwell import Cromwell
+from choppy.core.cromwell import get_cromwell
 from choppy import exit_code
 from choppy.exceptions import (InValidApp, AppInstallationFailed,
-                               AppUnInstallationFailed)
+                               AppUnInstallationFailed, InValidSamples)
 
 global_config = get_global_config()
 logging.setLoggerClass(verboselogs.VerboseLogger)
@@ -38,6 +44,82 @@ try:
 except Exception:
     basestring = str  # noqa: python3
 
+DEPS_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+DEPS_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+_deps_lock = threading.Lock()
+
+# A jinja2 environment per app, it caches the compiled templates and
+# reloads a template (or an included one) when its file changes.
+_template_envs = {}
+# Undeclared variables keyed by (app_path, template_file), value is
+# (template, variables), they are parsed again when the template is reloaded.
+_template_cache = {}
+_template_lock = threading.Lock()
+
+# Default variables keyed by defaults file, value is ((mtime, size), defaults).
+_defaults_cache = {}
+_defaults_lock = threading.Lock()
+
+
+def load_app_defaults(app_path):
+    """Get the read-only default variables of an app.
+
+    The defaults file is parsed once and cached until it changes, use
+    AppDefaultVar to modify the defaults.
+
+    :param app_path: the app directory.
+    :return: a read-only mapping.
+    """
+    defaults_file = os.path.join(os.path.abspath(app_path), 'defaults')
+    try:
+        stat = os.stat(defaults_file)
+        stamp = (stat.st_mtime, stat.st_size)
+    except OSError:
+        return MappingProxyType({})
+
+    with _defaults_lock:
+        cached = _defaults_cache.get(defaults_file)
+        if cached and cached[0] == stamp:
+            return cached[1]
+
+    with open(defaults_file, 'r') as f:
+        defaults = MappingProxyType(json.load(f))
+
+    with _defaults_lock:
+        _defaults_cache[defaults_file] = (stamp, defaults)
+    return defaults
+
+
+def merge_defaults(samples, defaults, header=None):
+    """Fill the columns missing in samples file with default variables.
+
+    Samples file can overwrite the variables defined in defaults file, so
+    only the columns missing in header are taken from defaults.
+
+    :param samples: a list or an iterator of sample dicts.
+    :param defaults: default variables, such as load_app_defaults(app_path).
+    :param header: the header of samples file, keys of the first sample by default.
+    :return: (samples, the list of columns taken from defaults), samples is
+             a list when a list is given, otherwise an iterator.
+    """
+    if header is None:
+        header = samples[0].keys() if len(samples) > 0 else []
+
+    default_columns = sorted(set(defaults.keys()) - set(header))
+    default_values = [(key, defaults[key]) for key in default_columns]
+
+    def fill(sample):
+        sample.update(default_values)
+        return sample
+
+    if isinstance(samples, list):
+        samples = [fill(sample) for sample in samples]
+    else:
+        # Keep a lazy samples reader lazy.
+        samples = (fill(sample) for sample in samples)
+
+    return samples, default_columns
+
 
 class AppDefaultVar:
     def __init__(self, app_path):
@@ -46,12 +128,7 @@ class AppDefaultVar:
         self.default_vars = self._parse()
 
     def _parse(self):
-        if os.path.isfile(self.default):
-            with open(self.default, 'r') as f:
-                vars = json.load(f)
-                return vars
-        else:
-            return dict()
+        return dict(load_app_defaults(self.app_path))
 
     def get(self, key):
         return self.default_vars.get(key)
@@ -113,8 +190,16 @@ def is_valid_app(path, ignore_error=False):
             if ignore_error:
                 return False
             else:
-                raise InValidApp("%s is not a valid app.\n" %
-                                 os.path.basename(path))
+                raise InValidApp("%s is not a valid app, no such file or directory: %s\n" %
+                                 (os.path.basename(path), fpath))
+
+    # The tasks directory is zipped as the dependencies of workflow.
+    if not os.path.isdir(dependencies):
+        if ignore_error:
+            return False
+        else:
+            raise InValidApp("%s is not a valid app, %s must be a directory.\n" %
+                             (os.path.basename(path), dependencies))
     return True
 
 
@@ -147,20 +232,21 @@ def dfs_get_zip_file(input_path, result):
             result.append(filepath)
 
 
-def zip_path(input_path, output_path):
+def zip_path(input_path, output_path, cwd=None):
+    cwd = cwd or os.getcwd()
     f = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED)
     filelists = []
-    dfs_get_zip_file(input_path, filelists)
+    dfs_get_zip_file(os.path.join(cwd, input_path), filelists)
     for file in filelists:
-        f.write(file)
+        f.write(file, arcname=os.path.relpath(file, cwd))
     f.close()
     return output_path
 
 
-def zip_path_by_ext_program(input_path, output_path):
+def zip_path_by_ext_program(input_path, output_path, cwd=None):
     cmd = ['zip', '-r', '-q', output_path, input_path]
-    logger.debug('ZIP: Working Directory %s, CMD: %s' % (os.getcwd(), cmd))
-    proc = Popen(cmd, stdin=PIPE)
+    logger.debug('ZIP: Working Directory %s, CMD: %s' % (cwd or os.getcwd(), cmd))
+    proc = Popen(cmd, stdin=PIPE, cwd=cwd)
     proc.communicate()
 
 
@@ -172,35 +258,113 @@ def check_cmd(command):
     return False
 
 
-def generate_dependencies_zip(dependencies_path):
+def generate_dependencies_zip(dependencies_path, zip_output=None):
     # Fix Bug: When Changing Directory, you need a abs path.
     dependencies_path = os.path.abspath(dependencies_path)
-    previous_workdir = os.getcwd()
     par_dir = str(uuid.uuid1())
     workdir = os.path.join('/', 'tmp', par_dir)
     os.mkdir(workdir)
-    zip_output = os.path.join('/', 'tmp', par_dir, 'tasks.zip')
+    tmp_zip_output = os.path.join('/', 'tmp', par_dir, 'tasks.zip')
 
-    os.chdir(workdir)
+    # Don't change the working directory of the process, it is shared by
+    # all threads of a concurrent batch submission.
     # Fix bug:
     # Need two levels or one level?
     # dest_path = os.path.join('tasks', 'tasks')
     dest_path = 'tasks'
-    shutil.copytree(dependencies_path, dest_path)
+    shutil.copytree(dependencies_path, os.path.join(workdir, dest_path))
 
     # 外部命令
     if check_cmd('zip'):
-        zip_path_by_ext_program('tasks', zip_output)
+        zip_path_by_ext_program(dest_path, tmp_zip_output, cwd=workdir)
     else:
         # TODO: Fix the Bug
         # Python zipfile generate a zip that are version 2.0;
         # But Cromwell need a zip that are version 1.0;
-        zip_path(dest_path, zip_output)
+        zip_path(dest_path, tmp_zip_output, cwd=workdir)
+
+    if zip_output:
+        # Rename is atomic, other processes never see a partial zip file.
+        shutil.move(tmp_zip_output, zip_output + '.' + par_dir)
+        os.rename(zip_output + '.' + par_dir, zip_output)
+        shutil.rmtree(workdir, ignore_errors=True)
+        return zip_output
+    else:
+        shutil.rmtree(os.path.join(workdir, dest_path), ignore_errors=True)
+        return tmp_zip_output
+
+
+def hash_dir(dir_path):
+    """Hash the relative paths and contents of all files in a directory.
+    """
+    sha1 = hashlib.sha1()
+    for root, dirs, files in os.walk(dir_path):
+        dirs.sort()
+        for fname in sorted(files):
+            filepath = os.path.join(root, fname)
+            relpath = os.path.relpath(filepath, dir_path).encode('utf-8')
+            # Length prefixes keep the boundary between path and content unambiguous.
+            sha1.update(('%d:' % len(relpath)).encode('utf-8') + relpath)
+            sha1.update(('%d:' % os.path.getsize(filepath)).encode('utf-8'))
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_dependencies_zip(dependencies_path):
+    """Get the dependencies zip from cache_dir, build it when the tasks
+    directory has been changed or never been zipped.
+
+    :param dependencies_path: the tasks directory of an app.
+    :return: the path of the dependencies zip.
+    """
+    cache_dir = global_config.get_cache_dir('dependencies')
+    digest = hash_dir(dependencies_path)
+    zip_output = os.path.join(cache_dir, '%s.zip' % digest)
+
+    with _deps_lock:
+        if os.path.isfile(zip_output):
+            logger.debug('Use cached dependencies zip: %s' % zip_output)
+            # Keep the recently used zip file when evicting.
+            os.utime(zip_output, None)
+        else:
+            generate_dependencies_zip(dependencies_path, zip_output)
+            evict_dependencies_cache(cache_dir, keep=zip_output)
 
-    os.chdir(previous_workdir)
     return zip_output
 
 
+def evict_dependencies_cache(cache_dir, keep=None, max_age=DEPS_CACHE_MAX_AGE,
+                             max_size=DEPS_CACHE_MAX_SIZE):
+    """Remove zip files unused for max_age seconds, then remove the least
+    recently used zip files until the cache is smaller than max_size bytes.
+    """
+    zip_files = []
+    for fname in os.listdir(cache_dir):
+        filepath = os.path.join(cache_dir, fname)
+        if fname.endswith('.zip') and filepath != keep:
+            # Another submission may have evicted the file meanwhile.
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            zip_files.append((stat.st_mtime, stat.st_size, filepath))
+
+    total_size = sum([size for _, size, _ in zip_files])
+    now = time.time()
+    for mtime, size, filepath in sorted(zip_files):
+        if now - mtime > max_age or total_size > max_size:
+            try:
+                os.remove(filepath)
+                logger.debug('Evict dependencies zip: %s' % filepath)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    logger.warning('Failed to evict dependencies zip %s: %s' % (filepath, err))
+                    continue
+            total_size -= size
+
+
 def get_version(app_dir):
     return {
         "app_name": get_remote_url(app_dir),
@@ -349,23 +513,135 @@ def uninstall_app(app_dir, is_terminal=True):
         return msg
 
 
+def open_samples(file):
+    """Open a samples file in text mode, gzip file is detected by magic number.
+    """
+    with open(file, 'rb') as f:
+        magic_number = f.read(2)
+
+    if magic_number == b'\x1f\x8b':
+        return gzip.open(file, 'rt', newline='')
+    else:
+        return open(file, 'rt', newline='')
+
+
+class SamplesReader:
+    """Read a CSV/TSV samples file (may be gzipped) row by row.
+
+    The header is read and validated when the reader is created, rows are
+    yielded lazily as dicts, so the memory stays flat for a large samples file.
+    Values are strings, unless a type is given for the column in `types`.
+
+    Example usage:
+        reader = SamplesReader('samples.csv', variables=['sample_id', 'fastq'],
+                               types={'read_length': int})
+        for sample in reader:
+            print(sample['sample_id'], sample['read_length'] + 1)
+    """
+
+    def __init__(self, file, variables=None, types=None):
+        self.file = file
+        self.types = types or {}
+        with open_samples(file) as f:
+            first_line = f.readline()
+
+        self.delimiter = self._get_delimiter(first_line)
+        self.header = next(csv.reader([first_line], delimiter=self.delimiter), [])
+        self.check_header(variables)
+
+    def _get_delimiter(self, first_line):
+        filename = re.sub(r'\.gz$', '', self.file)
+        if filename.endswith('.tsv'):
+            return '\t'
+        elif filename.endswith('.csv'):
+            return ','
+        else:
+            # A .txt file may be either, `choppy samples` writes commas to any filename.
+            return '\t' if first_line.count('\t') > first_line.count(',') else ','
+
+    def check_header(self, variables=None):
+        """Check the header once, all variables must be in the header.
+        """
+        if len(self.header) == 0 or "" in self.header:
+            raise InValidSamples("%s is not qualified, an empty column name "
+                                 "in the header." % self.file)
+
+        if variables:
+            missing = [var for var in variables if var not in self.header]
+            if missing:
+                raise InValidSamples("%s not in samples header." % ', '.join(sorted(missing)))
+
+    def __iter__(self):
+        with open_samples(self.file) as f:
+            reader = csv.DictReader(f, delimiter=self.delimiter)
+            # The first line is the header.
+            for lineno, line in enumerate(reader, start=2):
+                if None in line:
+                    raise InValidSamples("%s is not qualified, line %s has more "
+                                         "columns than the header." % (self.file, lineno))
+                yield self._convert(dict(line), lineno)
+
+    def _convert(self, sample, lineno):
+        for column, convert in self.types.items():
+            value = sample.get(column)
+            if value is None:
+                continue
+
+            try:
+                sample[column] = convert(value)
+            except (TypeError, ValueError):
+                raise InValidSamples("%s is not qualified, %s of line %s is not a valid %s: %s" %
+                                     (self.file, column, lineno,
+                                      getattr(convert, '__name__', convert), value))
+        return sample
+
+
 def parse_samples(file):
-    reader = csv.DictReader(open(file, 'rt'))
-    dict_list = []
+    try:
+        return list(SamplesReader(file))
+    except InValidSamples as err:
+        print("CSV file is not qualified: %s" % str(err))
+        sys.exit(2)
 
-    for line in reader:
-        header = line.keys()
-        if None in header or "" in header:
-            print("CSV file is not qualified.")
-            sys.exit(2)
-        dict_list.append(line)
 
-    return dict_list
+def get_app_template(app_path, template_file):
+    """Get the compiled template and its undeclared variables of an app.
 
+    Templates are compiled once by the jinja2 environment of the app, which
+    checks whether every loaded file (including the templates pulled in by
+    include/import) is up to date, so rendering thousands of samples doesn't
+    reparse the same template and an edited template is still picked up.
+
+    :param app_path: the app directory.
+    :param template_file: inputs or workflow.wdl.
+    :return: (jinja2.Template, frozenset of undeclared variables)
+    """
+    app_path = os.path.abspath(app_path)
+    key = (app_path, template_file)
+
+    with _template_lock:
+        env = _template_envs.get(app_path)
+        if env is None:
+            env = _template_envs[app_path] = Environment(loader=FileSystemLoader(app_path),
+                                                         auto_reload=True)
 
-def render_app(app_path, template_file, data):
-    env = Environment(loader=FileSystemLoader(app_path))
     template = env.get_template(template_file)
+    with _template_lock:
+        cached = _template_cache.get(key)
+        if cached and cached[0] is template:
+            return template, cached[1]
+
+    source, filename, _ = env.loader.get_source(env, template_file)
+    ast = env.parse(source, name=template_file, filename=filename)
+    variables = frozenset(meta.find_undeclared_variables(ast))
+
+    with _template_lock:
+        _template_cache[key] = (template, variables)
+    return template, variables
+
+
+def render_app(app_path, template_file, data):
+    template, _ = get_app_template(app_path, template_file)
     return template.render(**data)
 
 
@@ -426,9 +702,7 @@ def listapps():
 
 
 def get_header(file):
-    reader = csv.DictReader(open(file, 'rb'))
-
-    return reader.fieldnames
+    return SamplesReader(file).header
 
 
 def write(path, filename, data):
@@ -437,17 +711,22 @@ def write(path, filename, data):
 
 
 def submit_workflow(wdl, inputs, dependencies, label, username=None,
-                    server='localhost', extra_options=None, labels_dict=None):
+                    server='localhost', extra_options=None, labels_dict=None,
+                    wdl_string=False):
+    """Submit a workflow with the labels of the user.
+
+    :param wdl: the path of WDL file, or a WDL string when wdl_string is True.
+    :param inputs: the path of inputs json file, or a dict of inputs.
+    """
     labels_dict = kv_list_to_dict(
         label) if kv_list_to_dict(label) is not None else {}
     if username is None:
         username = global_config.getuser()
     labels_dict['username'] = username
-    section_name = 'remote_%s' % server if server != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(server, section_name)
-    cromwell = Cromwell(host=host, port=port, auth=auth)
+    cromwell = get_cromwell(server)
     result = cromwell.jstart_workflow(wdl_file=wdl, json_file=inputs,
                                       dependencies=dependencies,
+                                      wdl_string=wdl_string,
                                       extra_options=kv_list_to_dict(
                                           extra_options),
                                       custom_labels=labels_dict)
@@ -456,6 +735,41 @@ def submit_workflow(wdl, inputs, dependencies, label, username=None,
     return result
 
 
+def submit_workflow_batch(wdl, inputs_list, dependencies, label, username=None,
+                          server='localhost', extra_options=None, wdl_string=False):
+    """Submit workflows of the same WDL in one request, see submit_workflow.
+
+    :param inputs_list: a list of inputs dicts.
+    :param label: the label list of all workflows.
+    :return: a list of results in the order of inputs_list.
+    """
+    labels_dict = kv_list_to_dict(
+        label) if kv_list_to_dict(label) is not None else {}
+    if username is None:
+        username = global_config.getuser()
+    labels_dict['username'] = username
+    cromwell = get_cromwell(server)
+    results = cromwell.jstart_workflow_batch(wdl_file=wdl, inputs_list=inputs_list,
+                                             dependencies=dependencies,
+                                             wdl_string=wdl_string,
+                                             extra_options=kv_list_to_dict(
+                                                 extra_options),
+                                             custom_labels=labels_dict)
+    for result in results:
+        result['port'] = cromwell.port
+
+    return results
+
+
+def label_workflows(workflow_ids, labels_list, server='localhost'):
+    """Add the labels of every workflow, see Cromwell.label_workflows.
+
+    :return: a list of error messages in the order of workflow_ids, None when succeeded.
+    """
+    cromwell = get_cromwell(server)
+    return cromwell.label_workflows(workflow_ids, labels_list)
+
+
 def kv_list_to_dict(kv_list):
     """Converts a list of kv pairs delimited with colon into a dictionary.
 
@@ -502,19 +816,12 @@ def get_all_variables(app_dir, no_default=False):
 
 
 def get_vars_from_app(app_path, template_file, no_default=False):
-    env = Environment()
-    template = os.path.join(app_path, template_file)
-    with open(template) as f:
-        templ_str = f.read()
-        ast = env.parse(templ_str)
-        variables = meta.find_undeclared_variables(ast)
-
-        if no_default:
-            app_default_var = AppDefaultVar(app_path)
-            diff_variables = app_default_var.diff(variables)
-            return diff_variables
+    _, variables = get_app_template(app_path, template_file)
 
-    return variables
+    if no_default:
+        return set(variables) - set(load_app_defaults(app_path).keys())
+
+    return set(variables)
 
 
 def check_variables(app_path, template_file, line_dict=None, header_list=None,
@@ -522,8 +829,7 @@ def check_variables(app_path, template_file, line_dict=None, header_list=None,
     variables = get_vars_from_app(app_path, template_file)
     variables = list(variables) + ['sample_id', ]
     if no_default:
-        app_default_var = AppDefaultVar(app_path)
-        variables = app_default_var.diff(variables)
+        variables = set(variables) - set(load_app_defaults(app_path).keys())
 
     for var in variables:
         if line_dict:
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.core.async_cromwell
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module to interact with Cromwell Server by asyncio.
+
+    Requires aiohttp, use `pip install choppy-pipe[async]` to install it.
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import json
+import asyncio
+import logging
+from choppy import exceptions
+from choppy.config import get_global_config
+from choppy.core.cromwell import (load_workflow_inputs, build_submit_files, get_labels_key,
+                                  get_cached_version, set_cached_version)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+global_config = get_global_config()
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = (500, 502, 503, 504)
+
+
+def check_aiohttp():
+    if aiohttp is None:
+        raise exceptions.MissingDependency('AsyncCromwell requires aiohttp, '
+                                           'use `pip install choppy-pipe[async]` '
+                                           'to install it.')
+
+
+class AsyncCromwell:
+    """The coroutine counterpart of choppy.core.cromwell.Cromwell.
+
+    All requests share one connection pool (pool_size connections) and at
+    most `concurrency` requests are in flight at the same time, so callers
+    can fan out hundreds of coroutines safely.
+
+    Example usage:
+        async def main():
+            async with AsyncCromwell(host='localhost', port=8000) as cromwell:
+                status = await asyncio.gather(*[cromwell.status(workflow_id)
+                                                for workflow_id in workflow_ids])
+    """
+
+    def __init__(self, host='localhost', port=8000, auth=None, pool_size=100,
+                 concurrency=50, max_retries=3, backoff_factor=0.5, timeout=300):
+        check_aiohttp()
+        self.host = host
+        self.port = port
+        self.auth = aiohttp.BasicAuth(*auth) if auth and auth[0] else None
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.url = 'http://%s:%s/api/workflows/v1' % (host, port)
+        self.version_url = 'http://%s:%s/engine/v1/version' % (host, port)
+        self._session = None
+        self._semaphore = None
+        self._long_version = None
+
+    @property
+    def session(self):
+        # The session and the semaphore must be created in the running loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, auth=self.auth,
+                                                  timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def request(self, method, url, idempotent=True, **kwargs):
+        """Send a request and return the json of response.
+
+        Only idempotent requests are retried, so a workflow is never
+        submitted twice because of a retry.
+
+        :param method: GET, POST or PATCH.
+        :param url: the full url.
+        :param idempotent: whether to retry when the request failed.
+        """
+        session = self.session
+        retries = self.max_retries if idempotent else 0
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    async with session.request(method, url, **kwargs) as resp:
+                        if resp.status in RETRY_STATUS and attempt < retries:
+                            raise aiohttp.ClientResponseError(resp.request_info, resp.history,
+                                                              status=resp.status)
+                        text = await resp.text()
+                        return json.loads(text)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if attempt >= retries:
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                logger.debug('%s %s failed (%s), retry in %ss.' % (method, url, str(err), delay))
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def get(self, rtype, workflow_id=None, params=None):
+        if workflow_id:
+            url = '%s/%s/%s' % (self.url, workflow_id, rtype)
+        else:
+            url = '%s/%s' % (self.url, rtype)
+        return await self.request('GET', url, params=params)
+
+    async def version(self):
+        """The cromwell version, probed on first use and cached per host:port
+        like Cromwell.long_version.
+        """
+        if self._long_version is None:
+            self._long_version = get_cached_version(self.host, self.port)
+
+        if self._long_version is None:
+            result = await self.request('GET', self.version_url)
+            self._long_version = result['cromwell']
+            set_cached_version(self.host, self.port, self._long_version)
+        return self._long_version
+
+    async def short_version(self):
+        return int((await self.version()).split('-')[0])
+
+    async def submit(self, wdl, inputs, dependencies=None, labels=None, options=None):
+        """Submit a workflow, the request is the same as Cromwell.jstart_workflow.
+
+        :param wdl: the WDL string.
+        :param inputs: a dict, json file or json string of workflow inputs,
+                       see choppy.core.cromwell.load_workflow_inputs.
+        :param dependencies: the path of dependencies zip file. Optional.
+        :param labels: a dict of labels. Optional.
+        :param options: a dict of workflow options. Optional.
+        :return: Request response json.
+        """
+        labels_key = get_labels_key(await self.short_version()) if labels else 'labels'
+        files = build_submit_files(wdl, json.dumps(load_workflow_inputs(inputs)),
+                                   dependencies=dependencies, wdl_string=True,
+                                   extra_options=options, custom_labels=labels,
+                                   labels_key=labels_key)
+
+        data = aiohttp.FormData()
+        for name, (filename, content, content_type) in files.items():
+            data.add_field(name, content, filename=filename, content_type=content_type)
+        return await self.request('POST', self.url, idempotent=False, data=data)
+
+    async def status(self, workflow_id):
+        return await self.get('status', workflow_id)
+
+    async def metadata(self, workflow_id, include_keys=None, exclude_keys=None):
+        params = []
+        params.extend([('includeKey', key) for key in include_keys or []])
+        params.extend([('excludeKey', key) for key in exclude_keys or []])
+        return await self.get('metadata', workflow_id, params=params)
+
+    async def query(self, query_dict):
+        """Query workflows, a list value is expanded to repeated keys.
+
+        :param query_dict: Dictionary of query terms, such as {"id": [id1, id2]}.
+        """
+        params = []
+        for key, value in query_dict.items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            params.extend([(key, str(item)) for item in values])
+        return await self.get('query', params=params)
+
+    async def labels(self, workflow_id):
+        return await self.get('labels', workflow_id)
+
+    async def label_workflow(self, workflow_id, labels):
+        url = '%s/%s/labels' % (self.url, workflow_id)
+        return await self.request('PATCH', url, json=labels)
+
+    async def abort(self, workflow_id):
+        url = '%s/%s/abort' % (self.url, workflow_id)
+        return await self.request('POST', url, idempotent=False)
+
+    async def outputs(self, workflow_id):
+        return await self.get('outputs', workflow_id)
+
+    async def logs(self, workflow_id):
+        return await self.get('logs', workflow_id)
+
+    async def backends(self):
+        return await self.get('backends')
+
+    async def gather(self, method, args_list, return_exceptions=True):
+        """Call a method concurrently with every item of args_list.
+
+        :param method: the name of a coroutine method, such as status.
+        :param args_list: a list of arguments, a tuple is unpacked.
+        :return: a list of results in the order of args_list.
+        """
+        func = getattr(self, method)
+        coros = [func(*args) if isinstance(args, tuple) else func(args)
+                 for args in args_list]
+        return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+
+class SyncCromwell:
+    """A blocking facade of AsyncCromwell for the synchronous code, such as
+    the command line interface.
+
+    Every method of AsyncCromwell is available and runs to completion in a
+    private event loop.
+
+    Example usage:
+        cromwell = SyncCromwell(AsyncCromwell(host='localhost', port=8000))
+        statuses = cromwell.gather('status', workflow_ids)
+        cromwell.close()
+    """
+
+    def __init__(self, async_cromwell):
+        self.async_cromwell = async_cromwell
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_cromwell, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            return self.run(attr(*args, **kwargs))
+        return wrapper
+
+    def close(self):
+        self.run(self.async_cromwell.close())
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def get_async_cromwell(server='localhost', concurrency=50):
+    """Make an AsyncCromwell for a server in choppy config.
+
+    :param server: localhost or the name of a remote_* section.
+    :param concurrency: the maximum number of requests in flight.
+    """
+    section_name = global_config.get_server_section(server)
+    host, port, auth = global_config.get_conn_info(server, section_name)
+    pool_info = global_config.get_pool_info(section_name)
+    return AsyncCromwell(host=host, port=port, auth=auth,
+                         pool_size=max(pool_info['pool_size'], concurrency),
+                         concurrency=concurrency,
+                         max_retries=pool_info['max_retries'],
+                         backoff_factor=pool_info['backoff_factor'])
@@ -14,16 +14,45 @@ import logging
 import json
 import requests
 import datetime
+import os
 import sys
+import time
+import threading
+from itertools import islice
 from choppy.config import get_global_config
+from choppy.core.metadata_cache import MetadataCache
 from choppy import exit_code
 
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests.utils import quote
 from ratelimit import rate_limited
 
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
 global_config = get_global_config()
 module_logger = logging.getLogger(__name__)
 ONE_MINUTE = 60
+QUERY_PAGE_SIZE = 500
+QUERY_CHUNK_SIZE = 100
+
+# The metadata keys used by explain_workflow.
+EXPLAIN_METADATA_KEYS = ['id', 'status', 'workflowRoot']
+CALL_LOG_METADATA_KEYS = ['executionStatus', 'shardIndex', 'stdout', 'stderr']
+
+# Cromwell instances shared by all callers, keyed by server name.
+_cromwell_instances = {}
+_cromwell_lock = threading.Lock()
+
+# Cromwell versions keyed by host:port, value is (version, probed_at).
+VERSION_CACHE_TTL = 24 * 60 * 60
+VERSION_CACHE_FILE = 'cromwell_versions.json'
+_version_cache = {}
+_version_lock = threading.Lock()
 
 
 class Cromwell:
@@ -37,10 +66,12 @@ class Cromwell:
         {"VesperWorkflow.project_name":"Vesper_Anid_test"}
     """
 
-    def __init__(self, host='localhost', port=8000, auth=None):
+    def __init__(self, host='localhost', port=8000, auth=None, pool_size=10,
+                 max_retries=3, backoff_factor=0.5, metadata_cache_dir=None):
         self.host = host
         self.port = port
         self.auth = auth
+        self.session = self._make_session(pool_size, max_retries, backoff_factor)
 
         self.url = 'http://' + host + ':' + \
             str(self.port) + '/api/workflows/v1'
@@ -49,27 +80,70 @@ class Cromwell:
         self.logger = logging.getLogger(__name__)
         self.logger.debug('URL:{}'.format(self.url))
 
-        v_url = "http://{}:{}/engine/v1/version".format(host, str(self.port))
+        self._long_version = None
+        # Shared by all threads using this instance, terminal workflows are
+        # also saved to metadata_cache_dir.
+        self.metadata_cache = MetadataCache(cache_dir=metadata_cache_dir)
+        # (path, mtime, content) of the last dependencies zip file.
+        self._dependencies = None
+        self._dependencies_lock = threading.Lock()
+
+    @property
+    def long_version(self):
+        """The cromwell version, probed on first use and cached per host:port.
+        """
+        if self._long_version is None:
+            self._long_version = get_cached_version(self.host, self.port)
 
-        try:
-            self.long_version = json\
-                .loads(requests
-                       .get(v_url, auth=self.auth)
-                       .content)['cromwell']
-        except (requests.ConnectionError, ValueError) as e:
-            msg = "Unable to connect to {}:{}:\n{}".format(
-                self.host, self.port, str(e))
-            print_log_exit(msg)
-
-        self.short_version = int(self.long_version.split('-')[0])
-        self.cached_metadata = {}
-
-    def get(self, rtype, workflow_id=None, headers=None, v2=False):
+        if self._long_version is None:
+            v_url = "http://{}:{}/engine/v1/version".format(self.host, str(self.port))
+            try:
+                self._long_version = json\
+                    .loads(self.session
+                           .get(v_url, auth=self.auth)
+                           .content)['cromwell']
+            except (requests.ConnectionError, ValueError) as e:
+                msg = "Unable to connect to {}:{}:\n{}".format(
+                    self.host, self.port, str(e))
+                print_log_exit(msg)
+
+            set_cached_version(self.host, self.port, self._long_version)
+
+        return self._long_version
+
+    @property
+    def short_version(self):
+        return int(self.long_version.split('-')[0])
+
+    @staticmethod
+    def _make_session(pool_size, max_retries, backoff_factor):
+        """Build a keep-alive session with a bounded connection pool.
+
+        Only idempotent requests are retried, so a workflow is never
+        submitted twice because of a retry.
+
+        :param pool_size: The maximum number of connections kept alive.
+        :param max_retries: The number of retries for a failed request.
+        :param backoff_factor: The backoff factor between two retries.
+        :return: A requests session.
+        """
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, rtype, workflow_id=None, headers=None, v2=False, params=None):
         """A generic get request function.
 
         :param rtype: a type of request such as 'abort' or 'status'.
         :param workflow_id: The ID of a workflow if get request requires one.
         :param headers: Optional headers for request.
+        :param params: Optional query parameters for request.
         :return: json of request response
         """
         url = self.url if not v2 else self.url2
@@ -79,9 +153,10 @@ class Cromwell:
             workflow_url = url + '/' + rtype
         self.logger.debug("GET REQUEST:{}".format(workflow_url))
         if headers:
-            r = requests.get(workflow_url, headers=headers, auth=self.auth)
+            r = self.session.get(workflow_url, headers=headers, auth=self.auth,
+                                 params=params)
         else:
-            r = requests.get(workflow_url, auth=self.auth)
+            r = self.session.get(workflow_url, auth=self.auth, params=params)
         return json.loads(r.content)
 
     def post(self, rtype, workflow_id=None):
@@ -96,7 +171,7 @@ class Cromwell:
         else:
             workflow_url = self.url + '/' + rtype
         self.logger.debug("POST REQUEST:{}".format(workflow_url))
-        r = requests.post(workflow_url, auth=self.auth)
+        r = self.session.post(workflow_url, auth=self.auth)
         return json.loads(r.text)
 
     def patch(self, rtype, workflow_id, payload, headers):
@@ -112,8 +187,8 @@ class Cromwell:
         self.logger.debug("POST REQUEST:{}".format(workflow_url))
         tries = 4
         while tries != 0:
-            r = requests.patch(url=workflow_url, data=payload,
-                               headers=headers, auth=self.auth)
+            r = self.session.patch(url=workflow_url, data=payload,
+                                   headers=headers, auth=self.auth)
             if r.status_code == 200:
                 logging.info('{} request succeeded.'.format(rtype))
                 tries = 0
@@ -132,7 +207,7 @@ class Cromwell:
         :param disable_caching: If true, do not use cached data to restart the workflow. # noqa
         :return: Request response json.
         """
-        metadata = self.query_metadata(workflow_id)
+        metadata = self.query_metadata_cached(workflow_id)
         processed_labels = self.process_metadata_label(metadata)
 
         try:
@@ -150,9 +225,19 @@ class Cromwell:
 
     @staticmethod
     def getCalls(status, call_arr, full_logs=False, limit_n=3):
-        filteredCalls = list(
-            filter(lambda c: c[1][0]['executionStatus'] == status, call_arr.items()))
-        filteredCalls = map(lambda c: (c[0], c[1][0]), filteredCalls)
+        """Get the logs of the first limit_n shards with the status.
+
+        :param status: such as Failed or Running.
+        :param call_arr: the calls dict of metadata, or an iterable of (task, shard) pairs, such as iter_metadata_calls.
+        :param full_logs: read the content of the stdout/stderr files.
+        :param limit_n: the maximum number of shards.
+        :return: a list of logs.
+        """
+        if isinstance(call_arr, dict):
+            call_arr = ((task, shard) for task, shards in call_arr.items()
+                        for shard in shards)
+        filteredCalls = islice(((task, shard) for task, shard in call_arr
+                                if shard.get('executionStatus') == status), limit_n)
 
         def parse_logs(call_tuple):
             call = call_tuple[1]
@@ -182,7 +267,7 @@ class Cromwell:
                     log["stderr"]['log'] = e
             return log
 
-        return map(lambda c: parse_logs(c), filteredCalls[:limit_n])
+        return [parse_logs(c) for c in filteredCalls]
 
     def explain_workflow(self, workflow_id, include_inputs=True):
         def assign(sdict, ddict, key):
@@ -190,7 +275,18 @@ class Cromwell:
                 ddict[key] = sdict[key]
             except KeyError as e:
                 ddict[key] = e
-        result = self.query_metadata(workflow_id)
+
+        # Only fetch the needed keys and stream the calls, unless the full
+        # metadata is cached already.
+        result = self.metadata_cache.get(workflow_id)
+        if result is not None:
+            calls = result.get('calls', {})
+        else:
+            keys = EXPLAIN_METADATA_KEYS + (['inputs'] if include_inputs else [])
+            result = self.query_metadata(workflow_id, include_keys=keys)
+            calls = None
+            if 'status' not in result:
+                result = None
         explain_res = {}
         additional_res = {}
         stdout_res = {}
@@ -199,13 +295,15 @@ class Cromwell:
             assign(result, explain_res, 'status')
             assign(result, explain_res, 'id')
             assign(result, explain_res, 'workflowRoot')
-            if explain_res["status"] == "Failed":
-                stdout_res["failed_jobs"] = Cromwell.getCalls('Failed', result['calls'],
-                                                              full_logs=True)
-
-            elif explain_res["status"] == "Running":
-                explain_res["running_jobs"] = Cromwell.getCalls(
-                    'Running', result['calls'])
+            if explain_res["status"] in ("Failed", "Running"):
+                if calls is None:
+                    calls = self.iter_metadata_calls(workflow_id,
+                                                     include_keys=CALL_LOG_METADATA_KEYS)
+                if explain_res["status"] == "Failed":
+                    stdout_res["failed_jobs"] = Cromwell.getCalls('Failed', calls,
+                                                                  full_logs=True)
+                else:
+                    explain_res["running_jobs"] = Cromwell.getCalls('Running', calls)
 
             if include_inputs:
                 additional_res["inputs"] = result["inputs"]
@@ -239,7 +337,7 @@ class Cromwell:
             # add dependency as zip file
             files['wdlDependencies'] = (dependencies, open(
                 dependencies, 'rb'), 'application/zip')
-        r = requests.post(self.url, files=files, auth=self.auth)
+        r = self.session.post(self.url, files=files, auth=self.auth)
         return json.loads(r.text)
 
     def jstart_workflow(self, wdl_file, json_file, dependencies=None,
@@ -248,7 +346,7 @@ class Cromwell:
         """Start a workflow using json file for argument inputs.
 
         :param wdl_file: Workflow description file or WDL string (specify wdl_string if so). # noqa
-        :param json_file: JSON file or JSON string containing arguments.
+        :param json_file: JSON file, JSON string or a dict containing arguments.
         :param dependencies: The subworkflow zip file. Optional.
         :param wdl_string: If the wdl_file argument is actually a string. Optional. # noqa
         :param disable_caching: Disable Cromwell cacheing.
@@ -256,55 +354,80 @@ class Cromwell:
         :return: Request response json.
         """
 
-        if not json_file.startswith("{"):
-            with open(json_file) as fh:
-                args = json.load(fh)
-            fh.close()
-            args['user'] = global_config.getuser()
-            # j_args = json.dumps(args)
-        else:
-            args = json.loads(json_file)
-            # j_args = json_file
-
         # j_args needs to be a string at this point
-        j_args = json.dumps(args)
-
-        if not wdl_string:
-            files = {'wdlSource': (wdl_file, open(wdl_file, 'rb'), 'application/octet-stream'),
-                     'workflowInputs': ('report.csv', j_args, 'application/json')}
-        else:
-            files = {'wdlSource': ('workflow.wdl', wdl_file, 'application/text-plain'),
-                     'workflowInputs': ('report.csv', j_args, 'application/json')}
-        if custom_labels:
-            if self.short_version >= 30:
-                label_key = "labels"
-            else:
-                label_key = "customLabels"
-            files[label_key] = ('labels.json', json.dumps(
-                custom_labels), 'application/json')
-        if dependencies:
-            # add dependency as zip file
-            files['wdlDependencies'] = (dependencies, open(
-                dependencies, 'rb'), 'application/zip')
-        workflow_options = {}
-        if disable_caching:
-            workflow_options.update({"read_from_cache": False})
-        if extra_options:
-            workflow_options.update(extra_options)
-        if disable_caching or extra_options:
-            files['workflowOptions'] = ('options.json', json.dumps(
-                workflow_options), 'application/json')
-            print('Enabling the following additional workflow options:')
-            for k, v in workflow_options.items():
-                print("{}:{}".format(k, v))
-
-        r = requests.post(self.url, files=files, auth=self.auth) \
-            if not v2 else requests.post(self.url2, files=files,
-                                         auth=self.auth)
+        j_args = json.dumps(load_workflow_inputs(json_file))
+        files = self._submit_files(wdl_file, j_args, dependencies=dependencies,
+                                   wdl_string=wdl_string, disable_caching=disable_caching,
+                                   extra_options=extra_options, custom_labels=custom_labels)
+
+        r = self.session.post(self.url, files=files, auth=self.auth) \
+            if not v2 else self.session.post(self.url2, files=files,
+                                             auth=self.auth)
         if r.status_code not in [200, 201]:
             print_log_exit("Request Failed: {}".format(r.content))
         return json.loads(r.text)
 
+    def jstart_workflow_batch(self, wdl_file, inputs_list, dependencies=None,
+                              wdl_string=False, disable_caching=False,
+                              extra_options=None, custom_labels=None):
+        """Start many workflows of the same WDL in one request by the batch endpoint.
+
+        The WDL and the dependencies are uploaded once for all workflows, the
+        labels of every workflow can be added by label_workflows afterwards.
+
+        :param wdl_file: Workflow description file or WDL string (specify wdl_string if so). # noqa
+        :param inputs_list: a list of dicts containing arguments, `user` is added to every dict.
+        :param dependencies: The subworkflow zip file. Optional.
+        :param custom_labels: the labels of all workflows. Optional.
+        :return: a list of response json (id and status) in the order of inputs_list.
+        """
+        user = global_config.getuser()
+        j_args = json.dumps([dict(inputs, user=user) for inputs in inputs_list])
+        files = self._submit_files(wdl_file, j_args, dependencies=dependencies,
+                                   wdl_string=wdl_string, disable_caching=disable_caching,
+                                   extra_options=extra_options, custom_labels=custom_labels)
+
+        r = self.session.post(self.url + '/batch', files=files, auth=self.auth)
+        if r.status_code not in [200, 201]:
+            raise requests.HTTPError("Batch request failed: {}".format(r.content), response=r)
+
+        results = json.loads(r.text)
+        if len(results) != len(inputs_list):
+            raise ValueError("Submitted %s workflows, but got %s workflow ids." %
+                             (len(inputs_list), len(results)))
+        return results
+
+    def _submit_files(self, wdl_file, j_args, dependencies=None, wdl_string=False,
+                      disable_caching=False, extra_options=None, custom_labels=None):
+        """Build the multipart files of a submission, see build_submit_files.
+
+        :param j_args: the json string of inputs.
+        """
+        # Only probe the version when it matters.
+        labels_key = get_labels_key(self.short_version) if custom_labels else 'labels'
+        return build_submit_files(wdl_file, j_args, dependencies=dependencies,
+                                  wdl_string=wdl_string, disable_caching=disable_caching,
+                                  extra_options=extra_options, custom_labels=custom_labels,
+                                  labels_key=labels_key,
+                                  read_dependencies=self.read_dependencies)
+
+    def read_dependencies(self, dependencies):
+        """Read the dependencies zip file, the content is kept until the file
+        changes, so a batch of samples sharing the zip file reads it once.
+        """
+        mtime = os.path.getmtime(dependencies)
+        with self._dependencies_lock:
+            cached = self._dependencies
+            if cached and cached[0] == dependencies and cached[1] == mtime:
+                return cached[2]
+
+        with open(dependencies, 'rb') as fh:
+            content = fh.read()
+
+        with self._dependencies_lock:
+            self._dependencies = (dependencies, mtime, content)
+        return content
+
     def stop_workflow(self, workflow_id):
         """Ends a running workflow.
 
@@ -317,32 +440,90 @@ class Cromwell:
     def query_metadata_cached(self, workflow_id, expire=15):
         """Return all cached metadata for a given workflow
 
+        The metadata of a terminal workflow is cached forever, others are
+        cached for expire seconds.
+
         :param workflow_id: The workflow identifier
         :param expire: The number of seconds the cache is deemed to be not fresh # noqa
         :return: Request response json
         """
-        if workflow_id in self.cached_metadata:
-            date_time = datetime.datetime.now() - datetime.timedelta(seconds=15)
-            if self.cached_metadata[workflow_id]["timestamp"] > date_time:
-                return self.cached_metadata[workflow_id]
-
-        metadata = self.query_metadata(workflow_id, v2=True)
-        metadata["timestamp"] = datetime.datetime.now()
-        self.cached_metadata[workflow_id] = metadata
+        metadata = self.metadata_cache.get(workflow_id, ttl=expire)
+        if metadata is not None:
+            return metadata
+
+        metadata = self.query_metadata(workflow_id)
+        # Don't cache an error response, such as an unknown workflow id.
+        if 'id' in metadata and 'status' in metadata:
+            self.metadata_cache.set(workflow_id, metadata)
         return metadata
 
+    def _metadata_params(self, include_keys=None, exclude_keys=None,
+                         expand_subworkflows=False):
+        params = {}
+        if include_keys:
+            params['includeKey'] = list(include_keys)
+        if exclude_keys:
+            params['excludeKey'] = list(exclude_keys)
+        if expand_subworkflows:
+            params['expandSubWorkflows'] = 'true'
+        return params
+
     @rate_limited(300, ONE_MINUTE)
-    def query_metadata(self, workflow_id, v2=False):
+    def query_metadata(self, workflow_id, v2=False, include_keys=None,
+                       exclude_keys=None, expand_subworkflows=False):
         """Return all metadata for a given workflow.
 
         :param workflow_id: The workflow identifier.
+        :param include_keys: Only return these metadata keys. Optional.
+        :param exclude_keys: Don't return these metadata keys. Optional.
+        :param expand_subworkflows: Embed the metadata of subworkflows. Optional.
         :return: Request Response json.
         """
         self.logger.info(
             'Querying metadata for workflow {}'.format(workflow_id))
+        params = self._metadata_params(include_keys, exclude_keys, expand_subworkflows)
+        # The response is gzipped when cromwell enables it.
         return self.get('metadata', workflow_id,
-                        {'Accept': 'application/json',
-                         'Accept-Encoding': 'identity'}, v2=v2)
+                        {'Accept': 'application/json'}, v2=v2,
+                        params=params)
+
+    @rate_limited(300, ONE_MINUTE)
+    def _stream_metadata(self, workflow_id, params):
+        """Send the metadata request of iter_metadata_calls, the decorator
+        can't throttle the generator itself, which only sends it when iterated.
+        """
+        url = '{}/{}/metadata'.format(self.url, workflow_id)
+        self.logger.debug("GET REQUEST:{}".format(url))
+        return self.session.get(url, auth=self.auth, params=params, stream=True,
+                                headers={'Accept': 'application/json'})
+
+    def iter_metadata_calls(self, workflow_id, include_keys=None, exclude_keys=None):
+        """Yield the shards in the metadata of a workflow one by one.
+
+        The response is parsed incrementally when ijson is installed, so
+        only one shard is kept in memory at a time. Otherwise the whole
+        response is parsed.
+
+        :param workflow_id: The workflow identifier.
+        :param include_keys: Only return these keys of a shard, such as executionStatus. Optional.
+        :param exclude_keys: Don't return these metadata keys. Optional.
+        :return: A generator of (task name, shard) pairs.
+        """
+        params = self._metadata_params(include_keys, exclude_keys)
+        r = self._stream_metadata(workflow_id, params)
+        try:
+            if ijson is None:
+                metadata = json.loads(r.content)
+                for task, shards in metadata.get('calls', {}).items():
+                    for shard in shards:
+                        yield task, shard
+            else:
+                # Let urllib3 decompress the gzipped response.
+                r.raw.decode_content = True
+                for task, shard in parse_calls(r.raw):
+                    yield task, shard
+        finally:
+            r.close()
 
     def process_metadata_label(self, metadata):
         """Transfer the labels from an old workflow id to a new one. Labels applied by the system are removed so as to avoid conflicts.
@@ -376,6 +557,28 @@ class Cromwell:
                    'Accept': 'application/json'}
         return self.patch('labels', workflow_id, labels_json, headers)
 
+    def label_workflows(self, workflow_ids, labels_list):
+        """Label many workflows, one request per workflow.
+
+        It never raises, a failure only affects the labels of the workflow.
+
+        :param workflow_ids: a list of workflow ids.
+        :param labels_list: the labels dict of every workflow in the order of workflow_ids.
+        :return: a list of error messages in the order of workflow_ids, None when succeeded.
+        """
+        errors = []
+        for workflow_id, labels in zip(workflow_ids, labels_list):
+            error = None
+            if labels:
+                try:
+                    r = self.label_workflow(workflow_id, labels)
+                    if r.status_code != 200:
+                        error = "Error {}: {}".format(r.status_code, r.text)
+                except Exception as err:
+                    error = str(err)
+            errors.append(error)
+        return errors
+
     def query_labels(self, labels, start_time=None, status_filter=None,
                      running_jobs=False):
         """Query cromwell database with a given set of labels.
@@ -397,7 +600,7 @@ class Cromwell:
         url = url + 'status=Running' if running_jobs else url
 
         # In some cases we can get a dangling & so this removed that.
-        r = requests.get(url.rstrip('&'), auth=self.auth)
+        r = self.session.get(url.rstrip('&'), auth=self.auth)
         return json.loads(r.content)
 
     def query_status(self, workflow_id):
@@ -436,9 +639,76 @@ class Cromwell:
         base_url = self.url + '/query?'
         query_url = self.build_query_url(base_url, query_dict)
         self.logger.debug("QUERY REQUEST:{}".format(query_url))
-        r = requests.get(query_url, auth=self.auth)
+        r = self.session.get(query_url, auth=self.auth)
         return json.loads(r.text)
 
+    def query_many(self, ids=None, labels=None, statuses=None, since=None,
+                   names=None, additional_fields=None, page_size=QUERY_PAGE_SIZE,
+                   chunk_size=QUERY_CHUNK_SIZE):
+        """Query workflows page by page and yield the results one by one.
+
+        Long id lists are split into chunks of chunk_size ids to keep the
+        URL short, the other filters are applied to every chunk.
+
+        :param ids: A list of workflow ids. Optional.
+        :param labels: A dict of labels, a workflow must match all of them. Optional.
+        :param statuses: A status or a list of statuses. Optional.
+        :param since: Only the workflows submitted after the time, a datetime or an ISO 8601 string. Optional.
+        :param names: A list of workflow names. Optional.
+        :param additional_fields: Such as ['labels']. Optional.
+        :param page_size: The number of results per request.
+        :param chunk_size: The number of ids per request.
+        :return: A generator of query results.
+        """
+        params = []
+        for key, value in (labels or {}).items():
+            params.append(('label', '%s:%s' % (key, value)))
+        if isinstance(statuses, str):
+            statuses = [statuses]
+        params.extend([('status', status) for status in statuses or []])
+        params.extend([('name', name) for name in names or []])
+        params.extend([('additionalQueryResultFields', field)
+                       for field in additional_fields or []])
+        if since is not None:
+            params.append(('submission', self.format_query_time(since)))
+
+        if ids is not None:
+            ids = list(ids)
+            id_chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        else:
+            id_chunks = [None]
+
+        # A workflow may move to another page when new workflows are submitted.
+        seen = set()
+        for id_chunk in id_chunks:
+            chunk_params = params + [('id', workflow_id) for workflow_id in id_chunk or []]
+            page = 1
+            while True:
+                page_params = chunk_params + [('page', page), ('pageSize', page_size)]
+                self.logger.debug("QUERY REQUEST:{} {}".format(self.url, page_params))
+                r = self.session.get(self.url + '/query', params=page_params, auth=self.auth)
+                if r.status_code != 200:
+                    print_log_exit("Query Failed: {}".format(r.content), sys_exit=False)
+                    r.raise_for_status()
+
+                response = json.loads(r.text)
+                results = response.get('results', [])
+                for result in results:
+                    if result.get('id') not in seen:
+                        seen.add(result.get('id'))
+                        yield result
+
+                total = response.get('totalResultsCount', 0)
+                if len(results) < page_size or page * page_size >= total:
+                    break
+                page += 1
+
+    @staticmethod
+    def format_query_time(value):
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return value
+
     @staticmethod
     def build_query_url(base_url, url_dict, sep='='):
         """A function for building a query URL given a dictionary of key/value pairs to query. # noqa
@@ -457,8 +727,8 @@ class Cromwell:
                 dt = quote(str(value)) + 'Z'
                 value = dt.replace('%20', 'T')
             if isinstance(value, list):
-                for item in value:
-                    url_string += '{}{}{}'.format(key, sep, item)
+                url_string += '&'.join(['{}{}{}'.format(key, sep, item)
+                                        for item in value])
             else:
                 url_string += '{}{}{}'.format(key, sep, value)
             first = False
@@ -468,6 +738,157 @@ class Cromwell:
         return self.get('backends')
 
 
+def parse_calls(fileobj):
+    """Parse the calls of a metadata json incrementally by ijson.
+
+    :param fileobj: a file-like object of metadata json.
+    :return: A generator of (task name, shard) pairs.
+    """
+    task = None
+    shard_prefix = None
+    builder = None
+    for prefix, event, value in ijson.parse(fileobj):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == shard_prefix and event == 'end_map':
+                yield task, builder.value
+                builder = None
+        elif prefix == 'calls' and event == 'map_key':
+            task = value
+            shard_prefix = 'calls.%s.item' % task
+        elif task is not None and prefix == shard_prefix and event == 'start_map':
+            builder = ObjectBuilder()
+            builder.event(event, value)
+
+
+def load_workflow_inputs(json_file):
+    """Load the inputs of a submission, shared by Cromwell and AsyncCromwell.
+
+    :param json_file: JSON file, JSON string or a dict. `user` is added
+                      unless a JSON string is given, which is submitted as is.
+    :return: a new dict.
+    """
+    if isinstance(json_file, dict):
+        # Rendered in memory, don't change the caller's dict.
+        args = dict(json_file)
+        args['user'] = global_config.getuser()
+    elif not json_file.startswith("{"):
+        with open(json_file) as fh:
+            args = json.load(fh)
+        args['user'] = global_config.getuser()
+    else:
+        args = json.loads(json_file)
+    return args
+
+
+def get_labels_key(short_version):
+    """The form field of labels, Cromwell before 30 calls it customLabels.
+    """
+    return "labels" if short_version >= 30 else "customLabels"
+
+
+def build_submit_files(wdl_file, j_args, dependencies=None, wdl_string=False,
+                       disable_caching=False, extra_options=None, custom_labels=None,
+                       labels_key='labels', read_dependencies=None):
+    """Build the multipart files of a submission, shared by Cromwell and AsyncCromwell.
+
+    :param j_args: the json string of inputs.
+    :param labels_key: see get_labels_key.
+    :param read_dependencies: a function to read the dependencies zip file. Optional.
+    :return: a dict of field name to (filename, content, content type).
+    """
+    if not wdl_string:
+        with open(wdl_file, 'rb') as fh:
+            files = {'wdlSource': (wdl_file, fh.read(), 'application/octet-stream'),
+                     'workflowInputs': ('report.csv', j_args, 'application/json')}
+    else:
+        files = {'wdlSource': ('workflow.wdl', wdl_file, 'application/text-plain'),
+                 'workflowInputs': ('report.csv', j_args, 'application/json')}
+    if custom_labels:
+        files[labels_key] = ('labels.json', json.dumps(
+            custom_labels), 'application/json')
+    if dependencies:
+        # add dependency as zip file
+        if read_dependencies is None:
+            with open(dependencies, 'rb') as fh:
+                content = fh.read()
+        else:
+            content = read_dependencies(dependencies)
+        files['wdlDependencies'] = (dependencies, content, 'application/zip')
+    workflow_options = {}
+    if disable_caching:
+        workflow_options.update({"read_from_cache": False})
+    if extra_options:
+        workflow_options.update(extra_options)
+    if disable_caching or extra_options:
+        files['workflowOptions'] = ('options.json', json.dumps(
+            workflow_options), 'application/json')
+        print('Enabling the following additional workflow options:')
+        for k, v in workflow_options.items():
+            print("{}:{}".format(k, v))
+    return files
+
+
+def _version_cache_path():
+    return os.path.join(global_config.get_cache_dir(), VERSION_CACHE_FILE)
+
+
+def get_cached_version(host, port):
+    """Get the cromwell version of host:port from the in-process cache or
+    the cache file in cache_dir, return None when missing or expired.
+    """
+    key = '%s:%s' % (host, port)
+    with _version_lock:
+        if key not in _version_cache:
+            try:
+                with open(_version_cache_path(), 'r') as f:
+                    _version_cache.update(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+
+        version, probed_at = _version_cache.get(key, (None, 0))
+        if time.time() - probed_at > VERSION_CACHE_TTL:
+            return None
+        return version
+
+
+def set_cached_version(host, port, version):
+    key = '%s:%s' % (host, port)
+    with _version_lock:
+        _version_cache[key] = (version, time.time())
+        try:
+            cache_path = _version_cache_path()
+            tmp_path = '%s.%s' % (cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(_version_cache, f)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError) as err:
+            module_logger.debug('Unable to save cromwell version cache: %s' % str(err))
+
+
+def get_cromwell(server='localhost'):
+    """Get the shared Cromwell instance for a server in choppy config.
+
+    All callers asking for the same server reuse one instance, so they also
+    share its connection pool.
+
+    :param server: localhost or the name of a remote_* section.
+    :return: A Cromwell instance.
+    """
+    with _cromwell_lock:
+        cromwell = _cromwell_instances.get(server)
+        if cromwell is None:
+            section_name = global_config.get_server_section(server)
+            host, port, auth = global_config.get_conn_info(server, section_name)
+            pool_info = global_config.get_pool_info(section_name)
+            metadata_cache_dir = global_config.get_cache_dir(
+                os.path.join('metadata', '%s_%s' % (host, port)))
+            cromwell = Cromwell(host=host, port=port, auth=auth,
+                                metadata_cache_dir=metadata_cache_dir, **pool_info)
+            _cromwell_instances[server] = cromwell
+        return cromwell
+
+
 def print_log_exit(msg, sys_exit=True, ple_logger=module_logger):
     """Function for standard print/log/exit routine for fatal errors.
 
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.core.journal
+    ~~~~~~~~~~~~~~~~~~~
+
+    Module to record the submission of batch tasks.
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionJournal:
+    """An append-only JSON lines journal in the project directory.
+
+    Every outcome of a sample (render, zip, submit) is appended and flushed
+    to disk as it happens, so an interrupted batch can be resumed without
+    submitting a sample twice.
+
+    Example usage:
+        journal = SubmissionJournal('/path/to/project')
+        journal.record('sample1', 'submit', 'success', workflow_id='...')
+        journal.is_submitted('sample1')  # True
+    """
+    filename = 'journal.jsonl'
+
+    def __init__(self, project_path):
+        self.path = os.path.join(project_path, self.filename)
+        self.lock = threading.Lock()
+        # The last record of every sample.
+        self.records = {}
+        # The successful submit record of every sample, a later record
+        # (e.g. a failed label) doesn't make a submitted sample unsubmitted.
+        self.submissions = {}
+        self._load()
+
+    @staticmethod
+    def _is_submission(record):
+        return record.get('stage') == 'submit' and record.get('status') == 'success'
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be truncated by a crash.
+                    logger.debug('Skip a broken line in %s: %s' % (self.path, line))
+                    continue
+                self.records[record.get('sample_id')] = record
+                if self._is_submission(record):
+                    self.submissions[record.get('sample_id')] = record
+
+    def record(self, sample_id, stage, status, **extra):
+        """Append a record and flush it to disk.
+
+        :param sample_id: the sample id, None for a record of the whole batch.
+        :param stage: render, zip, submit or label.
+        :param status: success or failed.
+        """
+        record = {
+            "sample_id": sample_id,
+            "stage": stage,
+            "status": status,
+            "time": time.time()
+        }
+        record.update(extra)
+
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.records[sample_id] = record
+            if self._is_submission(record):
+                self.submissions[sample_id] = record
+        return record
+
+    def get(self, sample_id):
+        return self.records.get(sample_id)
+
+    def get_submission(self, sample_id):
+        return self.submissions.get(sample_id)
+
+    def is_submitted(self, sample_id):
+        return sample_id in self.submissions
@@ -56,12 +56,16 @@ def parse_error(err):
 
 
 def check_json(json_file=None, string=''):
+    """Exit with the position of the syntax error when the json is invalid.
+
+    :return: the parsed json.
+    """
     try:
         if json_file:
             with open(json_file) as f:
-                json.load(f)
+                return json.load(f)
         else:
-            json.loads(string)
+            return json.loads(string)
     except JSONDecodeError as error:
         if json_file:
             logger.error("Invalid JSON: %s" % json_file)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.core.metadata_cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module to cache the metadata of workflows.
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from choppy.config import ChoppyConfig
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """A thread-safe LRU cache of workflow metadata, bounded by entry count
+    and bytes.
+
+    The metadata of a terminal workflow never changes, so it is cached
+    without expiration and saved to cache_dir when specified. The metadata
+    of a running workflow expires after running_ttl seconds.
+
+    The files in cache_dir older than max_disk_age seconds are removed, then
+    the oldest files until they take at most max_disk_bytes. It's done once
+    per instance, before the first file is saved.
+
+    Example usage:
+        cache = MetadataCache(max_entries=100, cache_dir='~/.choppy/cache/metadata')
+        cache.set(workflow_id, metadata)
+        cache.get(workflow_id)
+    """
+
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024,
+                 running_ttl=15, cache_dir=None, max_disk_bytes=1024 * 1024 * 1024,
+                 max_disk_age=30 * 24 * 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.running_ttl = running_ttl
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_disk_age = max_disk_age
+        self._pruned = False
+        # workflow_id -> (metadata, size, cached_at, is_terminal)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def _disk_path(self, workflow_id):
+        return os.path.join(self.cache_dir, '%s.json' % workflow_id)
+
+    def get(self, workflow_id, ttl=None):
+        """Get the metadata of a workflow, return None when missing or expired.
+
+        :param ttl: overwrite running_ttl for a running workflow.
+        """
+        with self.lock:
+            entry = self.entries.get(workflow_id)
+            if entry:
+                metadata, size, cached_at, is_terminal = entry
+                ttl = self.running_ttl if ttl is None else ttl
+                if is_terminal or time.time() - cached_at < ttl:
+                    self.entries.move_to_end(workflow_id)
+                    return metadata
+                self._remove(workflow_id)
+
+        if self.cache_dir and os.path.isfile(self._disk_path(workflow_id)):
+            try:
+                with open(self._disk_path(workflow_id), 'r') as f:
+                    metadata = json.load(f)
+                self.set(workflow_id, metadata, save=False)
+                return metadata
+            except (IOError, OSError, ValueError) as err:
+                logger.debug('Unable to load cached metadata of %s: %s' % (workflow_id, str(err)))
+
+        return None
+
+    def set(self, workflow_id, metadata, save=True):
+        content = json.dumps(metadata)
+        size = len(content)
+        is_terminal = metadata.get('status') in ChoppyConfig.terminal_states
+
+        with self.lock:
+            self._remove(workflow_id)
+            if size <= self.max_bytes:
+                self.entries[workflow_id] = (metadata, size, time.time(), is_terminal)
+                self.total_bytes += size
+            self._evict()
+
+        if save and is_terminal and self.cache_dir:
+            self._save(workflow_id, content)
+
+    def _save(self, workflow_id, content):
+        if not self._pruned:
+            self._pruned = True
+            self.prune_disk()
+
+        filepath = self._disk_path(workflow_id)
+        tmp_filepath = '%s.%s.%s' % (filepath, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_filepath, 'w') as f:
+                f.write(content)
+            os.rename(tmp_filepath, filepath)
+        except (IOError, OSError) as err:
+            logger.debug('Unable to save metadata of %s: %s' % (workflow_id, str(err)))
+
+    def prune_disk(self):
+        """Remove the expired files in cache_dir, then the oldest files
+        until they take at most max_disk_bytes.
+        """
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return
+
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filepath))
+
+        # The oldest files are removed first.
+        files.sort()
+        expired_time = time.time() - self.max_disk_age
+        total_bytes = sum(size for _, size, _ in files)
+        for mtime, size, filepath in files:
+            if mtime >= expired_time and total_bytes <= self.max_disk_bytes:
+                break
+
+            try:
+                os.remove(filepath)
+                total_bytes -= size
+            except OSError as err:
+                logger.debug('Unable to remove cached metadata %s: %s' % (filepath, str(err)))
+
+    def _remove(self, workflow_id):
+        entry = self.entries.pop(workflow_id, None)
+        if entry:
+            self.total_bytes -= entry[1]
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, (_, size, _, _) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
@@ -35,6 +35,9 @@ class Workflow(Base):
 
     @staticmethod
     def parse_time(dt_str):
+        if not dt_str:
+            return None
+
         if dt_str.endswith("Z"):
             dt_str = dt_str[:-1]
 
@@ -55,8 +58,23 @@ class Workflow(Base):
 
         return None
 
-    def __init__(self, cromwell, w_id):
-        metadata = cromwell.query_metadata(w_id)
+    @classmethod
+    def from_query_result(cls, result):
+        """Build a workflow from a result of cromwell /query, which needs
+        additionalQueryResultFields=labels to get the owner of the workflow.
+        """
+        metadata = {
+            "id": result["id"],
+            "workflowName": result.get("name"),
+            "status": result["status"],
+            "start": result.get("start"),
+            "labels": result.get("labels", {})
+        }
+        return cls(metadata=metadata)
+
+    def __init__(self, cromwell=None, w_id=None, metadata=None):
+        if metadata is None:
+            metadata = cromwell.query_metadata(w_id)
         self.id = metadata["id"]
         self.name = self.get_or_none("workflowName", metadata)
         self.status = metadata["status"]
@@ -74,14 +92,22 @@ class Workflow(Base):
         self.notified = True
 
 
-# Create an engine that stores data in the local directory's
-# sqlalchemy_example.db file.
-if global_config:
-    engine = create_engine('sqlite:///' + global_config.get_path('general', 'workflow_db'))
+_engines = {}
+
+
+def get_engine(db_path=None):
+    """Create the engine of the workflow database on first use, the tables
+    are created at the same time.
+
+    :param db_path: the sqlite file, general.workflow_db in choppy config by default.
+    """
+    if db_path is None:
+        db_path = global_config.get_path('general', 'workflow_db')
 
-    # Create all tables in the engine. This is equivalent to "Create Table"
-    # statements in raw SQL.
-    Base.metadata.create_all(engine)
-else:
-    logger.warning('To access `g.config`, '
-                   'you need to call `get_global_config` firstly.')
+    engine = _engines.get(db_path)
+    if engine is None:
+        engine = _engines[db_path] = create_engine('sqlite:///' + db_path)
+        # Create all tables in the engine. This is equivalent to "Create Table"
+        # statements in raw SQL.
+        Base.metadata.create_all(engine)
+    return engine
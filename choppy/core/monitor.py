@@ -16,14 +16,14 @@ import json
 import os
 from dateutil.parser import parse
 from choppy.config import get_global_config
-from choppy.core.cromwell import Cromwell
+from choppy.core.cromwell import get_cromwell
 from choppy.notification import Messenger, EmailNotification
 from email.mime.text import MIMEText
 import pytz
-import threading
 import datetime
-from choppy.core.models import Workflow, Base
-from sqlalchemy import create_engine
+from choppy.core.models import Workflow, Base, get_engine
+from choppy.core.scheduler import PollScheduler
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import sessionmaker
 
 import traceback
@@ -33,6 +33,12 @@ __author__ = "Amr Abouelleil"
 
 module_logger = logging.getLogger(__name__)
 
+# The metadata keys used by notifications, such as EmailNotification.
+NOTIFICATION_METADATA_KEYS = ['id', 'status', 'start', 'end', 'failures',
+                              'workflowName', 'workflowRoot', 'labels',
+                              'calls', 'executionStatus', 'shardIndex',
+                              'stdout', 'stderr']
+
 
 def is_user_workflow(host, user, workflow_id):
     """A top-level function that returns a workflow if it matches the user workflow. This can't be an instance method of Monitor because we run into serializing issues otherwise. See: https://stackoverflow.com/questions/26249442/can-i-use-multiprocessing-pool-in-a-method-of-a-class
@@ -42,10 +48,7 @@ def is_user_workflow(host, user, workflow_id):
     :param workflow_id: workflow
     :return:  The workflow_id if it's the user owns the workflow. Otherwise None.
     """
-    section_name = 'remote_%s' % host if host != 'localhost' else 'local'
-    host, port, auth = global_config.get_conn_info(host, section_name)
-    metadata = Cromwell(host=host, port=port,
-                        auth=auth).query_metadata(workflow_id)
+    metadata = get_cromwell(host).query_metadata(workflow_id)
 
     try:
         j_input = json.loads(metadata['submittedFiles']['inputs'])
@@ -68,8 +71,7 @@ class Monitor:
         self.host, self.port, self.auth = global_config.get_conn_info(host, section_name)
         self.user = user
         self.interval = interval
-        self.cromwell = Cromwell(
-            host=self.host, port=self.port, auth=self.auth)
+        self.cromwell = get_cromwell(host)
         self.messenger = Messenger(self.user)
         self.no_notify = no_notify
         self.verbose = verbose
@@ -77,7 +79,7 @@ class Monitor:
         if user == "*":
             self.event_subscribers = [EmailNotification(self.cromwell), ]
 
-            engine = create_engine("sqlite:///" + global_config.get_path('general', 'workflow_db'))
+            engine = get_engine()
             Base.metadata.bind = engine
             DBSession = sessionmaker()
             DBSession.bind = engine
@@ -92,13 +94,12 @@ class Monitor:
             print('Determining {}\'s workflows...'.format(self.user))
 
         user_workflows = []
-        results = None
         if self.user == "*":
-            results = self.cromwell.query_labels(
-                {}, start_time=start_time, running_jobs=True)
+            results = self.cromwell.query_many(since=start_time, statuses=['Running'])
         else:
-            results = self.cromwell.query_labels(
-                {'username': self.user}, start_time=start_time)
+            results = self.cromwell.query_many(labels={'username': self.user},
+                                               since=start_time)
+        results = {'results': list(results)}
 
         if raw:
             return results
@@ -112,10 +113,14 @@ class Monitor:
             print('No user workflows found with username {}.'.format(self.user))
         return user_workflows
 
-    def process_events(self, workflow):
+    def process_events(self, workflow, metadata=None):
+        """Notify all subscribers, they share one metadata fetch.
+        """
+        if metadata is None:
+            # get final metadata
+            metadata = self.cromwell.query_metadata(workflow.id,
+                                                    include_keys=NOTIFICATION_METADATA_KEYS)
         for event_subscriber in self.event_subscribers:
-            metadata = self.cromwell.query_metadata(
-                workflow.id)  # get final metadata
             try:
                 event_subscriber.on_changed_workflow_status(
                     workflow, metadata, self.host, self.port)
@@ -124,25 +129,61 @@ class Monitor:
                 traceback.print_exc()
                 print("Event processing error occurred above.")
 
+    def poll_workflows(self, db_workflows):
+        """Query the workflows submitted after the high-water mark and the
+        status of the running workflows in database.
+
+        :param db_workflows: a dict of workflows in database.
+        :return: (new workflows, workflows whose status is changed)
+        """
+        # Overlap a little with the last query to tolerate clock skew,
+        # duplicated workflows are filtered by database.
+        query_time = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        submitted = list(self.cromwell.query_many(since=self.high_water_mark,
+                                                  additional_fields=['labels']))
+        self.high_water_mark = query_time
+
+        cromwell_workflows = dict((c["id"], c) for c in submitted)
+        running_ids = [w.id for w in db_workflows.values()
+                       if w.status in global_config.run_states and w.id not in cromwell_workflows]
+        if running_ids:
+            running = self.cromwell.query_many(ids=running_ids)
+            cromwell_workflows.update(dict((c["id"], c) for c in running))
+
+        new_workflows = [Workflow.from_query_result(c) for c in cromwell_workflows.values()
+                         if c["id"] not in db_workflows]
+        changed_workflows = [w for w in db_workflows.values()
+                             if w.id in cromwell_workflows and w.status != cromwell_workflows[w.id]["status"]]
+        for w in changed_workflows:
+            w.update_status(cromwell_workflows[w.id]["status"])
+
+        return new_workflows, changed_workflows
+
     def run(self):
+        one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=int(1))
+        self.high_water_mark = one_day_ago
         while True:
             try:
-                one_day_ago = datetime.datetime.now() - datetime.timedelta(days=int(1))
+                # Pick up the changes of config file (e.g. email) without a restart.
+                global_config.reload_if_changed()
+                one_day_ago = datetime.datetime.utcnow() - datetime.timedelta(days=int(1))
+                # The submitted workflows have not started yet, those aborted
+                # before starting are finished and never change again.
                 db_workflows = dict((d.id, d) for d in self.session.query(
-                    Workflow).filter(Workflow.start > one_day_ago))
-                cromwell_workflows = dict((c["id"], c) for c in self.get_user_workflows(
-                    raw=True, start_time=get_iso_datestr(one_day_ago), silent=True)['results'])
-
-                new_workflows = map(lambda c: Workflow(self.cromwell, c["id"]), filter(
-                    lambda w: w["id"] not in db_workflows, cromwell_workflows.values()))
+                    Workflow).filter(or_(Workflow.start > one_day_ago,
+                                         and_(Workflow.start.is_(None),
+                                              Workflow.status.notin_(global_config.terminal_states)))))
+                new_workflows, changed_workflows = self.poll_workflows(db_workflows)
+                # The overlapped query may return the finished workflows left out above.
+                if new_workflows:
+                    known_ids = set(i for (i,) in self.session.query(Workflow.id).filter(
+                        Workflow.id.in_([w.id for w in new_workflows])))
+                    new_workflows = [w for w in new_workflows if w.id not in known_ids]
                 [self.session.add(w) for w in new_workflows]
 
-                changed_workflows = filter(lambda d: d.id in cromwell_workflows and d.status !=  # noqa
-                                           cromwell_workflows[d.id]["status"], db_workflows.values())
-                [w.update_status(cromwell_workflows[w.id]["status"])
-                 for w in changed_workflows]
-
-                workflows_to_notify = new_workflows + changed_workflows
+                # Only fetch the metadata once when a workflow reached terminal state.
+                workflows_to_notify = [w for w in new_workflows + changed_workflows
+                                       if w.status in global_config.terminal_states]
                 [self.process_events(w) for w in workflows_to_notify]
 
                 self.session.flush()
@@ -155,6 +196,8 @@ class Monitor:
     def monitor_user_workflows(self):
         """A function for monitoring a several workflows.
 
+        All workflows are polled in batches by a single scheduler thread.
+
         :return:
         """
         print('Monitoring {}\'s workflows.'.format(self.user))
@@ -162,10 +205,21 @@ class Monitor:
         if len(workflows) == 0:
             print("User {} has no running workflows.".format(self.user))
         else:
-            for workflow in workflows:
-                t = threading.Thread(
-                    target=self.monitor_workflow, args=[workflow])
-                t.start()
+            scheduler = PollScheduler(self.cromwell, on_terminal=self.on_terminal,
+                                      on_status=self.on_status,
+                                      min_interval=self.interval,
+                                      max_interval=max(self.interval * 20, 600))
+            scheduler.add_many(workflows)
+            scheduler.run()
+
+    def on_status(self, query_status):
+        if self.verbose:
+            print('Workflow {} | {}'.format(
+                query_status['id'], query_status['status']))
+
+    def on_terminal(self, query_status):
+        if not self.no_notify:
+            self.notify_workflow(query_status)
 
     def monitor_workflow(self, workflow_id):
         """Monitor the status of a single workflow.
@@ -176,60 +230,63 @@ class Monitor:
 
         while 0 == 0:
             query_status = self.cromwell.query_status(workflow_id)
-            if self.verbose:
-                print('Workflow {} | {}'.format(
-                    query_status['id'], query_status['status']))
+            self.on_status(query_status)
             if query_status['status'] not in global_config.run_states:
-                if not self.no_notify:
-                    filename = '{}.metadata.json'.format(query_status['id'])
-                    log_dir = global_config.get_path('general', 'log_dir')
-                    filepath = os.path.join(log_dir, '{}.metadata.json'.format(query_status['id']))
-                    metadata = open(filepath, 'w+')
-                    json.dump(self.cromwell.query_metadata(
-                        workflow_id), indent=4, fp=metadata)
-                    metadata.close()
-                    email_content = self.generate_content(
-                        query_status=query_status, workflow_id=workflow_id)
-                    msg = self.messenger.compose_email(email_content)
-
-                    file_dict = {filename: filepath}
-                    if 'Failed' in query_status['status']:
-                        jdata = self.cromwell.query_metadata(workflow_id)
-                        for task, call in jdata['calls'].items():
-                            for shard in call:
-                                if 'Failed' in shard['executionStatus']:
-                                    attach_prefix = "{}.{}".format(
-                                        task, shard['shardIndex'])
-                                    stdout = "{}.stdout".format(attach_prefix)
-                                    stderr = "{}.stderr".format(attach_prefix)
-                                    try:
-                                        file_dict[stdout] = shard['stdout']
-                                    except Exception as e:
-                                        logging.warn(str(e))
-                                    try:
-                                        file_dict[stderr] = shard['stderr']
-                                    except Exception as e:
-                                        logging.warn(str(e))
-                                    break
-
-                    attachments = self.generate_attachments(file_dict)
-                    for attachment in attachments:
-                        if attachment:
-                            msg.attach(attachment)
-
-                    email_account = global_config.get('email', 'email_notification_account')
-                    email_domain = global_config.get('email', 'email_domain')
-                    if email_account:
-                        self.messenger.send_email(msg, "{}@{}".format(
-                            email_account, email_domain))
-                    else:
-                        self.messenger.send_email(msg)
-
-                    os.unlink(filepath)
+                self.on_terminal(query_status)
                 return 0
             else:
                 time.sleep(self.interval)
 
+    def notify_workflow(self, query_status):
+        """Send an email with the metadata (and the logs of the failed calls) of a finished workflow.
+
+        :param query_status: a dict contains the id and status of the workflow.
+        """
+        workflow_id = query_status['id']
+        metadata = self.cromwell.query_metadata_cached(workflow_id)
+        filename = '{}.metadata.json'.format(workflow_id)
+        log_dir = global_config.get_path('general', 'log_dir')
+        filepath = os.path.join(log_dir, filename)
+        with open(filepath, 'w+') as f:
+            json.dump(metadata, indent=4, fp=f)
+        email_content = self.generate_content(
+            query_status=query_status, workflow_id=workflow_id, metadata=metadata)
+        msg = self.messenger.compose_email(email_content)
+
+        file_dict = {filename: filepath}
+        if 'Failed' in query_status['status']:
+            for task, call in metadata['calls'].items():
+                for shard in call:
+                    if 'Failed' in shard['executionStatus']:
+                        attach_prefix = "{}.{}".format(
+                            task, shard['shardIndex'])
+                        stdout = "{}.stdout".format(attach_prefix)
+                        stderr = "{}.stderr".format(attach_prefix)
+                        try:
+                            file_dict[stdout] = shard['stdout']
+                        except Exception as e:
+                            logging.warn(str(e))
+                        try:
+                            file_dict[stderr] = shard['stderr']
+                        except Exception as e:
+                            logging.warn(str(e))
+                        break
+
+        attachments = self.generate_attachments(file_dict)
+        for attachment in attachments:
+            if attachment:
+                msg.attach(attachment)
+
+        email_account = global_config.get('email', 'email_notification_account')
+        email_domain = global_config.get('email', 'email_domain')
+        if email_account:
+            self.messenger.send_email(msg, "{}@{}".format(
+                email_account, email_domain))
+        else:
+            self.messenger.send_email(msg)
+
+        os.unlink(filepath)
+
     @staticmethod
     def generate_attachment(filename, filepath):
         """Create attachment from a file.
@@ -282,7 +339,7 @@ class Monitor:
         :param metadata: The metadata of the workflow (optional).
         :return: a dictionary containing the email contents for the template.
         """
-        jdata = self.cromwell.query_metadata(
+        jdata = self.cromwell.query_metadata_cached(
             workflow_id) if metadata is None else metadata
         summary = ""
         if 'start' in jdata:
@@ -11,29 +11,538 @@
 
 from __future__ import unicode_literals
 import os
+import re
 import sys
+import time
+import fnmatch
+import datetime
 import logging
+import selectors
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from choppy.config import get_global_config
-from subprocess import CalledProcessError, PIPE, Popen
+from subprocess import CalledProcessError, PIPE, STDOUT, Popen
+
+try:
+    import oss2
+except ImportError:
+    oss2 = None
 
 global_config = get_global_config()
 logger = logging.getLogger(__name__)
 
+LINE_SEP_PATTERN = re.compile(b'(\r\n|\r|\n)')
+PROGRESS_FIELD_PATTERN = re.compile(r'([A-Za-z][A-Za-z ]*?):\s*([^,]+?)(?=,|\.\s|$)')
+SIZE_PATTERN = re.compile(r'^([\d.]+)\s*([KMGTP]?B?)$', re.I)
+# The number of ossutil output lines kept to explain a failed link.
+ERROR_TAIL_LINES = 5
+SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2,
+              'G': 1024 ** 3, 'GB': 1024 ** 3, 'T': 1024 ** 4, 'TB': 1024 ** 4,
+              'P': 1024 ** 5, 'PB': 1024 ** 5}
+
 
 def run_copy_files(first_path, second_path, include=None, exclude=None,
-                   recursive=True, silent=False):
-    if isinstance(first_path, list):
-        for path in first_path:
-            logger.info('\nDownloading %s' % path)
-            oss_copy_func(path, second_path, include=include, exclude=exclude,
-                          recursive=recursive, silent=silent)
-    elif isinstance(first_path, str):
-        oss_copy_func(first_path, second_path, include=include, exclude=exclude,
-                      recursive=recursive, silent=silent)
+                   recursive=True, silent=False, jobs=1, retries=0,
+                   part_size=None, parallel=None, manifest=None):
+    """Copy one or several paths by ossutil.
+
+    :param: first_path: a source path or a list of source paths.
+    :param: jobs: the number of links copied concurrently.
+    :param: retries: the number of retries for a failed link.
+    :param: part_size: passed to ossutil --part-size.
+    :param: parallel: passed to ossutil --parallel.
+    :param: manifest: the file to record the failed links.
+    :return: the list of failed links.
+    """
+    if isinstance(first_path, str):
+        first_path = [first_path]
+
+    engine = TransferEngine(jobs=jobs, retries=retries, part_size=part_size,
+                            parallel=parallel, silent=silent, manifest=manifest)
+    return engine.run(first_path, second_path, include=include, exclude=exclude,
+                      recursive=recursive)
+
+
+class TransferEngine:
+    """Copy a list of links by a bounded pool of ossutil processes.
+
+    A failed link is retried with backoff, the links still failed at last
+    are written to a manifest file, which can be passed to
+    `choppy download -i` later. The last lines of ossutil output of a failed
+    link are logged and written to the manifest as comments, even when the
+    output isn't shown (silent or several jobs).
+
+    Example usage:
+        engine = TransferEngine(jobs=8, retries=2)
+        failed = engine.run(['oss://bucket/a', 'oss://bucket/b'], '/data')
+    """
+
+    def __init__(self, jobs=1, retries=0, part_size=None, parallel=None,
+                 silent=False, manifest=None, oss_bin=None, backoff_factor=1):
+        self.jobs = max(jobs, 1)
+        self.retries = retries
+        self.part_size = part_size
+        self.parallel = parallel
+        self.silent = silent
+        self.manifest = manifest
+        self.oss_bin = oss_bin
+        self.backoff_factor = backoff_factor
+        self.lock = threading.Lock()
+        # The transferred bytes of every link, reported by ossutil.
+        self.done_bytes = {}
+        # The last output lines of every failed link.
+        self.errors = {}
+
+    @property
+    def total_done_bytes(self):
+        with self.lock:
+            return sum(self.done_bytes.values())
+
+    def copy(self, link, dest, **kwargs):
+        def on_progress(event):
+            if event['done_bytes'] is not None:
+                with self.lock:
+                    self.done_bytes[link] = event['done_bytes']
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff_factor * (2 ** (attempt - 1))
+                logger.info('Retry %s in %ss (%s/%s)' % (link, delay, attempt, self.retries))
+                time.sleep(delay)
+            output = deque(maxlen=ERROR_TAIL_LINES)
+            returncode = oss_copy_func(link, dest, part_size=self.part_size,
+                                       parallel=self.parallel, oss_bin=self.oss_bin,
+                                       on_progress=on_progress, on_output=output.append,
+                                       **kwargs)
+            if returncode == 0:
+                with self.lock:
+                    self.errors.pop(link, None)
+                return True
+
+            with self.lock:
+                self.errors[link] = list(output)
+            logger.error('Failed to copy %s: %s' % (link, ' | '.join(output) or 'no output'))
+        return False
+
+    def run(self, links, dest, include=None, exclude=None, recursive=True):
+        """Copy all links to dest.
+
+        :return: the list of failed links.
+        """
+        total = len(links)
+        done = [0]
+        failed = []
+        start = time.time()
+        # Outputs of concurrent ossutil processes would interleave.
+        silent = self.silent or self.jobs > 1
+
+        def copy(link):
+            if total > 1:
+                logger.info('\nCopying %s' % link)
+            success = self.copy(link, dest, include=include, exclude=exclude,
+                                recursive=recursive, silent=silent)
+            done_bytes = self.total_done_bytes
+            with self.lock:
+                done[0] += 1
+                if not success:
+                    failed.append(link)
+                if total > 1:
+                    elapsed = max(time.time() - start, 1e-6)
+                    logger.info('[%s/%s] %s %s (%.2f links/s, %.2f MB/s, %s failed)' %
+                                (done[0], total, 'Finished' if success else 'Failed',
+                                 link, done[0] / elapsed, done_bytes / elapsed / 1024 ** 2,
+                                 len(failed)))
+
+        if self.jobs == 1 or total == 1:
+            for link in links:
+                copy(link)
+        else:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                list(executor.map(copy, links))
+
+        if failed:
+            self.write_manifest(failed)
+        return failed
+
+    def write_manifest(self, failed):
+        """Write the failed links one per line, each one follows the last
+        output lines of ossutil as # comments, which `choppy download -i` skips.
+        """
+        manifest = self.manifest
+        if not manifest:
+            log_dir = global_config.get_path('general', 'log_dir')
+            manifest = os.path.join(log_dir, 'oss_failed_%s.txt' % time.strftime('%Y%m%d%H%M%S'))
+
+        with open(manifest, 'w') as f:
+            for link in failed:
+                for line in self.errors.get(link, []):
+                    f.write('# %s\n' % line)
+                f.write(link + '\n')
+        logger.error('%s link(s) failed, they are saved in %s' % (len(failed), manifest))
+
+
+def pump_output(process, on_line, chunk_size=65536):
+    """Read the stdout of a process until it exits, without busy waiting.
+
+    The output is split by \\n and \\r (ossutil refreshes the progress by \\r).
+
+    :param process: a Popen object with stdout=PIPE.
+    :param on_line: called with (line, is_progress) for every line.
+    :return: the exit code of the process.
+    """
+    fd = process.stdout.fileno()
+    buf = b''
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            # Block until there is output, no CPU is used when idle.
+            selector.select()
+            chunk = os.read(fd, chunk_size)
+            if not chunk:
+                break
+            buf += chunk
+            lines = LINE_SEP_PATTERN.split(buf)
+            buf = lines.pop()
+            for line, sep in zip(lines[::2], lines[1::2]):
+                if line:
+                    on_line(line.decode('utf-8', 'replace'), sep == b'\r')
+
+    if buf:
+        on_line(buf.decode('utf-8', 'replace'), False)
+    process.stdout.close()
+    return process.wait()
+
+
+def parse_size(value):
+    """Convert a size string of ossutil (e.g. 1.5GB, 300B) to bytes.
+    """
+    matched = SIZE_PATTERN.match(value.strip())
+    if not matched:
+        return None
+    number, unit = matched.groups()
+    return int(float(number) * SIZE_UNITS.get(unit.upper(), 1))
+
+
+def parse_progress(line):
+    """Parse a progress line of ossutil cp.
+
+    e.g. Total num: 10, size: 1.00GB. Dealed num: 3, OK size: 300.00MB,
+    Progress: 30.000%, Speed: 10.00MB/s, Est: 1m10s
+
+    :param line: a line of ossutil output.
+    :return: a dict with total_bytes, done_bytes, percent, rate (bytes/s)
+             and eta, None when the line isn't a progress line.
+    """
+    fields = dict((key.strip().lower(), value.strip())
+                  for key, value in PROGRESS_FIELD_PATTERN.findall(line))
+    if 'progress' not in fields and 'ok size' not in fields:
+        return None
+
+    percent = fields.get('progress', '').rstrip('%')
+    rate = fields.get('speed', '')
+    return {
+        'total_bytes': parse_size(fields.get('size', '')),
+        'done_bytes': parse_size(fields.get('ok size', '')),
+        'percent': float(percent) if percent else None,
+        'rate': parse_size(rate[:-2]) if rate.endswith('/s') else None,
+        'eta': fields.get('est')
+    }
+
+
+def split_oss_link(link):
+    """Split oss://bucket/path/to/object to (bucket, path/to/object).
+    """
+    matched = re.match(r'^oss://([^/]+)/?(.*)$', link)
+    if not matched:
+        raise ValueError('Not a valid oss link: %s' % link)
+    return matched.groups()
+
+
+def get_oss2_bucket(bucket_name):
+    """Get an oss2.Bucket when oss2 is installed, otherwise None.
+    """
+    if oss2 is None:
+        return None
+    endpoint = global_config.get('oss', 'endpoint')
+    if not endpoint.startswith('http'):
+        endpoint = 'http://' + endpoint
+    auth = oss2.Auth(global_config.get('oss', 'access_key'),
+                     global_config.get('oss', 'access_secret'))
+    return oss2.Bucket(auth, endpoint, bucket_name)
+
+
+def build_oss_cmd(subcommand, args, oss_bin=None):
+    """Build an ossutil command with the credentials in choppy config.
+    """
+    oss_bin = oss_bin or get_oss_bin()
+    access_key = global_config.get('oss', 'access_key')
+    access_secret = global_config.get('oss', 'access_secret')
+    endpoint = global_config.get('oss', 'endpoint')
+    return [oss_bin, subcommand, "-i", access_key, "-k", access_secret,
+            "-e", endpoint] + list(args)
+
+
+def iter_remote_file(link, chunk_size=65536, oss_bin=None):
+    """Stream the content of an oss object (or a local file) chunk by chunk.
+
+    The object is read by oss2 when it's installed, otherwise by `ossutil cat`.
+    No temporary file is created, stop iterating to abort the transfer.
+
+    :param link: an oss link or a local path.
+    :return: A generator of bytes.
+    """
+    if not link.startswith('oss://'):
+        with open(link, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+        return
+
+    bucket_name, key = split_oss_link(link)
+    bucket = None if oss_bin else get_oss2_bucket(bucket_name)
+    if bucket is not None:
+        stream = bucket.get_object(key)
+        try:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                yield chunk
+        finally:
+            stream.close()
+        return
+
+    shell_cmd = build_oss_cmd('cat', [link], oss_bin=oss_bin)
+    logger.debug('Running Command: %s' % ' '.join(shell_cmd))
+    process = Popen(shell_cmd, stdout=PIPE, stderr=PIPE)
+    # Drain stderr aside, ossutil would block on a full stderr pipe otherwise.
+    errors = deque(maxlen=ERROR_TAIL_LINES)
+    reader = threading.Thread(target=errors.extend, args=(process.stderr,))
+    reader.daemon = True
+    reader.start()
+    try:
+        for chunk in iter(lambda: process.stdout.read1(chunk_size), b''):
+            yield chunk
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        reader.join()
+        process.stderr.close()
+        # A negative return code means the transfer is aborted by the caller.
+        returncode = process.wait()
+        if returncode > 0:
+            stderr = ' | '.join(line.decode('utf-8', 'replace').strip() for line in errors)
+            raise IOError('Unable to read %s (exit code %s): %s'
+                          % (link, returncode, stderr or 'no output'))
+
+
+def iter_remote_lines(link, oss_bin=None):
+    buf = b''
+    for chunk in iter_remote_file(link, oss_bin=oss_bin):
+        buf += chunk
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+    if buf:
+        yield buf.decode('utf-8', 'replace')
+
+
+def _tail_by_range(bucket, key, n, block_size=65536):
+    """Read the last n lines of an object by range requests from the end.
+    """
+    size = bucket.head_object(key).content_length
+    end = size
+    data = b''
+    while end > 0 and data.count(b'\n') <= n:
+        start = max(0, end - block_size)
+        data = bucket.get_object(key, byte_range=(start, end - 1)).read() + data
+        end = start
+    lines = data.decode('utf-8', 'replace').split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    return lines[-n:] if n > 0 else []
+
+
+def read_remote_lines(link, head=None, tail=None, oss_bin=None):
+    """Read the lines of an oss object (or a local file).
+
+    :param head: only read the first head lines, the transfer stops early.
+    :param tail: only read the last tail lines, by range requests when oss2 is installed.
+    :return: A generator of lines.
+    """
+    if head is not None:
+        for index, line in enumerate(iter_remote_lines(link, oss_bin=oss_bin)):
+            if index >= head:
+                break
+            yield line
+    elif tail is not None:
+        bucket = None
+        if link.startswith('oss://') and not oss_bin:
+            bucket_name, key = split_oss_link(link)
+            bucket = get_oss2_bucket(bucket_name)
+
+        if bucket is not None:
+            lines = _tail_by_range(bucket, key, tail)
+        else:
+            lines = deque(iter_remote_lines(link, oss_bin=oss_bin), maxlen=tail)
+        for line in lines:
+            yield line
+    else:
+        for line in iter_remote_lines(link, oss_bin=oss_bin):
+            yield line
+
+
+def read_remote_file(link, oss_bin=None):
+    """Read the whole content of an oss object (or a local file) as text.
+    """
+    return b''.join(iter_remote_file(link, oss_bin=oss_bin)).decode('utf-8', 'replace')
+
+
+def read_remote_files(links, jobs=8, oss_bin=None):
+    """Read several small objects concurrently.
+
+    :return: a dict of link and content, the content is None when the read failed.
+    """
+    def read(link):
+        try:
+            return link, read_remote_file(link, oss_bin=oss_bin)
+        except (IOError, OSError, ValueError) as err:
+            logger.warning('Unable to read %s: %s' % (link, str(err)))
+            return link, None
+
+    with ThreadPoolExecutor(max_workers=max(min(jobs, len(links)), 1)) as executor:
+        return dict(executor.map(read, links))
+
+
+OssEntry = namedtuple('OssEntry', ['link', 'size', 'last_modified', 'is_dir'])
+
+# e.g. 2019-05-09 15:39:56 +0800 CST        133  Standard  E2B..  oss://bucket/a.txt
+LS_LONG_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) [+-]\d{4} \S+\s+'
+                             r'(\d+)\s+\S+\s+\S+\s+(oss://.+)$')
+
+
+def iter_oss_objects(oss_link, recursive=True, oss_bin=None):
+    """List the objects under an oss link lazily.
+
+    Pages through the bucket by markers with oss2 when it's installed,
+    otherwise parses the output of `ossutil ls` line by line.
+
+    :param oss_link: an oss link, e.g. oss://bucket/prefix
+    :param recursive: list all objects, or only the objects and directories
+                      directly under the prefix.
+    :return: A generator of OssEntry, the size and last_modified of a
+             directory (or any entry listed by ossutil non-recursively) are None.
+    """
+    bucket_name, prefix = split_oss_link(oss_link)
+    bucket = None if oss_bin else get_oss2_bucket(bucket_name)
+    if bucket is not None:
+        delimiter = '' if recursive else '/'
+        try:
+            for obj in oss2.ObjectIterator(bucket, prefix=prefix, delimiter=delimiter,
+                                           max_keys=1000):
+                link = 'oss://%s/%s' % (bucket_name, obj.key)
+                if obj.is_prefix():
+                    yield OssEntry(link, None, None, True)
+                else:
+                    yield OssEntry(link, obj.size,
+                                   datetime.datetime.fromtimestamp(obj.last_modified), False)
+        except oss2.exceptions.OssError as err:
+            # e.g. NoSuchBucket or AccessDenied, raised like the failures of ossutil.
+            raise IOError('Unable to list %s, %s: %s' % (oss_link, err.code, err.message))
+        return
+
+    args = [oss_link] if recursive else [oss_link, '-d']
+    shell_cmd = build_oss_cmd('ls', args, oss_bin=oss_bin)
+    logger.debug('Running Command: %s' % ' '.join(shell_cmd))
+    process = Popen(shell_cmd, stdout=PIPE)
+    try:
+        for line in process.stdout:
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            matched = LS_LONG_PATTERN.match(line)
+            if matched:
+                mtime, size, link = matched.groups()
+                yield OssEntry(link, int(size),
+                               datetime.datetime.strptime(mtime, '%Y-%m-%d %H:%M:%S'), False)
+            elif line.startswith('oss://'):
+                yield OssEntry(line, None, None, line.endswith('/'))
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        if process.wait() > 0:
+            raise IOError('Unable to list %s, ossutil exited with code %s.' %
+                          (oss_link, process.returncode))
+
+
+def filter_oss_objects(entries, include=None, exclude=None, min_size=None, max_size=None):
+    """Filter the entries by the glob patterns of their names and their sizes.
+    """
+    for entry in entries:
+        name = os.path.basename(entry.link.rstrip('/'))
+        if include and not fnmatch.fnmatch(name, include):
+            continue
+        if exclude and fnmatch.fnmatch(name, exclude):
+            continue
+        if min_size is not None and (entry.size is None or entry.size < min_size):
+            continue
+        if max_size is not None and (entry.size is None or entry.size > max_size):
+            continue
+        yield entry
+
+
+class ListingSummary:
+    """Count the objects and the bytes of a listing in one streaming pass.
+
+    Example usage:
+        summary = ListingSummary()
+        for entry in summary.watch(iter_oss_objects('oss://bucket/prefix')):
+            print(entry.link)
+        print(summary.report())
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_bytes = 0
+        self.dirs = 0
+        # extension -> [count, bytes]
+        self.extensions = {}
+
+    def add(self, entry):
+        if entry.is_dir:
+            self.dirs += 1
+            return
+        size = entry.size or 0
+        self.count += 1
+        self.total_bytes += size
+        ext = os.path.splitext(entry.link)[1].lower() or '<none>'
+        stat = self.extensions.setdefault(ext, [0, 0])
+        stat[0] += 1
+        stat[1] += size
+
+    def watch(self, entries):
+        for entry in entries:
+            self.add(entry)
+            yield entry
+
+    def report(self):
+        lines = ['Objects: %s, Directories: %s, Total size: %s bytes' %
+                 (self.count, self.dirs, self.total_bytes)]
+        for ext, (count, size) in sorted(self.extensions.items(),
+                                         key=lambda item: -item[1][1]):
+            lines.append('%s\t%s objects\t%s bytes' % (ext, count, size))
+        return '\n'.join(lines)
+
+
+def get_oss_bin():
+    oss_bin = global_config.get('oss', 'oss_bin')
+    if not oss_bin:
+        oss_bin_name = 'ossutil64' if os.uname().sysname == 'Linux' else 'ossutilmac64'
+        oss_bin = os.path.join(global_config.resource_dir, 'lib', oss_bin_name)
+    return oss_bin
 
 
 def oss_copy_func(first_path, second_path, include=None, exclude=None,
-                  recursive=True, silent=False):
+                  recursive=True, silent=False, part_size=None, parallel=None,
+                  oss_bin=None, on_progress=None, on_output=None):
     """Call ossutil and copy files from one place to anothers.
 
     :param: first_path: source path.
@@ -48,23 +557,24 @@ def oss_copy_func(first_path, second_path, include=None, exclude=None,
     :type: recursive: bool
     :param: silent: no any exception and warning, just let it go.
     :type: silent: bool
-    :return:
+    :param: part_size: the part size in bytes of a multipart transfer.
+    :type: part_size: int
+    :param: parallel: the number of parts transferred concurrently.
+    :type: parallel: int
+    :param: on_progress: called with every progress event, see parse_progress.
+    :type: on_progress: function
+    :param: on_output: called with every output line except progress lines, even when silent.
+    :type: on_output: function
+    :return: the exit code of ossutil.
     """
     log_dir = global_config.get_path('general', 'log_dir')
     output_dir = os.path.join(log_dir, 'oss_outputs')
     checkpoint_dir = os.path.join(log_dir, 'oss_checkpoint')
 
     try:
-        oss_bin = global_config.get('oss', 'oss_bin')
-        if not oss_bin:
-            oss_bin_name = 'ossutil64' if os.uname().sysname == 'Linux' else 'ossutilmac64'
-            oss_bin = os.path.join(global_config.resource_dir, 'lib', oss_bin_name)
-        access_key = global_config.get('oss', 'access_key')
-        access_secret = global_config.get('oss', 'access_secret')
-        endpoint = global_config.get('oss', 'endpoint')
-        shell_cmd = [oss_bin, "cp", "-u", "-i", access_key, "-k", access_secret,
-                     "--output-dir=%s" % output_dir, "--checkpoint-dir=%s" % checkpoint_dir,
-                     "-e", endpoint]
+        shell_cmd = build_oss_cmd("cp", ["-u", "--output-dir=%s" % output_dir,
+                                         "--checkpoint-dir=%s" % checkpoint_dir],
+                                  oss_bin=oss_bin)
         if include:
             shell_cmd.extend(["--include", include])
 
@@ -74,18 +584,33 @@ def oss_copy_func(first_path, second_path, include=None, exclude=None,
         if recursive:
             shell_cmd.extend(["-r"])
 
+        if part_size:
+            shell_cmd.extend(["--part-size", str(part_size)])
+
+        if parallel:
+            shell_cmd.extend(["--parallel", str(parallel)])
+
         shell_cmd.extend([first_path, second_path])
 
         logger.debug('Running Command: %s' % ' '.join(shell_cmd))
-        process = Popen(shell_cmd, stdout=PIPE)
-        while process.poll() is None:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output and not silent:
-                print(output.strip().decode())
+        process = Popen(shell_cmd, stdout=PIPE, stderr=STDOUT)
+
+        def on_line(line, is_progress):
+            event = parse_progress(line)
+            if event and on_progress:
+                on_progress(event)
+            if on_output and not is_progress:
+                on_output(line)
+            if not silent:
+                # Progress lines overwrite each other like in a terminal.
+                sys.stdout.write(line + ('\r' if is_progress else '\n'))
                 sys.stdout.flush()
-            process.poll()
-    except CalledProcessError as e:
+
+        returncode = pump_output(process, on_line)
+        if returncode != 0:
+            logger.error('ossutil exited with code %s when copying %s' % (returncode, first_path))
+        return returncode
+    except (CalledProcessError, OSError) as e:
         logger.critical(e)
         logger.critical("access_key/access_secret or oss_link is not valid.")
+        return 1
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.core.path_checker
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Module to check whether many (local or remote) paths exist.
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import os
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def get_scheme(path):
+    """Get the scheme of a path, '' for a local path.
+    """
+    return path.split('://', 1)[0] if '://' in path else ''
+
+
+class OssBackend:
+    """Check oss:// links in bulk: the parent directory of the links is listed
+    once (non-recursively) instead of a request per link.
+    """
+
+    def __init__(self, oss_bin=None):
+        self.oss_bin = oss_bin
+
+    def list_directory(self, directory):
+        from choppy.core.oss import iter_oss_objects
+
+        try:
+            return set(entry.link.rstrip('/') for entry in
+                       iter_oss_objects(directory, recursive=False, oss_bin=self.oss_bin))
+        except Exception as err:
+            logger.warning('Unable to list %s: %s' % (directory, str(err)))
+            return set()
+
+    def exists_many(self, paths, executor):
+        """
+        :param paths: a list of oss links.
+        :param executor: a thread pool to list the directories.
+        :return: a dict of link to boolean.
+        """
+        # Import it in the calling thread, choppy config is thread local.
+        import choppy.core.oss  # noqa
+
+        groups = defaultdict(list)
+        for path in paths:
+            groups[path.rstrip('/').rsplit('/', 1)[0] + '/'].append(path)
+
+        directories = list(groups.keys())
+        results = {}
+        for directory, links in zip(directories, executor.map(self.list_directory, directories)):
+            for path in groups[directory]:
+                results[path] = path.rstrip('/') in links
+        return results
+
+
+class PathChecker:
+    """Check whether paths exist, concurrently and only once per path.
+
+    Local paths are stat'ed in a pool of `jobs` threads, which hides the
+    latency of NFS or fuse mounts. A path with a scheme (e.g. oss://) is
+    checked by the backend registered for the scheme, in bulk. A path whose
+    scheme has no backend doesn't exist.
+
+    Example usage:
+        checker = PathChecker(jobs=16)
+        checker.check_many(['/data/a.bam', 'oss://bucket/b.bam'])
+        checker.exists('/data/a.bam')  # Cached.
+    """
+
+    def __init__(self, jobs=16, backends=None):
+        self.jobs = jobs
+        self.backends = {'oss': OssBackend()}
+        self.backends.update(backends or {})
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def register_backend(self, scheme, backend):
+        """
+        :param backend: an object with exists_many(paths, executor) -> dict.
+        """
+        self.backends[scheme] = backend
+
+    def check_many(self, paths):
+        """Check all paths which aren't cached yet.
+
+        :return: a dict of path to boolean for all paths.
+        """
+        paths = [path.rstrip() for path in paths]
+        with self.lock:
+            missing = set(path for path in paths if path not in self.cache)
+
+        if missing:
+            groups = defaultdict(list)
+            for path in missing:
+                groups[get_scheme(path)].append(path)
+
+            results = {}
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                for scheme, group in groups.items():
+                    if scheme == '':
+                        results.update(zip(group, executor.map(os.path.exists, group)))
+                    elif scheme in self.backends:
+                        results.update(self.backends[scheme].exists_many(group, executor))
+                    else:
+                        logger.warning('Unable to check %s paths with %s://.' % (len(group), scheme))
+                        results.update((path, False) for path in group)
+
+            with self.lock:
+                self.cache.update(results)
+
+        return dict((path, self.cache[path]) for path in paths)
+
+    def exists(self, path):
+        path = path.rstrip()
+        if path not in self.cache:
+            self.check_many([path])
+        return self.cache[path]
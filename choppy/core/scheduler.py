@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.core.scheduler
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Module to poll the status of many workflows from a single thread.
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import time
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from choppy.config import get_global_config
+
+logger = logging.getLogger(__name__)
+global_config = get_global_config()
+
+
+class WorkflowState:
+    def __init__(self, workflow_id, interval, now):
+        self.workflow_id = workflow_id
+        self.status = None
+        self.interval = interval
+        self.first_seen = now
+        self.misses = 0
+
+
+class PollScheduler:
+    """Poll the status of workflows in batches through the query endpoint.
+
+    All workflows are kept in a heap ordered by their next poll time. Every
+    tick, the due workflows are queried together with `/query?id=..&id=..`
+    (batch_size ids per request). A workflow whose status is unchanged is
+    polled less and less often (up to max_interval), and a young or changed
+    workflow is polled every min_interval seconds.
+
+    The callback is called with the query result when a workflow reaches a
+    terminal state, in a pool of `workers` threads, so a slow callback (e.g.
+    send an email) doesn't delay the polling.
+
+    A workflow missing from max_misses successful queries in a row is dropped
+    (e.g. it was submitted to another server), on_missing is called with its id.
+
+    Example usage:
+        scheduler = PollScheduler(cromwell, on_terminal=notify)
+        scheduler.add_many(workflow_ids)
+        scheduler.run()  # Return when all workflows are finished.
+    """
+
+    def __init__(self, cromwell, on_terminal=None, on_status=None,
+                 min_interval=30, max_interval=600, backoff=1.5,
+                 young_age=600, batch_size=100, workers=4, max_misses=10,
+                 on_missing=None):
+        """
+        :param cromwell: a Cromwell instance.
+        :param on_terminal: callback(query_result) when a workflow finished.
+        :param on_status: callback(query_result) after every poll of a workflow.
+        :param on_missing: callback(workflow_id) when a workflow is dropped after max_misses.
+        :param young_age: a workflow is polled every min_interval seconds in the first young_age seconds.
+        """
+        self.cromwell = cromwell
+        self.on_terminal = on_terminal
+        self.on_status = on_status
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.young_age = young_age
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_misses = max_misses
+        self.on_missing = on_missing
+        self.heap = []
+        self.states = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def add(self, workflow_id, delay=0):
+        now = time.time()
+        with self.lock:
+            if workflow_id in self.states:
+                return
+            self.states[workflow_id] = WorkflowState(workflow_id, self.min_interval, now)
+            heapq.heappush(self.heap, (now + delay, workflow_id))
+
+    def add_many(self, workflow_ids, delay=0):
+        for workflow_id in workflow_ids:
+            self.add(workflow_id, delay=delay)
+
+    def __len__(self):
+        return len(self.states)
+
+    def stop(self):
+        self.stopped.set()
+
+    def pop_due(self, now):
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+                _, workflow_id = heapq.heappop(self.heap)
+                if workflow_id in self.states:
+                    due.append(workflow_id)
+        return due
+
+    def next_interval(self, state, status, now):
+        if status != state.status or now - state.first_seen < self.young_age:
+            return self.min_interval
+        return min(state.interval * self.backoff, self.max_interval)
+
+    def reschedule(self, state, interval, now):
+        state.interval = interval
+        with self.lock:
+            heapq.heappush(self.heap, (now + interval, state.workflow_id))
+
+    def poll(self, workflow_ids, executor=None):
+        """Query the status of workflow_ids in one request and reschedule them.
+        """
+        now = time.time()
+        queried = True
+        try:
+            results = self.cromwell.query({"id": workflow_ids}).get('results', [])
+        except Exception as err:
+            logger.warning('Unable to query the status of %s workflows: %s' %
+                           (len(workflow_ids), str(err)))
+            queried = False
+            results = []
+
+        results = dict((result['id'], result) for result in results)
+        for workflow_id in workflow_ids:
+            state = self.states[workflow_id]
+            result = results.get(workflow_id)
+            if result is None:
+                # Unknown to cromwell yet (or a failed request), try later.
+                # Only a successful query counts as a miss.
+                if queried:
+                    state.misses += 1
+                if state.misses >= self.max_misses:
+                    self._drop_missing(workflow_id)
+                else:
+                    self.reschedule(state, min(self.min_interval * (state.misses + 1),
+                                               self.max_interval), now)
+                continue
+
+            state.misses = 0
+            status = result.get('status')
+            if self.on_status:
+                self.on_status(result)
+
+            if status in global_config.terminal_states:
+                with self.lock:
+                    self.states.pop(workflow_id, None)
+                if self.on_terminal:
+                    if executor:
+                        executor.submit(self._call_terminal, result)
+                    else:
+                        self._call_terminal(result)
+                continue
+
+            interval = self.next_interval(state, status, now)
+            state.status = status
+            self.reschedule(state, interval, now)
+
+    def _drop_missing(self, workflow_id):
+        with self.lock:
+            self.states.pop(workflow_id, None)
+
+        logger.warning('Workflow %s is missing from %s queries, stop polling it.' %
+                       (workflow_id, self.max_misses))
+        if self.on_missing:
+            try:
+                self.on_missing(workflow_id)
+            except Exception as err:
+                logger.error('Error occurred when processing workflow %s: %s' %
+                             (workflow_id, str(err)))
+
+    def _call_terminal(self, result):
+        try:
+            self.on_terminal(result)
+        except Exception as err:
+            logger.error('Error occurred when processing workflow %s: %s' %
+                         (result.get('id'), str(err)))
+
+    def run(self, forever=False):
+        """Poll the workflows until all of them are finished.
+
+        :param forever: keep running (waiting for new workflows) when no workflows are left.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopped.is_set():
+                if not self.states and not forever:
+                    break
+
+                now = time.time()
+                due = self.pop_due(now)
+                if due:
+                    self.poll(due, executor=executor)
+                    continue
+
+                with self.lock:
+                    next_time = self.heap[0][0] if self.heap else now + self.min_interval
+                self.stopped.wait(max(0, min(next_time - now, self.min_interval)))
@@ -13,27 +13,177 @@ from __future__ import unicode_literals
 import logging
 import json
 import os
+import re
 import subprocess
 import csv
 import sys
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from choppy import exit_code
+from choppy import exceptions
 from choppy.config import get_global_config
+from choppy.core.wdl_parser import WdlInputParser
+from choppy.core.path_checker import PathChecker
 
 global_config = get_global_config()
 module_logger = logging.getLogger(__name__)
 
+IMPORT_PATTERN = re.compile(r'^\s*import\s+"([^"]+)"', re.M)
+
+
+def hash_wdl(wdl, salt=''):
+    """Hash the content of a WDL file and all files it imports.
+
+    :param wdl: the path of WDL file.
+    :param salt: mixed into the hash, such as the name of womtool jar.
+    :return: a sha256 hex digest.
+    """
+    digest = hashlib.sha256(salt.encode('utf-8'))
+    root_dir = os.path.dirname(os.path.abspath(wdl))
+    pending = [os.path.abspath(wdl)]
+    seen = set()
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest.update(os.path.relpath(path, root_dir).encode('utf-8'))
+        digest.update(content)
+        # Remote imports (http://...) can't be hashed, they are kept in the content.
+        for imported in sorted(IMPORT_PATTERN.findall(content.decode('utf-8', 'replace'))):
+            imported_path = os.path.join(os.path.dirname(path), imported)
+            if '://' not in imported and os.path.isfile(imported_path):
+                pending.append(os.path.abspath(imported_path))
+    return digest.hexdigest()
+
+
+class WdlSignatureCache:
+    """Cache the output of `womtool inputs` on disk by the content hash of
+    the WDL file and its imports.
+
+    womtool has no server mode, so a cache miss still starts a JVM, but the
+    same WDL is only parsed once per cache_dir (concurrent misses of the same
+    WDL wait for the first one), and the misses of different WDL files run
+    in a bounded pool by get_many.
+
+    Example usage:
+        cache = get_signature_cache(womtool_path)
+        signature = cache.get('/path/to/workflow.wdl')
+    """
+
+    def __init__(self, womtool_path, cache_dir=None, jobs=4):
+        self.womtool_path = os.path.abspath(womtool_path)
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.signatures = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, '%s.json' % key)
+
+    def _load(self, key):
+        if not self.cache_dir or not os.path.isfile(self._disk_path(key)):
+            return None
+
+        try:
+            with open(self._disk_path(key), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as err:
+            module_logger.debug('Unable to load cached signature %s: %s' % (key, str(err)))
+            return None
+
+    def _save(self, key, signature):
+        if not self.cache_dir:
+            return
+
+        filepath = self._disk_path(key)
+        tmp_filepath = '%s.%s.%s' % (filepath, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_filepath, 'w') as f:
+                json.dump(signature, f)
+            os.rename(tmp_filepath, filepath)
+        except (IOError, OSError) as err:
+            module_logger.debug('Unable to save signature %s: %s' % (key, str(err)))
+
+    def run_womtool(self, wdl):
+        """Run `womtool inputs` in the directory of the WDL file.
+
+        :raises: subprocess.CalledProcessError, ValueError when the output isn't json.
+        """
+        cmd = ['java', '-jar', self.womtool_path, 'inputs', wdl]
+        module_logger.debug('Run womtool: %s' % ' '.join(cmd))
+        # Imports are resolved relative to the working directory.
+        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(wdl)).decode('utf-8')
+        return json.loads(output)
+
+    def get(self, wdl):
+        """Get the input signature of a WDL file, a dict of input names to types.
+        """
+        wdl = os.path.abspath(wdl)
+        key = hash_wdl(wdl, salt=os.path.basename(self.womtool_path))
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            signature = self.signatures.get(key)
+            if signature is None:
+                signature = self._load(key)
+                if signature is None:
+                    signature = self.run_womtool(wdl)
+                    self._save(key, signature)
+                self.signatures[key] = signature
+        # The caller may change the dict.
+        return dict(signature)
+
+    def get_many(self, wdls):
+        """Get the input signatures of many WDL files in a pool of `jobs` threads.
+
+        :return: a list of signatures in the order of wdls.
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(self.get, wdls))
+
+
+_signature_caches = {}
+
+
+def get_signature_cache(womtool_path, cache_dir=None):
+    """Get a WdlSignatureCache shared by the whole process.
+
+    :param cache_dir: ~/.choppy/cache/womtool by default.
+    """
+    if cache_dir is None:
+        cache_dir = global_config.get_cache_dir('womtool')
+
+    key = (os.path.abspath(womtool_path), cache_dir)
+    if key not in _signature_caches:
+        _signature_caches[key] = WdlSignatureCache(womtool_path, cache_dir=cache_dir)
+    return _signature_caches[key]
+
 
 class Validator:
     """Module to validate JSON inputs.
     """
 
-    def __init__(self, wdl, json):
+    def __init__(self, wdl, json, womtool_path=None, cache_dir=None):
         self.wdl = os.path.abspath(wdl)
         self.json = os.path.abspath(json)
-        womtool_path = global_config.get('general', 'womtool_path')
-        if not womtool_path:
-            raise Exception('You need to tell choppy-pipe where womtool is.')
-        self.wdl_tool = os.path.abspath(womtool_path)
+        womtool_path = womtool_path or global_config.get('general', 'womtool_path')
+        if womtool_path:
+            self.wdl_tool = os.path.abspath(womtool_path)
+            self.signature_cache = get_signature_cache(self.wdl_tool, cache_dir=cache_dir)
+        else:
+            # No java runtime needed, the parser has the same interface.
+            self.wdl_tool = None
+            self.signature_cache = WdlInputParser()
+        # The paths are checked once for a validation run.
+        self.path_checker = PathChecker()
         self.logger = logging.getLogger('choppy.validator.Validator')
 
     def get_json(self):
@@ -47,31 +197,25 @@ class Validator:
         return json_data
 
     def get_wdl_args(self, optional=True):
-        """Uses wdl-tool to get the expected arguments from the WDL file.
+        """Uses wdl-tool (or the pure Python parser without womtool_path) to get the expected arguments from the WDL file.
 
         :param optional: Include optional arguments if true.
         :return: Returns a dictionary of wdl arguments as keys and expected type as as value. # noqa
         """
         try:
-            os.chdir(os.path.dirname(self.wdl))
-        except OSError:
-            self.logger.warn('Warning: Could not navigate to WDL directory.')
-        cmd = ['java', '-jar', self.wdl_tool, 'inputs', self.wdl]
-        try:
-            run = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode("utf-8")
-        except subprocess.CalledProcessError:
+            d = self.signature_cache.get(self.wdl)
+            if optional:
+                return d
+            else:
+                return {k: v for k, v in d.items() if "optional" not in v}
+        except (subprocess.CalledProcessError, OSError):
             self.logger.warn("Unable to execute womtool command. "
                              "Make sure any subworkflow wdl files are present and try again.")
             sys.exit(exit_code.WOMTOOL_CAN_NOT_EXECUTE)
-
-        try:
-            if optional:
-                return json.loads(run)
-            else:
-                d = json.loads(run)
-                ds = json.dumps(
-                    {k: v for k, v in d.items() if "optional" not in v})
-                return json.loads(ds)
+        except exceptions.WdlSyntaxError as err:
+            self.logger.error("Unable to parse the WDL file: %s\n"
+                              "Set womtool_path in choppy.conf to use womtool instead." % str(err))
+            sys.exit(exit_code.VALIDATE_ERROR)
         except ValueError:
             self.logger.error("Something went wrong with getting args. "
                               "Note that if using validation, unzipped WDL dependencies "
@@ -87,6 +231,7 @@ class Validator:
         errors = list()
         jdict = self.get_json()
         wdict = self.get_wdl_args()
+        self.check_files(jdict, wdict)
         # for every key/value pair in jdict
         # first make sure the key is in wdict. If it isn't, that's an error.
         # return a list of any errors uncovered.
@@ -146,6 +291,16 @@ class Validator:
                     'Required parameter {} is missing from input json.'.format(k))
         return errors
 
+    def check_files(self, jdict, wdict):
+        """Check all File inputs at once, validate_file reads the results later.
+        """
+        paths = []
+        for param, val in jdict.items():
+            if param in wdict and 'File' in wdict[param]:
+                values = val if isinstance(val, list) else [val]
+                paths.extend([value for value in values if self.validate_string(value)])
+        self.path_checker.check_many(paths)
+
     def validate_samples_array(self, samples_array):
         """Validates a TSV sample file array (passed as an array) used in WDL inputs. Assumes that last column of each row contains an absolute path to a file.
 
@@ -153,6 +308,8 @@ class Validator:
         :return: A list of errors. If list is empty, there were no errors.
         """
         errors = []
+        samples_array = [row for row in samples_array if row]
+        self.path_checker.check_many([row[-1] for row in samples_array])
         for row in samples_array:
             if not self.validate_file(row[-1]):
                 errors.append(
@@ -198,14 +355,13 @@ class Validator:
 
         return isinstance(i, basestring)
 
-    @staticmethod
-    def validate_file(f):
-        """Validates that a particular file exists in the file system.
+    def validate_file(self, f):
+        """Validates that a particular file exists in the file system (or oss).
 
         :param f:
         :return: Boolean
         """
-        return os.path.exists(f.rstrip())
+        return self.path_checker.exists(f)
 
     @staticmethod
     def validate_boolean(i):
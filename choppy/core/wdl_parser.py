@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.core.wdl_parser
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Module to extract the input signature of a WDL file without womtool.
+
+    Only the subset of WDL (draft-2 and 1.0) used by choppy apps is supported:
+    imports, tasks, workflows, calls (with aliases and subworkflows) and
+    declarations of any type. The result has the same format as the output
+    of `womtool inputs`, such as:
+
+        {
+            "workflow.sample_id": "String",
+            "workflow.mapping.cpu": "Int? (optional)",
+            "workflow.mapping.docker": "String (optional, default = \"bwa\")"
+        }
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import os
+import re
+import logging
+from choppy import exceptions
+
+logger = logging.getLogger(__name__)
+
+IMPORT_PATTERN = re.compile(r'^import\s+"(?P<uri>[^"]+)"(?:\s+as\s+(?P<alias>\w+))?')
+BLOCK_PATTERN = re.compile(r'^(?P<kind>task|workflow|struct)\s+(?P<name>\w+)\s*\{')
+CALL_PATTERN = re.compile(r'^call\s+(?P<callee>[\w.]+)(?:\s+as\s+(?P<alias>\w+))?\s*(?P<body>\{.*)?$',
+                          re.S)
+DECLARATION_PATTERN = re.compile(r'^(?P<type>[A-Z]\w*(?:\s*\[.*?\])?\s*[+?]*)\s+'
+                                 r'(?P<name>[A-Za-z_]\w*)\s*(?:=\s*(?P<expr>.+))?$', re.S)
+SECTION_PATTERN = re.compile(r'^(?P<name>input|output|runtime|meta|parameter_meta|'
+                             r'scatter|if|command)\b')
+OPEN_BRACKETS = '([{'
+CLOSE_BRACKETS = ')]}'
+
+
+def strip_comments(text):
+    """Remove `# comments`, but keep `#` in strings.
+    """
+    lines = []
+    for line in text.splitlines():
+        quote = None
+        for index, char in enumerate(line):
+            if quote:
+                if char == quote:
+                    quote = None
+            elif char in '"\'':
+                quote = char
+            elif char == '#':
+                line = line[:index]
+                break
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def find_closing(text, start, opening='{', closing='}', quoted=True):
+    """Find the index of the bracket which closes text[start].
+
+    :param quoted: skip the brackets in strings, False for the command section.
+    """
+    depth = 0
+    quote = None
+    for index in range(start, len(text)):
+        char = text[index]
+        if quote:
+            if char == quote:
+                quote = None
+        elif quoted and char in '"\'':
+            quote = char
+        elif char == opening:
+            depth += 1
+        elif char == closing:
+            depth -= 1
+            if depth == 0:
+                return index
+    raise exceptions.WdlSyntaxError('Unclosed %s at %s.' % (opening, text[start:start + 50]))
+
+
+def strip_commands(text):
+    """Remove the command sections, which may contain anything.
+    """
+    chunks = []
+    position = 0
+    for match in re.finditer(r'(?m)^\s*command\s*(<<<|\{)', text):
+        if match.start() < position:
+            continue
+        chunks.append(text[position:match.start()])
+        if match.group(1) == '<<<':
+            end = text.find('>>>', match.end())
+            if end < 0:
+                raise exceptions.WdlSyntaxError('Unclosed command <<<.')
+            position = end + 3
+        else:
+            position = find_closing(text, match.end() - 1, quoted=False) + 1
+    chunks.append(text[position:])
+    return ''.join(chunks)
+
+
+def split_statements(body):
+    """Split a block body into statements, a nested block (or a multi-line
+    expression) belongs to the statement which opens it.
+    """
+    statements = []
+    current = []
+    depth = 0
+    quote = None
+    for char in body:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in OPEN_BRACKETS:
+            depth += 1
+        elif char in CLOSE_BRACKETS:
+            depth -= 1
+
+        if char == '\n' and depth == 0 and not quote:
+            statements.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    statements.append(''.join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def block_body(statement):
+    """Get the content between the outermost braces of a statement.
+    """
+    start = statement.find('{')
+    end = find_closing(statement, start)
+    return statement[start + 1:end]
+
+
+def normalize_type(wdl_type):
+    return re.sub(r'\s*,\s*', ', ', re.sub(r'\s+', '', wdl_type))
+
+
+def parse_declaration(statement):
+    """Parse `Type name [= expression]`.
+
+    :return: (name, type, default expression or None), None when it isn't a declaration.
+    """
+    match = DECLARATION_PATTERN.match(statement)
+    if match is None or match.group('type').split('[')[0] in ('call', 'import'):
+        return None
+
+    expr = match.group('expr')
+    return match.group('name'), normalize_type(match.group('type')), \
+        expr.strip() if expr is not None else None
+
+
+def format_input_type(wdl_type, default=None):
+    """Format a type like womtool inputs.
+    """
+    if default is not None:
+        return '%s (optional, default = %s)' % (wdl_type, default)
+    elif wdl_type.endswith('?'):
+        return '%s (optional)' % wdl_type
+    else:
+        return wdl_type
+
+
+def parse_call_inputs(body):
+    """Get the names of inputs supplied by `{ input: a = x, b = y }`.
+    """
+    body = body.strip()
+    if body.startswith('input'):
+        body = body[len('input'):].lstrip().lstrip(':')
+
+    names = []
+    depth = 0
+    quote = None
+    current = []
+    for char in body + ',':
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in OPEN_BRACKETS:
+            depth += 1
+        elif char in CLOSE_BRACKETS:
+            depth -= 1
+        elif char == ',' and depth == 0:
+            name = ''.join(current).split('=')[0].strip()
+            if name:
+                names.append(name)
+            current = []
+            continue
+        current.append(char)
+    return names
+
+
+class WdlDocument:
+    """The tasks, workflows and imports of a WDL file.
+    """
+
+    def __init__(self, path, text=None):
+        self.path = os.path.abspath(path)
+        if text is None:
+            with open(self.path, 'r') as f:
+                text = f.read()
+
+        self.version = 'draft-2'
+        self.imports = {}
+        # name -> list of (name, type, default)
+        self.tasks = {}
+        # name -> (list of (name, type, default), list of (callee, alias, supplied names))
+        self.workflows = {}
+        self.parse(strip_comments(strip_commands(text)))
+
+    def parse(self, text):
+        for statement in split_statements(text):
+            if statement.startswith('version'):
+                self.version = statement.split()[-1]
+                continue
+
+            match = IMPORT_PATTERN.match(statement)
+            if match:
+                uri = match.group('uri')
+                alias = match.group('alias') or os.path.splitext(os.path.basename(uri))[0]
+                self.imports[alias] = uri
+                continue
+
+            match = BLOCK_PATTERN.match(statement)
+            if match is None:
+                raise exceptions.WdlSyntaxError('Unsupported statement in %s: %s' %
+                                                (self.path, statement[:80]))
+
+            kind, name = match.group('kind'), match.group('name')
+            if kind == 'task':
+                self.tasks[name] = self.parse_declarations(block_body(statement))
+            elif kind == 'workflow':
+                body = block_body(statement)
+                self.workflows[name] = (self.parse_declarations(body), self.parse_calls(body))
+
+    def parse_declarations(self, body):
+        """Parse the inputs of a task or workflow, in the `input {}` section
+        (WDL 1.0) or all declarations out of sections (draft-2).
+        """
+        declarations = []
+        for statement in split_statements(body):
+            section = SECTION_PATTERN.match(statement)
+            if section:
+                if section.group('name') == 'input':
+                    declarations.extend(filter(None, map(parse_declaration,
+                                                         split_statements(block_body(statement)))))
+                continue
+
+            # The other declarations of WDL 1.0 are private.
+            declaration = parse_declaration(statement) if self.version == 'draft-2' else None
+            if declaration:
+                declarations.append(declaration)
+        return declarations
+
+    def parse_calls(self, body):
+        """Parse the calls of a workflow, including the calls in scatter and if blocks.
+        """
+        calls = []
+        for statement in split_statements(body):
+            match = CALL_PATTERN.match(statement)
+            if match:
+                callee = match.group('callee')
+                alias = match.group('alias') or callee.split('.')[-1]
+                supplied = parse_call_inputs(block_body(statement)) if match.group('body') else []
+                calls.append((callee, alias, supplied))
+            elif re.match(r'^(scatter|if)\b', statement):
+                calls.extend(self.parse_calls(block_body(statement)))
+        return calls
+
+
+class WdlInputParser:
+    """Extract the input signature of a WDL file, the counterpart of
+    `womtool inputs` in pure Python.
+
+    Example usage:
+        WdlInputParser().get('/path/to/workflow.wdl')
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        if path not in self.documents:
+            self.documents[path] = WdlDocument(path)
+        return self.documents[path]
+
+    def resolve_import(self, document, uri, root_dir):
+        if '://' in uri:
+            raise exceptions.WdlSyntaxError('Remote import is not supported: %s' % uri)
+
+        # Relative to the importing file first, then the main WDL file like cromwell.
+        for base_dir in (os.path.dirname(document.path), root_dir):
+            path = os.path.join(base_dir, uri)
+            if os.path.isfile(path):
+                return self.load(path)
+        raise exceptions.WdlSyntaxError('No such imported file: %s' % uri)
+
+    def resolve_callee(self, document, callee, root_dir):
+        """Find the task or workflow called by `call ns.name`.
+
+        :return: (the document of callee, 'task' or 'workflow', name)
+        """
+        if '.' in callee:
+            namespace, name = callee.split('.', 1)
+            if namespace not in document.imports:
+                raise exceptions.WdlSyntaxError('No such namespace in %s: %s' % (document.path, namespace))
+            document = self.resolve_import(document, document.imports[namespace], root_dir)
+        else:
+            name = callee
+
+        if name in document.tasks:
+            return document, 'task', name
+        elif name in document.workflows:
+            return document, 'workflow', name
+        raise exceptions.WdlSyntaxError('No such task or workflow: %s' % callee)
+
+    def workflow_inputs(self, document, workflow_name, root_dir):
+        """Get the inputs of a workflow, the keys are relative to the workflow.
+        """
+        declarations, calls = document.workflows[workflow_name]
+        inputs = {}
+        for name, wdl_type, default in declarations:
+            inputs[name] = format_input_type(wdl_type, default)
+
+        for callee, alias, supplied in calls:
+            callee_document, kind, name = self.resolve_callee(document, callee, root_dir)
+            if kind == 'task':
+                callee_inputs = dict((input_name, format_input_type(wdl_type, default))
+                                     for input_name, wdl_type, default in callee_document.tasks[name])
+            else:
+                callee_inputs = self.workflow_inputs(callee_document, name, root_dir)
+
+            for input_name, input_type in callee_inputs.items():
+                if input_name not in supplied:
+                    inputs['%s.%s' % (alias, input_name)] = input_type
+        return inputs
+
+    def get(self, wdl):
+        """Get the input signature of a WDL file.
+
+        :param wdl: the path of the main WDL file, which contains one workflow.
+        :return: a dict of input names to types, the same as `womtool inputs`.
+        """
+        document = self.load(wdl)
+        if len(document.workflows) != 1:
+            raise exceptions.WdlSyntaxError('%s must contain exactly one workflow.' % wdl)
+
+        workflow_name = list(document.workflows.keys())[0]
+        root_dir = os.path.dirname(document.path)
+        inputs = self.workflow_inputs(document, workflow_name, root_dir)
+        return dict(('%s.%s' % (workflow_name, name), input_type)
+                    for name, input_type in inputs.items())
+
+
+def get_wdl_inputs(wdl):
+    """Extract the input signature of a WDL file, see WdlInputParser.get.
+    """
+    return WdlInputParser().get(wdl)
@@ -13,127 +13,495 @@ from __future__ import unicode_literals
 import csv
 import os
 import json
+import time
+import hashlib
 import logging
+import threading
+from itertools import chain
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from choppy.check_utils import check_dir, is_valid_label
-from choppy.core.app_utils import (parse_samples, render_app, write,
-                                   generate_dependencies_zip, submit_workflow,
-                                   AppDefaultVar, is_valid_app, get_version)
+from choppy.core.app_utils import (SamplesReader, render_app, write,
+                                   get_dependencies_zip, submit_workflow,
+                                   submit_workflow_batch, label_workflows,
+                                   load_app_defaults, merge_defaults,
+                                   get_all_variables, is_valid_app, get_version)
 from choppy.core.json_checker import check_json
+from choppy.core.journal import SubmissionJournal
 from choppy.utils import copy_and_overwrite
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of WDL groups waiting for more samples in batch mode.
+MAX_OPEN_GROUPS = 64
+# The maximum number of samples whose project files are waiting to be saved.
+MAX_PENDING_WRITES = 64
+
+
+class RateLimiter:
+    """Space out calls so that no more than `rate` calls start per second,
+    shared by all workers of a batch.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            wait_seconds = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+class BoundedExecutor:
+    """A thread pool whose submit blocks while max_pending tasks are queued
+    or running, so a slow disk can't pile up the rendered files in memory.
+    """
+
+    def __init__(self, max_workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.semaphore = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        self.semaphore.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self.semaphore.release())
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def ordered_map(executor, func, iterable, max_pending):
+    """Like executor.map, but only max_pending items of a lazy iterable are
+    read ahead, results are yielded in the order of the iterable.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+class BatchProgress:
+    """Report progress and throughput of a batch submission.
+    """
+
+    def __init__(self, total=None, report_every=10):
+        self.total = total
+        self.report_every = report_every
+        self.finished = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, failed=False, skipped=False):
+        """
+        :param skipped: the sample was submitted by a previous run of the project.
+        """
+        with self.lock:
+            self.finished += 1
+            if failed:
+                self.failed += 1
+            if skipped:
+                self.skipped += 1
+
+            if self.finished % self.report_every == 0 or self.finished == self.total:
+                elapsed = max(time.time() - self.start_time, 1e-6)
+                logger.info("Progress: %s/%s samples (%s failed, %s skipped), %.2f samples/s" %
+                            (self.finished, self.total or '-', self.failed, self.skipped,
+                             (self.finished - self.skipped) / elapsed))
+
+
+class SamplesWriter:
+    """Write samples to a CSV file as they are produced, the file is created
+    with the first sample and its header is the keys of the first sample.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, sample):
+        if self._writer is None:
+            self._file = open(self.path, 'wt')
+            self._writer = csv.DictWriter(self._file, list(sample.keys()),
+                                          extrasaction='ignore')
+            self._writer.writeheader()
+
+        self._writer.writerow(sample)
+        self.count += 1
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+def save_sample_files(sample_path, app_dir, inputs, wdl):
+    """Save the rendered files of a sample in the project directory.
+    """
+    try:
+        write(sample_path, 'inputs', inputs)
+        write(sample_path, 'workflow.wdl', wdl)
+
+        src_defaults_file = os.path.join(app_dir, 'defaults')
+        dest_defaults_file = os.path.join(sample_path, 'defaults')
+        copy_and_overwrite(src_defaults_file, dest_defaults_file, is_file=True)
+
+        src_dependencies = os.path.join(app_dir, 'tasks')
+        dest_dependencies = os.path.join(sample_path, 'tasks')
+        copy_and_overwrite(src_dependencies, dest_dependencies)
+    except (IOError, OSError) as err:
+        logger.warning("Unable to save the files of %s: %s" % (sample_path, str(err)))
+
+
+def render_sample(sample, project_name, project_path, app_dir, dry_run=False,
+                  force=False, journal=None, save_files=True, writer=None):
+    """Render and save one sample.
+
+    The rendered WDL string and inputs dict are submitted directly, the
+    project files are only a record of the submission.
+
+    :param save_files: save inputs, workflow.wdl, defaults and tasks in project_path/sample_id.
+    :param writer: an executor to save the files in the background, save them in place when None.
+    :return: (wdl, inputs_dict)
+    """
+    sample_id = sample.get('sample_id')
+    sample['project_name'] = project_name
+
+    try:
+        # inputs
+        inputs = render_app(app_dir, 'inputs', sample)
+        inputs_dict = check_json(string=inputs)  # Json Syntax Checker
+
+        # workflow.wdl
+        wdl = render_app(app_dir, 'workflow.wdl', sample)
+
+        if save_files or dry_run:
+            # make project_name/sample_id directory
+            sample_path = os.path.join(project_path, sample.get('sample_id'))
+            check_dir(sample_path, skip=force)
+            if writer:
+                writer.submit(save_sample_files, sample_path, app_dir, inputs, wdl)
+            else:
+                save_sample_files(sample_path, app_dir, inputs, wdl)
+
+        is_valid_label(sample["sample_id"])
+    except Exception as err:
+        # Record why the run stopped, --resume retries the sample.
+        if journal:
+            journal.record(sample_id, 'render', 'failed', error=str(err))
+        raise
+
+    if journal:
+        journal.record(sample_id, 'render', 'success')
+
+    return wdl, inputs_dict
+
+
+def submit_sample(sample, project_name, project_path, app_dir, label,
+                  server='localhost', username=None, dry_run=False,
+                  force=False, rate_limiter=None, dep_zip_file=None,
+                  journal=None, save_files=True, writer=None):
+    """Render, save and submit one sample, see render_sample.
+
+    :return: (sample, submitted), submitted is False when the submission failed.
+    """
+    sample_id = sample.get('sample_id')
+    wdl, inputs_dict = render_sample(sample, project_name, project_path, app_dir,
+                                     dry_run=dry_run, force=force, journal=journal,
+                                     save_files=save_files, writer=writer)
+    # Each sample has its own labels, the label list is shared by all samples.
+    sample_label = list(label or []) + ["sample-id:%s" % sample["sample_id"].lower()]
+
+    if not dry_run:
+        try:
+            if rate_limiter:
+                rate_limiter.wait()
+            result = submit_workflow(wdl, inputs_dict,
+                                     dep_zip_file,
+                                     sample_label, username=username,
+                                     server=server, wdl_string=True)
+
+            sample['workflow_id'] = result['id']
+            logger.info("Sample ID: %s, Workflow ID: %s" %
+                        (sample.get('sample_id'), result['id']))
+            if journal:
+                journal.record(sample_id, 'submit', 'success',
+                               workflow_id=result['id'], sample=sample)
+        except Exception as e:
+            logger.error("Sample ID: %s, %s" %
+                         (sample.get('sample_id'), str(e)))
+            if journal:
+                journal.record(sample_id, 'submit', 'failed', error=str(e))
+            return sample, False
+
+    return sample, True
+
+
+def group_by_wdl(rendered, batch_size, max_groups=MAX_OPEN_GROUPS):
+    """Group the rendered samples sharing the same WDL.
+
+    :param rendered: an iterable of (sample, wdl, inputs_dict).
+    :param batch_size: the maximum number of samples in a group.
+    :param max_groups: submit the oldest group when there are too many distinct WDL files.
+    :return: a generator of (wdl, [(sample, inputs_dict), ...]).
+    """
+    groups = OrderedDict()
+    for sample, wdl, inputs_dict in rendered:
+        key = hashlib.sha1(wdl.encode('utf-8')).hexdigest()
+        if key not in groups:
+            groups[key] = (wdl, [])
+
+        items = groups[key][1]
+        items.append((sample, inputs_dict))
+        if len(items) >= batch_size:
+            yield groups.pop(key)
+        elif len(groups) > max_groups:
+            yield groups.popitem(last=False)[1]
+
+    for group in groups.values():
+        yield group
+
+
+def submit_sample_group(wdl, items, label, server='localhost', username=None,
+                        rate_limiter=None, dep_zip_file=None, journal=None):
+    """Submit the samples sharing a WDL by one request of the batch endpoint.
+
+    Each sample has its own sample-id label, which is added after the
+    submission is recorded. A sample whose labels can't be added is still
+    submitted, the error is logged and recorded in the journal.
+
+    :param items: a list of (sample, inputs_dict).
+    :return: a list of (sample, submitted).
+    """
+    samples = [sample for sample, _ in items]
+    try:
+        if rate_limiter:
+            rate_limiter.wait()
+        results = submit_workflow_batch(wdl, [inputs_dict for _, inputs_dict in items],
+                                        dep_zip_file, label, username=username,
+                                        server=server, wdl_string=True)
+    except Exception as e:
+        for sample in samples:
+            logger.error("Sample ID: %s, %s" % (sample.get('sample_id'), str(e)))
+            if journal:
+                journal.record(sample.get('sample_id'), 'submit', 'failed', error=str(e))
+        return [(sample, False) for sample in samples]
+
+    for sample, result in zip(samples, results):
+        sample['workflow_id'] = result['id']
+        logger.info("Sample ID: %s, Workflow ID: %s" %
+                    (sample.get('sample_id'), result['id']))
+        if journal:
+            journal.record(sample.get('sample_id'), 'submit', 'success',
+                           workflow_id=result['id'], sample=sample)
+
+    workflow_ids = [result['id'] for result in results]
+    labels_list = [{"sample-id": sample["sample_id"].lower()} for sample in samples]
+    errors = label_workflows(workflow_ids, labels_list, server=server)
+    for sample, workflow_id, error in zip(samples, workflow_ids, errors):
+        if error:
+            logger.warning("Sample ID: %s, Workflow ID: %s, unable to add labels: %s" %
+                           (sample.get('sample_id'), workflow_id, error))
+            if journal:
+                journal.record(sample.get('sample_id'), 'label', 'failed',
+                               workflow_id=workflow_id, error=error)
+    return [(sample, True) for sample in samples]
+
 
 def run_batch(project_name, app_dir, samples, label, server='localhost',
-              username=None, dry_run=False, force=False):
+              username=None, dry_run=False, force=False, jobs=1, rate=None,
+              resume=False, save_files=True, batch_size=1, keep_samples=True):
+    """Submit all samples of a samples file.
+
+    :param jobs: The number of samples rendered and submitted concurrently.
+    :param rate: The maximum number of submissions per second, no limit when None.
+    :param resume: Skip the samples submitted by a previous run of the project,
+                   retry the failed or missing ones.
+    :param save_files: Save the rendered files of every sample in the project
+                       directory, in the background. Always True for dry run.
+    :param batch_size: Submit at most batch_size samples sharing the same
+                       WDL in one request, the samples in submitted.csv are
+                       in the order of submission when it's greater than 1.
+    :param keep_samples: Return the successed and failed samples, otherwise
+                         they are only written to submitted.csv/failed.csv
+                         as they are produced and the lists are empty.
+    """
     is_valid_app(app_dir)
     working_dir = os.getcwd()
     project_path = os.path.join(working_dir, project_name)
+    # Resuming a project need to overwrite the files of unsubmitted samples.
+    force = force or resume
     check_dir(project_path, skip=force)
+    journal = SubmissionJournal(project_path)
+    if resume:
+        logger.info("Resume the project, %s samples have been submitted." %
+                    len(journal.submissions))
 
-    samples_data = parse_samples(samples)
-    successed_samples = []
-    failed_samples = []
+    # Validate the header once, the rows are read lazily while submitting.
+    defaults = load_app_defaults(app_dir)
+    variables = set(get_all_variables(app_dir)) - set(defaults.keys())
+    samples_reader = SamplesReader(samples)
+    if 'sample_id' not in samples_reader.header:
+        raise Exception("Your samples file must contain sample_id column.")
+    samples_reader.check_header(variables)
 
-    for sample in samples_data:
-        if 'sample_id' not in sample.keys():
-            raise Exception("Your samples file must contain sample_id column.")
-        else:
-            # 用户可通过samples文件覆写default文件中已定义的变量
-            # 只有samples文件中缺少的变量才从default文件中取值
-            app_default_var = AppDefaultVar(app_dir)
-            all_default_value = app_default_var.show_default_value()
+    # 用户可通过samples文件覆写default文件中已定义的变量
+    # 只有samples文件中缺少的变量才从default文件中取值
+    samples_data, default_columns = merge_defaults(samples_reader, defaults,
+                                                   header=samples_reader.header)
+    if default_columns:
+        logger.info("Columns from defaults: %s" % ', '.join(default_columns))
 
-            for key in all_default_value.keys():
-                if key not in sample.keys():
-                    sample[key] = all_default_value.get(key)
+    # The tasks directory is same for all samples, zip it only once.
+    dep_zip_file = None
+    if not dry_run:
+        dep_zip_file = get_dependencies_zip(os.path.join(app_dir, 'tasks'))
+        journal.record(None, 'zip', 'success', dependencies=dep_zip_file)
 
-            # make project_name/sample_id directory
-            sample_path = os.path.join(project_path, sample.get('sample_id'))
-            check_dir(sample_path, skip=force)
+    rate_limiter = RateLimiter(rate)
+    progress = BatchProgress()
+    # Saving the project files doesn't delay the submissions.
+    writer = None
+    if save_files and not dry_run:
+        writer = BoundedExecutor(max_workers=2, max_pending=MAX_PENDING_WRITES)
+    kwargs = dict(project_name=project_name, project_path=project_path,
+                  app_dir=app_dir, label=label, server=server,
+                  username=username, dry_run=dry_run, force=force,
+                  rate_limiter=rate_limiter, dep_zip_file=dep_zip_file,
+                  journal=None if dry_run else journal,
+                  save_files=save_files, writer=writer)
 
-            sample['project_name'] = project_name
-
-            # inputs
-            inputs = render_app(app_dir, 'inputs', sample)
-            check_json(string=inputs)  # Json Syntax Checker
-            write(sample_path, 'inputs', inputs)
-            inputs_path = os.path.join(sample_path, 'inputs')
-
-            # workflow.wdl
-            wdl = render_app(app_dir, 'workflow.wdl', sample)
-            write(sample_path, 'workflow.wdl', wdl)
-            wdl_path = os.path.join(sample_path, 'workflow.wdl')
-
-            # defaults
-            src_defaults_file = os.path.join(app_dir, 'defaults')
-            dest_defaults_file = os.path.join(sample_path, 'defaults')
-            copy_and_overwrite(src_defaults_file, dest_defaults_file, is_file=True)
-
-            src_dependencies = os.path.join(app_dir, 'tasks')
-            dest_dependencies = os.path.join(sample_path, 'tasks')
-            copy_and_overwrite(src_dependencies, dest_dependencies)
-
-            if label is None:
-                label = []
-
-            is_valid_label(sample["sample_id"])
-            label.append("sample-id:%s" % sample["sample_id"].lower())
-
-            if not dry_run:
-                try:
-                    dep_path = os.path.join(app_dir, 'tasks')
-                    dep_zip_file = generate_dependencies_zip(dep_path)
-                    result = submit_workflow(wdl_path, inputs_path,
-                                             dep_zip_file,
-                                             label, username=username,
-                                             server=server)
-
-                    sample['workflow_id'] = result['id']
-                    logger.info("Sample ID: %s, Workflow ID: %s" %
-                                (sample.get('sample_id'), result['id']))
-                except Exception as e:
-                    logger.error("Sample ID: %s, %s" %
-                                 (sample.get('sample_id'), str(e)))
-                    failed_samples.append(sample)
-                    continue
+    def get_submitted(sample):
+        sample_id = sample.get('sample_id')
+        if resume and journal.is_submitted(sample_id):
+            # The sample has been submitted by a previous run.
+            sample = journal.get_submission(sample_id).get('sample')
+            logger.info("Sample ID: %s, Workflow ID: %s, skip the submitted sample." %
+                        (sample_id, sample.get('workflow_id')))
+            progress.update(skipped=True)
+            return sample
 
-            successed_samples.append(sample)
+    def submit(sample):
+        submitted_sample = get_submitted(sample)
+        if submitted_sample:
+            return submitted_sample, True
+
+        sample, submitted = submit_sample(sample, **kwargs)
+        progress.update(failed=not submitted)
+        return sample, submitted
+
+    render_kwargs = dict((key, kwargs[key]) for key in
+                         ('project_name', 'project_path', 'app_dir', 'dry_run',
+                          'force', 'journal', 'save_files', 'writer'))
+
+    def render(sample):
+        submitted_sample = get_submitted(sample)
+        if submitted_sample:
+            return submitted_sample, None, None
+
+        wdl, inputs_dict = render_sample(sample, **render_kwargs)
+        return sample, wdl, inputs_dict
+
+    def submit_group(group):
+        wdl, items = group
+        results = submit_sample_group(wdl, items, label, server=server, username=username,
+                                      rate_limiter=rate_limiter, dep_zip_file=dep_zip_file,
+                                      journal=journal)
+        for _, submitted in results:
+            progress.update(failed=not submitted)
+        return results
+
+    def submit_in_batches(rendered):
+        # The samples submitted by a previous run, reported with the next group.
+        skipped = []
+
+        def unsubmitted():
+            for sample, wdl, inputs_dict in rendered:
+                if wdl is None:
+                    skipped.append((sample, True))
+                else:
+                    yield sample, wdl, inputs_dict
+
+        groups = group_by_wdl(unsubmitted(), batch_size)
+        for results in ordered_map(executor, submit_group, groups, max_pending=jobs):
+            reported = skipped[:]
+            del skipped[:]
+            for result in chain(reported, results):
+                yield result
+
+        for result in skipped:
+            yield result
+
+    if batch_size > 1 and not dry_run:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        rendered = ordered_map(executor, render, samples_data, max_pending=jobs * 2)
+        results = submit_in_batches(rendered)
+    elif jobs > 1:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        # Keep the order of samples file in submitted.csv/failed.csv.
+        results = ordered_map(executor, submit, samples_data, max_pending=jobs * 2)
+    else:
+        executor = None
+        results = (submit(sample) for sample in samples_data)
 
-    submitted_file_path = os.path.join(project_path, 'submitted.csv')
-    failed_file_path = os.path.join(project_path, 'failed.csv')
     version_path = os.path.join(project_path, 'version')
     version_dict = get_version(app_dir)
 
     with open(version_path, 'wt') as fversion:
         json.dump(version_dict, fversion)
 
-    if len(successed_samples) > 0:
-        keys = successed_samples[0].keys()
-        with open(submitted_file_path, 'wt') as fsuccess:
-            dict_writer = csv.DictWriter(fsuccess, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(successed_samples)
-
-    if len(failed_samples) > 0:
-        keys = failed_samples[0].keys()
-        with open(failed_file_path, 'wt') as ffail:
-            dict_writer = csv.DictWriter(ffail, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(failed_samples)
-
-    if len(successed_samples) > 0:
-        if len(failed_samples) == 0:
-            logger.info("Successed: %s, %s" %
-                        (len(successed_samples), submitted_file_path))
-        else:
-            logger.info("Successed: %s, %s" %
-                        (len(successed_samples), submitted_file_path))
-            logger.error("Failed: %s, %s" %
-                         (len(failed_samples), failed_file_path))
-    else:
+    successed_samples = []
+    failed_samples = []
+    # Rows are written as samples are submitted, the memory stays flat.
+    submitted_file_path = os.path.join(project_path, 'submitted.csv')
+    failed_file_path = os.path.join(project_path, 'failed.csv')
+    submitted_writer = SamplesWriter(submitted_file_path)
+    failed_writer = SamplesWriter(failed_file_path)
+    try:
+        for sample, submitted in results:
+            if submitted:
+                submitted_writer.write(sample)
+                if keep_samples:
+                    successed_samples.append(sample)
+            else:
+                failed_writer.write(sample)
+                if keep_samples:
+                    failed_samples.append(sample)
+    finally:
+        submitted_writer.close()
+        failed_writer.close()
+        if executor:
+            executor.shutdown()
+        if writer:
+            # All files are saved when run_batch returns.
+            writer.shutdown(wait=True)
+
+    if submitted_writer.count > 0:
+        logger.info("Successed: %s, %s" %
+                    (submitted_writer.count, submitted_file_path))
+    if failed_writer.count > 0 or submitted_writer.count == 0:
         logger.error("Failed: %s, %s" %
-                     (len(failed_samples), failed_file_path))
+                     (failed_writer.count, failed_file_path))
 
     return {
         "successed": successed_samples,
@@ -44,6 +44,10 @@ class InValidApp(Exception):
     pass
 
 
+class InValidSamples(Exception):
+    pass
+
+
 class NotFoundApp(Exception):
     pass
 
@@ -82,3 +86,15 @@ class NoSuchSchema(Exception):
 
 class NoProperConfig(Exception):
     pass
+
+
+class ConfigValueError(Exception):
+    pass
+
+
+class MissingDependency(Exception):
+    pass
+
+
+class WdlSyntaxError(Exception):
+    pass
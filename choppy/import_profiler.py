@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    choppy.import_profiler
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Report the import time of every module when CHOPPY_PROFILE_IMPORTS is set.
+
+    Usage:
+        CHOPPY_PROFILE_IMPORTS=1 choppy version
+        CHOPPY_PROFILE_IMPORTS=50 choppy batch ...   # Show the top 50 modules.
+
+    :copyright: © 2019 by the Choppy team.
+    :license: AGPL, see LICENSE.md for more details.
+"""
+
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import atexit
+import importlib.abc
+
+PROFILE_ENV = 'CHOPPY_PROFILE_IMPORTS'
+
+
+class _TimedLoader:
+    """Time the execution of a module, forward everything else to the loader.
+    """
+
+    def __init__(self, loader, profiler):
+        self._loader = loader
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Restore the original loader, so importlib.resources etc. still work.
+        module.__loader__ = self._loader
+        if getattr(module, '__spec__', None) is not None:
+            module.__spec__.loader = self._loader
+
+        self._profiler.start(module.__name__)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profiler.stop()
+
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    """A meta path finder that records the self and cumulative import time
+    of every module imported after install().
+    """
+
+    def __init__(self):
+        # [module name, start time, time spent in child imports]
+        self.stack = []
+        # module name -> (self seconds, cumulative seconds)
+        self.records = {}
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def start(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        name, start, children = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self.records[name] = (elapsed - children, elapsed)
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def report(self, limit=30, stream=None):
+        stream = stream or sys.stderr
+        records = sorted(self.records.items(), key=lambda item: -item[1][1])
+        total = sum(self_time for self_time, _ in self.records.values())
+        stream.write('Imported %s modules in %.1f ms, the slowest %s:\n' %
+                     (len(records), total * 1000, min(limit, len(records))))
+        stream.write('%10s | %10s | %s\n' % ('self (ms)', 'cumul (ms)', 'module'))
+        for name, (self_time, cumulative) in records[:limit]:
+            stream.write('%10.1f | %10.1f | %s\n' % (self_time * 1000, cumulative * 1000, name))
+
+
+def install_import_profiler(environ=os.environ):
+    """Install the profiler when CHOPPY_PROFILE_IMPORTS is set, and print the
+    report when the process exits.
+
+    :return: the profiler, None when CHOPPY_PROFILE_IMPORTS isn't set.
+    """
+    value = environ.get(PROFILE_ENV)
+    if not value:
+        return None
+
+    limit = int(value) if value.isdigit() and int(value) > 1 else 30
+    profiler = ImportProfiler()
+    sys.meta_path.insert(0, profiler)
+    atexit.register(profiler.report, limit)
+    return profiler
@@ -48,7 +48,7 @@ class EmailNotification(object):
     @staticmethod
     def attach_logs(msg, metadata):
         failed_jobs = Cromwell.getCalls(
-            'Failed', metadata['calls'], full_logs=True)
+            'Failed', metadata.get('calls', {}), full_logs=True)
 
         for log in failed_jobs:
             stdout_attachment = MIMEText(str(log["stdout"]['log']))
@@ -14,10 +14,8 @@ from __future__ import unicode_literals
 import os
 import logging
 import shutil
-import psutil
 import signal
 import time
-import coloredlogs
 import verboselogs
 from datetime import datetime
 from random import Random as _Random
@@ -33,6 +31,8 @@ logger = logging.getLogger('choppy.utils')
 
 
 def set_logger(log_name, loglevel, handler='stream', subdir="project_logs", log_dir='/tmp'):
+    import coloredlogs
+
     if subdir:
         project_logs = os.path.join(log_dir, "project_logs")
         check_dir(project_logs, skip=True)
@@ -259,6 +259,8 @@ class Process:
         self.logger = logging.getLogger('choppy.utils.Process')
 
     def get_process(self, process_id):
+        import psutil
+
         try:
             p = psutil.Process(process_id)
             return p
@@ -279,6 +281,8 @@ class Process:
         "on_terminate", if specified, is a callabck function which is
         called as soon as a child terminates.
         """
+        import psutil
+
         parent = psutil.Process(pid)
         children = parent.children(recursive=True)
         if include_parent:
@@ -52,6 +52,11 @@ def call_server(args):
     flask_app = create_app(flask_config_name='production')
     register_helper(flask_app)
 
+    @flask_app.before_request
+    def reload_config():
+        # Pick up the changes of config file without restarting the server.
+        global_config.reload_if_changed()
+
     global_config.cromwell_server = args.server
     framework = args.framework
 
@@ -72,6 +72,9 @@ setup(
     },
     extras_require={
         "dotenv": ["python-dotenv"],
+        "async": ["aiohttp>=3.3"],
+        "stream": ["ijson>=2.3"],
+        "oss": ["oss2>=2.6"],
         "dev": [
             "pytest>=3",
             "tox",
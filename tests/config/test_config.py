@@ -98,3 +98,58 @@ class TestConfigFile(object):
         example_path = config_obj.get_conf_example(return_path=True)
         assert isinstance(example, str)
         assert 'choppy.conf.example' in example_path
+
+
+class TestSectionCache(object):
+    @pytest.fixture()
+    def conf_file(self, tmpdir):
+        example = config.ChoppyConfig.get_conf_example()
+        conf_file = tmpdir.join('choppy.conf')
+        conf_file.write(example + '\n[remote_broken]\nport = not_a_port\nusername = \npassword = \n')
+        return str(conf_file)
+
+    def test_invalid_section(self, conf_file):
+        from jsonschema.exceptions import ValidationError
+        config_obj = config.ChoppyConfig(config_file=conf_file)
+        assert config_obj.get('general', 'log_level')
+        with pytest.raises(ValidationError):
+            config_obj.get_section('remote_broken')
+
+    def test_validate_once(self, conf_file):
+        config_obj = config.ChoppyConfig(config_file=conf_file)
+        validated = []
+        validate_section = config_obj._validate_section
+
+        def count_validation(section_name, section_dict):
+            validated.append(section_name)
+            validate_section(section_name, section_dict)
+
+        config_obj._validate_section = count_validation
+        for _ in range(3):
+            config_obj.get('general', 'log_level')
+            config_obj.get_path('general', 'log_dir')
+            config_obj.get_conn_info('localhost', 'local')
+        assert validated == ['general', 'local']
+
+        # The error of an invalid section is memoized too.
+        for _ in range(2):
+            with pytest.raises(Exception):
+                config_obj.get_section('remote_broken')
+        assert validated == ['general', 'local', 'remote_broken']
+
+    def test_frozen_section(self, conf_file):
+        config_obj = config.ChoppyConfig(config_file=conf_file)
+        section = config_obj.get_section('local', is_dict=True)
+        section['port'] = 'changed'
+        assert config_obj.get('local', 'port') != 'changed'
+        assert config_obj.get_path('general', 'log_dir') is config_obj.get_path('general', 'log_dir')
+
+    def test_reload_if_changed(self, conf_file):
+        config_obj = config.ChoppyConfig(config_file=conf_file)
+        assert config_obj.reload_if_changed() is False
+
+        with open(conf_file, 'a') as f:
+            f.write('\n[remote_new]\nport = 8000\nserver = localhost\nusername = \npassword = \n')
+        os.utime(conf_file, (0, 0))
+        assert config_obj.reload_if_changed() is True
+        assert config_obj.get_int('remote_new', 'port') == 8000
@@ -0,0 +1,149 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import time
+import gzip
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.app_utils import (SamplesReader, hash_dir, get_app_template, render_app,  # noqa
+                                   evict_dependencies_cache)
+from choppy.exceptions import InValidSamples  # noqa
+
+
+class SamplesReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_typed_rows(self):
+        samples = os.path.join(self.tmp_dir, 'samples.tsv.gz')
+        with gzip.open(samples, 'wt') as f:
+            f.write('sample_id\tread_length\nS1\t150\nS2\t100\n')
+
+        reader = SamplesReader(samples, variables=['sample_id'], types={'read_length': int})
+        self.assertEqual([{'sample_id': 'S1', 'read_length': 150},
+                          {'sample_id': 'S2', 'read_length': 100}], list(reader))
+
+    def test_delimiter(self):
+        for filename, content in (('samples.txt', 'sample_id,fastq\nS1,a.fq\n'),
+                                  ('samples.txt', 'sample_id\tfastq\nS1\ta.fq\n'),
+                                  ('samples', 'sample_id,fastq\nS1,a.fq\n')):
+            samples = os.path.join(self.tmp_dir, filename)
+            with open(samples, 'w') as f:
+                f.write(content)
+            reader = SamplesReader(samples, variables=['sample_id', 'fastq'])
+            self.assertEqual([{'sample_id': 'S1', 'fastq': 'a.fq'}], list(reader))
+
+    def test_invalid_value(self):
+        samples = os.path.join(self.tmp_dir, 'samples.csv')
+        with open(samples, 'w') as f:
+            f.write('sample_id,read_length\nS1,150\nS2,long\n')
+
+        rows = iter(SamplesReader(samples, types={'read_length': int}))
+        self.assertEqual(150, next(rows)['read_length'])
+        with self.assertRaisesRegex(InValidSamples, 'read_length of line 3'):
+            next(rows)
+
+
+class AppTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_dir = tempfile.mkdtemp()
+        self.write('inputs', '{"{{ project_name }}.id": "{{ sample_id }}"{% include "extra" %}}')
+        self.write('extra', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.app_dir)
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.app_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+
+    def test_cached_template(self):
+        template, variables = get_app_template(self.app_dir, 'inputs')
+        self.assertEqual(frozenset(['project_name', 'sample_id']), variables)
+        self.assertIs(template, get_app_template(self.app_dir, 'inputs')[0])
+
+    def test_reload_included_template(self):
+        data = {'project_name': 'p', 'sample_id': 'S1'}
+        self.assertEqual('{"p.id": "S1"}', render_app(self.app_dir, 'inputs', data))
+
+        # Only the included template is changed.
+        self.write('extra', ', "p.flag": true', mtime=time.time() + 10)
+        self.assertEqual('{"p.id": "S1", "p.flag": true}', render_app(self.app_dir, 'inputs', data))
+
+    def test_error_filename(self):
+        self.write('workflow.wdl', 'workflow {{ project_name }\n')
+        with self.assertRaises(Exception) as context:
+            get_app_template(self.app_dir, 'workflow.wdl')
+        self.assertEqual('workflow.wdl', context.exception.name)
+
+
+class HashDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_dir(self, name, files):
+        path = os.path.join(self.tmp_dir, name)
+        os.makedirs(path)
+        for fname, content in files.items():
+            with open(os.path.join(path, fname), 'w') as f:
+                f.write(content)
+        return path
+
+    def test_boundaries(self):
+        # Same bytes when the path and the content are concatenated.
+        first = self.make_dir('first', {'a': 'bc'})
+        second = self.make_dir('second', {'ab': 'c'})
+        self.assertNotEqual(hash_dir(first), hash_dir(second))
+        self.assertEqual(hash_dir(first), hash_dir(self.make_dir('third', {'a': 'bc'})))
+
+
+class EvictDependenciesCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def make_zip(self, name, age=0):
+        path = os.path.join(self.cache_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'0' * 10)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_evict(self):
+        old = self.make_zip('old.zip', age=100)
+        new = self.make_zip('new.zip')
+        keep = self.make_zip('keep.zip', age=100)
+        evict_dependencies_cache(self.cache_dir, keep=keep, max_age=50)
+        self.assertEqual([False, True, True], [os.path.exists(p) for p in (old, new, keep)])
+
+    def test_removed_meanwhile(self):
+        removed = self.make_zip('removed.zip', age=100)
+        other = self.make_zip('other.zip')
+        real_stat = os.stat
+
+        def stat(path, *args, **kwargs):
+            # Another process evicts the file after listdir.
+            if path == removed:
+                os.remove(removed)
+            return real_stat(path, *args, **kwargs)
+
+        with mock.patch('os.stat', stat):
+            evict_dependencies_cache(self.cache_dir, max_age=50, max_size=15)
+        self.assertTrue(os.path.exists(other))
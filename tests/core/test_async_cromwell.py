@@ -0,0 +1,92 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import json
+import unittest
+import asyncio
+from choppy.config import init_config, get_global_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.async_cromwell import AsyncCromwell, SyncCromwell, aiohttp  # noqa
+
+global_config = get_global_config()
+
+if aiohttp:
+    from aiohttp import web
+
+
+def make_app(submitted):
+    async def status(request):
+        workflow_id = request.match_info['workflow_id']
+        return web.json_response({'id': workflow_id, 'status': 'Running'})
+
+    async def query(request):
+        ids = request.query.getall('id', [])
+        return web.json_response({'results': [{'id': i, 'status': 'Succeeded'} for i in ids]})
+
+    async def submit(request):
+        form = await request.post()
+        fields = dict((name, field.file.read().decode('utf-8')) for name, field in form.items())
+        submitted.append(fields)
+        return web.json_response({'id': 'wf1', 'status': 'Submitted'})
+
+    async def version(request):
+        return web.json_response({'cromwell': '29'})
+
+    app = web.Application()
+    app.router.add_post('/api/workflows/v1', submit)
+    app.router.add_get('/engine/v1/version', version)
+    app.router.add_get('/api/workflows/v1/query', query)
+    app.router.add_get('/api/workflows/v1/{workflow_id}/status', status)
+    return app
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed.')
+class AsyncCromwellTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.submitted = []
+        self.runner = web.AppRunner(make_app(self.submitted))
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.port = self.runner.addresses[0][1]
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def test_gather_status(self):
+        cromwell = AsyncCromwell(host='127.0.0.1', port=self.port, concurrency=5)
+        ids = ['wf%s' % i for i in range(20)]
+        results = self.loop.run_until_complete(cromwell.gather('status', ids))
+        self.loop.run_until_complete(cromwell.close())
+        self.assertEqual(ids, [result['id'] for result in results])
+
+    def test_submit(self):
+        cromwell = AsyncCromwell(host='127.0.0.1', port=self.port)
+        inputs = {'wf.sample_id': 'S1'}
+        result = self.loop.run_until_complete(
+            cromwell.submit('workflow wf {}', inputs, labels={'username': 'choppy'}))
+        self.loop.run_until_complete(cromwell.close())
+        self.assertEqual('wf1', result['id'])
+
+        # Same as Cromwell.jstart_workflow: `user` is added, labels are customLabels before 30.
+        fields = self.submitted[0]
+        self.assertEqual(['customLabels', 'wdlSource', 'workflowInputs'], sorted(fields))
+        self.assertEqual(dict(inputs, user=global_config.getuser()),
+                         json.loads(fields['workflowInputs']))
+        self.assertEqual({'username': 'choppy'}, json.loads(fields['customLabels']))
+        self.assertEqual({'wf.sample_id': 'S1'}, inputs)
+
+    def test_sync_query(self):
+        cromwell = SyncCromwell(AsyncCromwell(host='127.0.0.1', port=self.port))
+        # The fake server runs in self.loop, so run the facade in a thread.
+        future = self.loop.run_in_executor(None, cromwell.query, {'id': ['wf1', 'wf2']})
+        results = self.loop.run_until_complete(future)
+        self.loop.run_until_complete(self.loop.run_in_executor(None, cromwell.close))
+        self.assertEqual(['wf1', 'wf2'], [r['id'] for r in results['results']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import time
+import unittest
+import shutil
+import tempfile
+from choppy.core.metadata_cache import MetadataCache
+
+
+class MetadataCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_running_workflow_expires(self):
+        cache = MetadataCache(running_ttl=0)
+        cache.set('wf1', {'id': 'wf1', 'status': 'Running'})
+        self.assertIsNone(cache.get('wf1'))
+
+    def test_lru_eviction(self):
+        cache = MetadataCache(max_entries=2)
+        for wf in ('wf1', 'wf2'):
+            cache.set(wf, {'id': wf, 'status': 'Running'})
+        cache.get('wf1')
+        cache.set('wf3', {'id': 'wf3', 'status': 'Running'})
+        self.assertIsNotNone(cache.get('wf1'))
+        self.assertIsNone(cache.get('wf2'))
+
+    def test_terminal_workflow_on_disk(self):
+        metadata = {'id': 'wf1', 'status': 'Succeeded'}
+        MetadataCache(cache_dir=self.cache_dir).set('wf1', metadata)
+        cache = MetadataCache(cache_dir=self.cache_dir)
+        self.assertEqual(metadata, cache.get('wf1'))
+
+    def test_prune_disk(self):
+        cache = MetadataCache(cache_dir=self.cache_dir, max_disk_bytes=100, max_disk_age=3600)
+        now = time.time()
+        for i, age in enumerate((7200, 60, 30, 0)):
+            filepath = os.path.join(self.cache_dir, 'wf%s.json' % i)
+            with open(filepath, 'w') as f:
+                f.write('x' * 40)
+            os.utime(filepath, (now - age, now - age))
+
+        # wf0 is expired, wf1 is the oldest one over max_disk_bytes.
+        cache.set('wf4', {'id': 'wf4', 'status': 'Aborted'})
+        self.assertEqual(['wf2.json', 'wf3.json', 'wf4.json'], sorted(os.listdir(self.cache_dir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
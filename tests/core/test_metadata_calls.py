@@ -0,0 +1,60 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import io
+import os
+import json
+import unittest
+from unittest import mock
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.cromwell import Cromwell, parse_calls, ijson  # noqa
+
+CALLS = {
+    "wf.a": [{"shardIndex": 0, "executionStatus": "Failed", "stdout": "a0.out", "stderr": "a0.err"},
+             {"shardIndex": 1, "executionStatus": "Failed", "stdout": "a1.out", "stderr": "a1.err",
+              "subWorkflowMetadata": {"calls": {"sub.c": [{"shardIndex": -1}]}}}],
+    "wf.b": [{"shardIndex": -1, "executionStatus": "Done", "stdout": "b.out", "stderr": "b.err"}]
+}
+
+
+class MetadataCallsTestCase(unittest.TestCase):
+    def test_get_calls_from_dict(self):
+        logs = Cromwell.getCalls('Failed', CALLS, limit_n=1)
+        self.assertEqual(['wf.a.0.stdout'], [log['stdout']['label'] for log in logs])
+
+    def test_get_calls_from_pairs(self):
+        pairs = [(task, shard) for task, shards in CALLS.items() for shard in shards]
+        logs = Cromwell.getCalls('Failed', iter(pairs))
+        self.assertEqual(['wf.a.0.stderr', 'wf.a.1.stderr'],
+                         [log['stderr']['label'] for log in logs])
+
+    @unittest.skipIf(ijson is None, 'ijson is not installed.')
+    def test_parse_calls(self):
+        metadata = json.dumps({"id": "wf", "status": "Failed", "calls": CALLS})
+        pairs = list(parse_calls(io.BytesIO(metadata.encode('utf-8'))))
+        self.assertEqual(['wf.a', 'wf.a', 'wf.b'], [task for task, _ in pairs])
+        self.assertEqual(CALLS['wf.a'][1], pairs[1][1])
+
+    def test_iter_metadata_calls(self):
+        content = json.dumps({"id": "wf", "status": "Failed", "calls": CALLS}).encode('utf-8')
+
+        class FakeResponse:
+            def __init__(self):
+                self.content = content
+                self.raw = io.BytesIO(content)
+
+            def close(self):
+                pass
+
+        cromwell = Cromwell(host='localhost', port=8000)
+        # The request is sent by the rate limited _stream_metadata.
+        with mock.patch.object(Cromwell, '_stream_metadata',
+                               return_value=FakeResponse()) as stream_metadata:
+            pairs = list(cromwell.iter_metadata_calls('wf', include_keys=['stdout']))
+        self.assertEqual(['wf.a', 'wf.a', 'wf.b'], [task for task, _ in pairs])
+        self.assertEqual('wf', stream_metadata.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core import oss  # noqa
+from choppy.core.oss import (TransferEngine, parse_progress, read_remote_lines,  # noqa
+                             read_remote_files, iter_oss_objects, filter_oss_objects,
+                             ListingSummary)
+
+# A stand-in of ossutil: copy a local file, fail when the source contains "fail",
+# fail once when the source contains "flaky". `cat oss://path` prints /path,
+# `ls` prints 5 objects in long format.
+FAKE_OSSUTIL = '''#!{python}
+import os
+import sys
+import shutil
+if sys.argv[1] == 'ls':
+    print('LastModifiedTime                   Size(B)  StorageClass   ETAG                  ObjectName')
+    for i in range(5):
+        print('2019-05-09 15:39:56 +0800 CST  %10d      Standard   E2B9FE0D              '
+              'oss://bucket/data/sample%s.%s' % (i * 100, i, 'bam' if i % 2 else 'vcf'))
+    print('Object Number is: 5')
+    print('0.1(s) elapsed')
+    sys.exit(0)
+if sys.argv[1] == 'cat':
+    if not os.path.exists(sys.argv[-1].replace('oss://', '/', 1)):
+        sys.stderr.write('Error: oss: service returned error: StatusCode=404, ErrorCode=NoSuchKey\\n')
+        sys.exit(1)
+    with open(sys.argv[-1].replace('oss://', '/', 1), 'rb') as f:
+        shutil.copyfileobj(f, sys.stdout.buffer)
+    sys.exit(0)
+src, dest = sys.argv[-2:]
+marker = dest + '.' + os.path.basename(src) + '.tried'
+if 'fail' in src or ('flaky' in src and not os.path.exists(marker)):
+    open(marker, 'w').close()
+    print('Error: unable to copy ' + src)
+    sys.exit(1)
+sys.stdout.write('Total num: 1, size: 5B. Dealed num: 0, OK size: 0B, Progress: 0.000%\\r')
+shutil.copy(src, dest)
+sys.stdout.write('Total num: 1, size: 5B. Dealed num: 1, OK size: 5B, Progress: 100.000%\\r')
+print('Succeed: Total num: 1, size: 5. OK num: 1')
+'''
+
+
+class FakeOssutilTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dest')
+        os.makedirs(self.src_dir)
+        os.makedirs(self.dest_dir)
+        self.oss_bin = os.path.join(self.tmp_dir, 'ossutil')
+        with open(self.oss_bin, 'w') as f:
+            f.write(FAKE_OSSUTIL.format(python=sys.executable))
+        os.chmod(self.oss_bin, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TransferEngineTestCase(FakeOssutilTestCase):
+    def make_links(self, names):
+        links = []
+        for name in names:
+            link = os.path.join(self.src_dir, name)
+            with open(link, 'w') as f:
+                f.write('hello')
+            links.append(link)
+        return links
+
+    def test_parallel_copy(self):
+        links = self.make_links(['sample%s.txt' % i for i in range(10)])
+        engine = TransferEngine(jobs=4, oss_bin=self.oss_bin)
+        self.assertEqual([], engine.run(links, self.dest_dir, recursive=False))
+        self.assertEqual(10, len(os.listdir(self.dest_dir)))
+        self.assertEqual(50, engine.total_done_bytes)
+
+    def test_retry_and_manifest(self):
+        links = self.make_links(['ok.txt', 'flaky.txt', 'fail.txt'])
+        manifest = os.path.join(self.tmp_dir, 'failed.txt')
+        engine = TransferEngine(jobs=2, retries=1, backoff_factor=0, manifest=manifest,
+                                oss_bin=self.oss_bin)
+        failed = engine.run(links, self.dest_dir, recursive=False)
+        self.assertEqual([links[2]], failed)
+        self.assertTrue(os.path.exists(os.path.join(self.dest_dir, 'flaky.txt')))
+        with open(manifest, 'r') as f:
+            self.assertEqual(['# Error: unable to copy %s' % links[2], links[2]],
+                             f.read().splitlines())
+
+        # The errors are logged although the outputs of several jobs are hidden.
+        with self.assertLogs('choppy.core.oss', level='ERROR') as logs:
+            engine.run(links[2:], self.dest_dir, recursive=False)
+        self.assertIn('Failed to copy %s: Error: unable to copy' % links[2], '\n'.join(logs.output))
+
+
+class RemoteReadTestCase(FakeOssutilTestCase):
+    def setUp(self):
+        super(RemoteReadTestCase, self).setUp()
+        self.link = 'oss:/' + os.path.join(self.src_dir, 'log.txt')
+        with open(os.path.join(self.src_dir, 'log.txt'), 'w') as f:
+            f.write('\n'.join(['line%s' % i for i in range(100)]) + '\n')
+
+    def test_head_and_tail(self):
+        lines = list(read_remote_lines(self.link, head=3, oss_bin=self.oss_bin))
+        self.assertEqual(['line0', 'line1', 'line2'], lines)
+        lines = list(read_remote_lines(self.link, tail=2, oss_bin=self.oss_bin))
+        self.assertEqual(['line98', 'line99'], lines)
+        self.assertEqual(100, len(list(read_remote_lines(self.link, oss_bin=self.oss_bin))))
+
+    def test_missing_object(self):
+        missing = 'oss:/' + os.path.join(self.src_dir, 'missing.txt')
+        with self.assertRaises(IOError) as context:
+            list(read_remote_lines(missing, oss_bin=self.oss_bin))
+        self.assertIn('ErrorCode=NoSuchKey', str(context.exception))
+
+        # Stopping early kills ossutil without an error.
+        lines = read_remote_lines(self.link, oss_bin=self.oss_bin)
+        self.assertEqual('line0', next(lines))
+        lines.close()
+
+    def test_read_remote_files(self):
+        missing = 'oss:/' + os.path.join(self.src_dir, 'missing.txt')
+        contents = read_remote_files([self.link, missing], oss_bin=self.oss_bin)
+        self.assertTrue(contents[self.link].startswith('line0\n'))
+        self.assertIsNone(contents[missing])
+        self.assertEqual([], os.listdir(self.dest_dir))
+
+
+class ListingTestCase(FakeOssutilTestCase):
+    def test_iter_oss_objects(self):
+        entries = list(iter_oss_objects('oss://bucket/data/', oss_bin=self.oss_bin))
+        self.assertEqual(5, len(entries))
+        self.assertEqual(('oss://bucket/data/sample1.bam', 100), entries[1][:2])
+
+    def test_oss2_error(self):
+        class OssError(Exception):
+            code = 'NoSuchBucket'
+            message = 'The specified bucket does not exist.'
+
+        def object_iterator(*args, **kwargs):
+            raise OssError()
+            yield
+
+        fake_oss2 = SimpleNamespace(ObjectIterator=object_iterator,
+                                    exceptions=SimpleNamespace(OssError=OssError))
+        with mock.patch.object(oss, 'oss2', fake_oss2), \
+                mock.patch.object(oss, 'get_oss2_bucket', return_value=object()):
+            with self.assertRaises(IOError) as context:
+                list(iter_oss_objects('oss://missing/data/'))
+        self.assertIn('NoSuchBucket', str(context.exception))
+
+    def test_filter_and_summary(self):
+        summary = ListingSummary()
+        entries = iter_oss_objects('oss://bucket/data/', oss_bin=self.oss_bin)
+        entries = list(summary.watch(filter_oss_objects(entries, include='*.bam')))
+        self.assertEqual(2, len(entries))
+        self.assertEqual(400, summary.total_bytes)
+        self.assertEqual({'.bam': [2, 400]}, summary.extensions)
+
+
+class ParseProgressTestCase(unittest.TestCase):
+    def test_parse_progress(self):
+        event = parse_progress('Total num: 10, size: 1.00GB. Dealed num: 3, OK size: 300.00MB, '
+                               'Progress: 30.000%, Speed: 10.00MB/s, Est: 1m10s')
+        self.assertEqual(1024 ** 3, event['total_bytes'])
+        self.assertEqual(300 * 1024 ** 2, event['done_bytes'])
+        self.assertEqual(30.0, event['percent'])
+        self.assertEqual(10 * 1024 ** 2, event['rate'])
+        self.assertEqual('1m10s', event['eta'])
+
+    def test_parse_other_line(self):
+        self.assertIsNone(parse_progress('Succeed: Total num: 1, size: 5. OK num: 1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.path_checker import PathChecker, OssBackend  # noqa
+
+# A stand-in of `ossutil ls ... oss://bucket/dir/ -d`, it records the listed directories.
+FAKE_OSSUTIL = '''#!{python}
+import sys
+with open({calls!r}, 'a') as f:
+    f.write(sys.argv[-2] + '\\n')
+if sys.argv[-2] == 'oss://bucket/data/':
+    print('oss://bucket/data/')
+    print('oss://bucket/data/a.bam')
+    print('oss://bucket/data/b.bam')
+    print('oss://bucket/data/sub/')
+print('Object and Directory Number is: 4')
+'''
+
+
+class CountingBackend:
+    def __init__(self):
+        self.calls = []
+
+    def exists_many(self, paths, executor):
+        self.calls.append(sorted(paths))
+        return dict((path, path.endswith('.ok')) for path in paths)
+
+
+class PathCheckerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_local_paths(self):
+        checker = PathChecker(jobs=4)
+        exists = os.path.join(self.tmp_dir, 'exists')
+        open(exists, 'w').close()
+        missing = os.path.join(self.tmp_dir, 'missing')
+        results = checker.check_many([exists, missing, exists + '\n'])
+        self.assertEqual({exists: True, missing: False}, results)
+
+        # Cached for the whole run.
+        os.remove(exists)
+        self.assertTrue(checker.exists(exists))
+
+    def test_backend_dedupe(self):
+        backend = CountingBackend()
+        checker = PathChecker(backends={'s3': backend})
+        checker.check_many(['s3://a.ok', 's3://b', 's3://a.ok'])
+        self.assertTrue(checker.exists('s3://a.ok'))
+        self.assertFalse(checker.exists('s3://b'))
+        self.assertEqual([['s3://a.ok', 's3://b']], backend.calls)
+        self.assertFalse(checker.exists('gs://unknown'))
+
+    def test_oss_backend(self):
+        calls = os.path.join(self.tmp_dir, 'calls')
+        oss_bin = os.path.join(self.tmp_dir, 'ossutil')
+        with open(oss_bin, 'w') as f:
+            f.write(FAKE_OSSUTIL.format(python=sys.executable, calls=calls))
+        os.chmod(oss_bin, 0o755)
+
+        checker = PathChecker(backends={'oss': OssBackend(oss_bin=oss_bin)})
+        results = checker.check_many(['oss://bucket/data/a.bam', 'oss://bucket/data/b.bam',
+                                      'oss://bucket/data/c.bam', 'oss://bucket/data/sub',
+                                      'oss://bucket/other/d.bam'])
+        self.assertEqual([True, True, False, True, False],
+                         [results[path] for path in sorted(results)])
+        with open(calls) as f:
+            self.assertEqual(['oss://bucket/data/', 'oss://bucket/other/'],
+                             sorted(f.read().split()))
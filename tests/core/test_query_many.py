@@ -0,0 +1,69 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import json
+import datetime
+import unittest
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.cromwell import Cromwell  # noqa
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+        self.content = self.text
+
+
+class FakeSession:
+    """Answer /query with the requested ids (or `workflows`), page by page."""
+
+    def __init__(self, workflows=None):
+        self.workflows = workflows or []
+        self.requests = []
+
+    def get(self, url, params=None, auth=None):
+        self.requests.append(params)
+        ids = [value for key, value in params if key == 'id'] or self.workflows
+        params = dict(params)
+        page, page_size = params['page'], params['pageSize']
+        results = [{'id': workflow_id, 'status': 'Running'}
+                   for workflow_id in ids[(page - 1) * page_size:page * page_size]]
+        return FakeResponse({'results': results, 'totalResultsCount': len(ids)})
+
+
+class QueryManyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cromwell = Cromwell(host='localhost', port=8000)
+
+    def test_id_chunks(self):
+        self.cromwell.session = FakeSession()
+        ids = ['wf%s' % i for i in range(5)]
+        results = list(self.cromwell.query_many(ids=ids, chunk_size=2, page_size=10))
+        self.assertEqual(ids, [result['id'] for result in results])
+        self.assertEqual([['wf0', 'wf1'], ['wf2', 'wf3'], ['wf4']],
+                         [[value for key, value in params if key == 'id']
+                          for params in self.cromwell.session.requests])
+
+    def test_pagination(self):
+        workflows = ['wf%s' % i for i in range(7)]
+        self.cromwell.session = FakeSession(workflows)
+        results = list(self.cromwell.query_many(statuses='Running', page_size=3))
+        self.assertEqual(workflows, [result['id'] for result in results])
+        self.assertEqual([1, 2, 3], [dict(params)['page'] for params in self.cromwell.session.requests])
+        self.assertTrue(all(('status', 'Running') in params
+                            for params in self.cromwell.session.requests))
+
+    def test_since(self):
+        self.cromwell.session = FakeSession()
+        since = datetime.datetime(2019, 5, 1, 8, 30)
+        list(self.cromwell.query_many(since=since))
+        list(self.cromwell.query_many(since='2019-05-01T00:00:00Z'))
+        self.assertEqual(['2019-05-01T08:30:00.000000Z', '2019-05-01T00:00:00Z'],
+                         [dict(params)['submission'] for params in self.cromwell.session.requests])
+
+
+if __name__ == '__main__':
+    unittest.main()
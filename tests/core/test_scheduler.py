@@ -0,0 +1,68 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import unittest
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.scheduler import PollScheduler  # noqa
+
+
+class FakeCromwell:
+    """Every workflow succeeds after it is queried `rounds` times."""
+
+    def __init__(self, rounds=2):
+        self.rounds = rounds
+        self.counts = {}
+        self.requests = 0
+
+    def query(self, query_dict):
+        self.requests += 1
+        results = []
+        for workflow_id in query_dict['id']:
+            if workflow_id.startswith('unknown'):
+                continue
+            self.counts[workflow_id] = self.counts.get(workflow_id, 0) + 1
+            status = 'Succeeded' if self.counts[workflow_id] >= self.rounds else 'Running'
+            results.append({'id': workflow_id, 'status': status})
+        return {'results': results}
+
+
+class PollSchedulerTestCase(unittest.TestCase):
+    def test_batch_polling(self):
+        cromwell = FakeCromwell(rounds=2)
+        finished = []
+        scheduler = PollScheduler(cromwell, on_terminal=lambda r: finished.append(r['id']),
+                                  min_interval=0, batch_size=100)
+        scheduler.add_many(['wf%s' % i for i in range(250)])
+        scheduler.run()
+        self.assertEqual(250, len(finished))
+        self.assertEqual(0, len(scheduler))
+        # 500 status checks in full batches.
+        self.assertEqual(5, cromwell.requests)
+
+    def test_drop_missing(self):
+        cromwell = FakeCromwell(rounds=1)
+        missing = []
+        scheduler = PollScheduler(cromwell, on_missing=missing.append,
+                                  min_interval=0, max_misses=3)
+        scheduler.add_many(['wf1', 'unknown1'])
+        scheduler.run()
+        self.assertEqual(['unknown1'], missing)
+        self.assertEqual(3, cromwell.requests)
+
+    def test_adaptive_interval(self):
+        scheduler = PollScheduler(FakeCromwell(), min_interval=10, max_interval=30,
+                                  backoff=2, young_age=0)
+        scheduler.add('wf1')
+        state = scheduler.states['wf1']
+        state.status = 'Running'
+        now = state.first_seen + 1
+        self.assertEqual(20, scheduler.next_interval(state, 'Running', now))
+        state.interval = 20
+        self.assertEqual(30, scheduler.next_interval(state, 'Running', now))
+        self.assertEqual(10, scheduler.next_interval(state, 'Submitted', now))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.validator import WdlSignatureCache, hash_wdl  # noqa
+
+# A stand-in of `java -jar womtool.jar inputs workflow.wdl`, it counts the calls
+# and fails when imports aren't resolvable from the working directory.
+FAKE_JAVA = '''#!{python}
+import os
+import sys
+import json
+with open(os.environ['FAKE_JAVA_CALLS'], 'a') as f:
+    f.write(sys.argv[-1] + '\\n')
+if not os.path.exists('tasks/hello.wdl'):
+    sys.exit(1)
+print(json.dumps({{"hello.name": "String", "hello.bam": "File? (optional)"}}))
+'''
+
+WORKFLOW_WDL = '''import "tasks/hello.wdl" as hello
+
+workflow hello {
+    call hello.hello
+}
+'''
+
+
+class SignatureCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bin_dir = os.path.join(self.tmp_dir, 'bin')
+        self.app_dir = os.path.join(self.tmp_dir, 'app')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        for path in (self.bin_dir, os.path.join(self.app_dir, 'tasks'), self.cache_dir):
+            os.makedirs(path)
+
+        java = os.path.join(self.bin_dir, 'java')
+        with open(java, 'w') as f:
+            f.write(FAKE_JAVA.format(python=sys.executable))
+        os.chmod(java, 0o755)
+
+        self.wdl = os.path.join(self.app_dir, 'workflow.wdl')
+        with open(self.wdl, 'w') as f:
+            f.write(WORKFLOW_WDL)
+        self.task = os.path.join(self.app_dir, 'tasks', 'hello.wdl')
+        with open(self.task, 'w') as f:
+            f.write('task hello {\n  String name\n  File? bam\n}\n')
+
+        self.calls = os.path.join(self.tmp_dir, 'calls')
+        self.environ = dict(os.environ)
+        os.environ['FAKE_JAVA_CALLS'] = self.calls
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def count_calls(self):
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def test_hash_includes_imports(self):
+        key = hash_wdl(self.wdl)
+        with open(self.task, 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(key, hash_wdl(self.wdl))
+
+    def test_cached_on_disk(self):
+        cwd = os.getcwd()
+        cache = WdlSignatureCache('womtool.jar', cache_dir=self.cache_dir)
+        signatures = cache.get_many([self.wdl] * 5)
+        self.assertEqual(signatures[0]['hello.name'], 'String')
+        self.assertEqual(1, self.count_calls())
+        self.assertEqual(cwd, os.getcwd())
+
+        # A new process reuses the signature on disk.
+        cache = WdlSignatureCache('womtool.jar', cache_dir=self.cache_dir)
+        self.assertEqual(signatures[0], cache.get(self.wdl))
+        self.assertEqual(1, self.count_calls())
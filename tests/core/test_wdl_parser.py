@@ -0,0 +1,69 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy import exceptions  # noqa
+from choppy.core.validator import Validator  # noqa
+from choppy.core.wdl_parser import get_wdl_inputs  # noqa
+
+WDL_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'wdl')
+
+
+class WdlParserTestCase(unittest.TestCase):
+    def assert_same_as_womtool(self, app):
+        with open(os.path.join(WDL_DIR, app, 'womtool_inputs.json')) as f:
+            expected = json.load(f)
+        self.assertEqual(expected, get_wdl_inputs(os.path.join(WDL_DIR, app, 'workflow.wdl')))
+
+    def test_draft2(self):
+        self.assert_same_as_womtool('draft2')
+
+    def test_version1(self):
+        self.assert_same_as_womtool('v1')
+
+    def test_missing_import(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            wdl = os.path.join(tmp_dir, 'workflow.wdl')
+            with open(wdl, 'w') as f:
+                f.write('import "tasks/missing.wdl" as missing\n\n'
+                        'workflow app {\n    call missing.task\n}\n')
+            with self.assertRaises(exceptions.WdlSyntaxError):
+                get_wdl_inputs(wdl)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class ValidatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.json = os.path.join(self.tmp_dir, 'inputs.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def validate(self, inputs):
+        with open(self.json, 'w') as f:
+            json.dump(inputs, f)
+        return Validator(wdl=os.path.join(WDL_DIR, 'draft2', 'workflow.wdl'),
+                         json=self.json).validate_json()
+
+    def test_validate_without_womtool(self):
+        errors = self.validate({
+            "test_app.fastq_1": self.json,
+            "test_app.fastq_2": os.path.join(self.tmp_dir, 'missing.fastq'),
+            "test_app.sample_id": "sample1",
+            "test_app.regions": [self.json],
+            "test_app.mapping.disk_size": "200",
+            "test_app.mapping.cpu": "8"
+        })
+        self.assertEqual(3, len(errors))
+        self.assertIn('missing.fastq is not a valid file path', errors[0])
+        self.assertIn('test_app.mapping.cpu', errors[1])
+        self.assertIn('test_app.haplotyper.annotations is missing', errors[2])
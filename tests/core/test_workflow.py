@@ -0,0 +1,237 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from choppy.config import init_config
+
+init_config(os.path.join(os.path.dirname(__file__), os.pardir, 'examples', 'choppy.conf'))
+from choppy.core.cromwell import Cromwell  # noqa
+from choppy.core.journal import SubmissionJournal  # noqa
+from choppy.core.workflow import (submit_sample, group_by_wdl, submit_sample_group,  # noqa
+                                  run_batch, BoundedExecutor)
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+        self.content = self.text
+
+
+class FakeSession:
+    def __init__(self):
+        self.posts = []
+        self.patches = []
+
+    def post(self, url, files=None, auth=None):
+        self.posts.append((url, files))
+        inputs = json.loads(files['workflowInputs'][1])
+        return FakeResponse([{'id': 'wf%s' % i, 'status': 'Submitted'} for i in range(len(inputs))])
+
+    def patch(self, url=None, data=None, headers=None, auth=None):
+        self.patches.append((url, json.loads(data)))
+        workflow_id = url.split('/')[-2]
+        if workflow_id == 'down':
+            raise IOError('down')
+        elif workflow_id == 'missing':
+            return FakeResponse({'status': 'fail', 'message': 'Unrecognized workflow ID'}, 400)
+        return FakeResponse({})
+
+
+class AppTestCase(unittest.TestCase):
+    """Create an app in a temporary directory.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_dir = os.path.join(self.tmp_dir, 'app')
+        self.project_path = os.path.join(self.tmp_dir, 'project')
+        os.makedirs(os.path.join(self.app_dir, 'tasks'))
+        os.makedirs(self.project_path)
+        files = {
+            'inputs': '{"{{ project_name }}.sample_id": "{{ sample_id }}"}',
+            'workflow.wdl': 'workflow {{ project_name }} {\n    String sample_id\n}\n',
+            'defaults': '{}',
+            os.path.join('tasks', 'task.wdl'): 'task hello {}\n'
+        }
+        for name, content in files.items():
+            with open(os.path.join(self.app_dir, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class SubmitSampleTestCase(AppTestCase):
+    def submit(self, **kwargs):
+        with mock.patch('choppy.core.workflow.submit_workflow',
+                        return_value={'id': 'wf1'}) as submit_workflow:
+            sample, submitted = submit_sample({'sample_id': 'S1'}, 'project', self.project_path,
+                                              self.app_dir, label=None, **kwargs)
+        self.assertTrue(submitted)
+        self.assertEqual('wf1', sample['workflow_id'])
+        return submit_workflow.call_args
+
+    def test_submit_in_memory(self):
+        args, kwargs = self.submit(save_files=False)
+        self.assertEqual('workflow project {\n    String sample_id\n}', args[0].strip())
+        self.assertEqual({'project.sample_id': 'S1'}, args[1])
+        self.assertTrue(kwargs['wdl_string'])
+        self.assertEqual([], os.listdir(self.project_path))
+
+    def test_save_files_in_background(self):
+        writer = ThreadPoolExecutor(max_workers=1)
+        self.submit(writer=writer)
+        writer.shutdown(wait=True)
+        self.assertEqual(['defaults', 'inputs', 'tasks', 'workflow.wdl'],
+                         sorted(os.listdir(os.path.join(self.project_path, 'S1'))))
+
+
+class BoundedExecutorTestCase(unittest.TestCase):
+    def test_bounded_pending(self):
+        executor = BoundedExecutor(max_workers=1, max_pending=2)
+        release = threading.Event()
+        executor.submit(release.wait)
+        executor.submit(release.wait)
+
+        # The third task waits for a free slot.
+        submitter = threading.Thread(target=executor.submit, args=(release.wait, ))
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+
+        release.set()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        executor.shutdown(wait=True)
+
+
+class RunBatchTestCase(AppTestCase):
+    def setUp(self):
+        super(RunBatchTestCase, self).setUp()
+        shutil.rmtree(self.project_path)
+        self.samples = os.path.join(self.tmp_dir, 'samples.csv')
+        with open(self.samples, 'w') as f:
+            f.write('sample_id\nS1\nS2\nS3\n')
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        super(RunBatchTestCase, self).tearDown()
+
+    def run_batch(self, submit_workflow, **kwargs):
+        with mock.patch('choppy.core.workflow.submit_workflow', side_effect=submit_workflow), \
+                mock.patch('choppy.core.workflow.get_dependencies_zip', return_value='tasks.zip'), \
+                mock.patch('choppy.core.workflow.get_version', return_value={}):
+            return run_batch('project', self.app_dir, self.samples, None,
+                             save_files=False, **kwargs)
+
+    def read_csv(self, name):
+        with open(os.path.join(self.project_path, name)) as f:
+            return list(csv.DictReader(f))
+
+    def test_stream_results(self):
+        def submit_workflow(wdl, inputs, *args, **kwargs):
+            if inputs['project.sample_id'] == 'S2':
+                raise IOError('down')
+            return {'id': 'wf-' + inputs['project.sample_id']}
+
+        results = self.run_batch(submit_workflow, keep_samples=False)
+        self.assertEqual({'successed': [], 'failed': []}, results)
+        self.assertEqual([('S1', 'wf-S1'), ('S3', 'wf-S3')],
+                         [(row['sample_id'], row['workflow_id'])
+                          for row in self.read_csv('submitted.csv')])
+        self.assertEqual(['S2'], [row['sample_id'] for row in self.read_csv('failed.csv')])
+
+    def test_journal(self):
+        def submit_workflow(wdl, inputs, *args, **kwargs):
+            return {'id': 'wf-' + inputs['project.sample_id']}
+
+        with mock.patch('choppy.core.workflow.is_valid_label', side_effect=ValueError('bad label')):
+            self.assertRaises(ValueError, self.run_batch, submit_workflow)
+        journal = SubmissionJournal(self.project_path)
+        self.assertEqual(('render', 'failed', 'bad label'),
+                         tuple(journal.get('S1')[key] for key in ('stage', 'status', 'error')))
+
+        with mock.patch('choppy.core.workflow.BatchProgress.update') as update:
+            self.run_batch(submit_workflow, resume=True)
+            update.reset_mock()
+            self.run_batch(submit_workflow, resume=True)
+        self.assertEqual([mock.call(skipped=True)] * 3, update.call_args_list)
+
+
+class BatchSubmitTestCase(unittest.TestCase):
+    def test_group_by_wdl(self):
+        rendered = [({'sample_id': 'S%s' % i}, 'wdl%s' % (i % 2), {'i': i}) for i in range(5)]
+        groups = [(wdl, [sample['sample_id'] for sample, _ in items])
+                  for wdl, items in group_by_wdl(rendered, batch_size=2)]
+        self.assertEqual([('wdl0', ['S0', 'S2']), ('wdl1', ['S1', 'S3']), ('wdl0', ['S4'])], groups)
+
+        # Submit the oldest group when there are too many distinct WDL files.
+        groups = list(group_by_wdl(rendered, batch_size=10, max_groups=1))
+        self.assertEqual(['wdl0', 'wdl1', 'wdl0', 'wdl1', 'wdl0'], [wdl for wdl, _ in groups])
+
+    def test_jstart_workflow_batch(self):
+        cromwell = Cromwell(host='localhost', port=8000)
+        cromwell._long_version = '36'
+        cromwell.session = FakeSession()
+        results = cromwell.jstart_workflow_batch('workflow app {}', [{'a': 1}, {'a': 2}],
+                                                 wdl_string=True, custom_labels={'username': 'choppy'})
+        self.assertEqual(['wf0', 'wf1'], [result['id'] for result in results])
+
+        url, files = cromwell.session.posts[0]
+        self.assertTrue(url.endswith('/api/workflows/v1/batch'))
+        self.assertEqual([1, 2], [inputs['a'] for inputs in json.loads(files['workflowInputs'][1])])
+        self.assertEqual({'username': 'choppy'}, json.loads(files['labels'][1]))
+        self.assertEqual([], cromwell.session.patches)
+
+    def test_label_workflows(self):
+        cromwell = Cromwell(host='localhost', port=8000)
+        cromwell.session = FakeSession()
+        errors = cromwell.label_workflows(['wf0', 'down', 'missing', 'wf3'],
+                                          [{'sample-id': 's0'}, {'sample-id': 's1'},
+                                           {'sample-id': 's2'}, None])
+        self.assertEqual([None, 'down'], errors[:2])
+        self.assertTrue(errors[2].startswith('Error 400'))
+        self.assertIsNone(errors[3])
+        self.assertEqual([('wf0', 's0'), ('down', 's1'), ('missing', 's2')],
+                         [(url.split('/')[-2], labels['sample-id'])
+                          for url, labels in cromwell.session.patches])
+
+    def test_submit_sample_group(self):
+        samples = [{'sample_id': 'S1'}, {'sample_id': 'S2'}]
+        results = [{'id': 'wf1'}, {'id': 'wf2'}]
+        with mock.patch('choppy.core.workflow.submit_workflow_batch', return_value=results), \
+                mock.patch('choppy.core.workflow.label_workflows',
+                           return_value=[None, None]) as label_workflows:
+            submitted = submit_sample_group('wdl', [(sample, {}) for sample in samples], None)
+        self.assertEqual(['wf1', 'wf2'], [sample['workflow_id'] for sample, _ in submitted])
+        self.assertEqual(mock.call(['wf1', 'wf2'], [{'sample-id': 's1'}, {'sample-id': 's2'}],
+                                   server='localhost'), label_workflows.call_args)
+
+        with mock.patch('choppy.core.workflow.submit_workflow_batch', side_effect=IOError('down')):
+            submitted = submit_sample_group('wdl', [({'sample_id': 'S3'}, {})], None)
+        self.assertEqual([False], [ok for _, ok in submitted])
+
+    def test_label_failure(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        journal = SubmissionJournal(tmp_dir)
+        with mock.patch('choppy.core.workflow.submit_workflow_batch', return_value=[{'id': 'wf1'}]), \
+                mock.patch('choppy.core.workflow.label_workflows', return_value=['Error 500']):
+            submitted = submit_sample_group('wdl', [({'sample_id': 'S1'}, {})], None, journal=journal)
+        self.assertEqual([True], [ok for _, ok in submitted])
+
+        # The submitted sample is still skipped by --resume.
+        journal = SubmissionJournal(tmp_dir)
+        self.assertEqual(('label', 'failed'), (journal.get('S1')['stage'], journal.get('S1')['status']))
+        self.assertTrue(journal.is_submitted('S1'))
+        self.assertEqual('wf1', journal.get_submission('S1')['sample']['workflow_id'])
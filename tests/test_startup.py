@@ -0,0 +1,48 @@
+# coding: utf-8
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import unittest
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only the subcommands which need them import these modules.
+HEAVY_MODULES = ('sqlalchemy', 'jinja2', 'markdown2', 'git', 'psutil', 'coloredlogs',
+                 'dateutil', 'pytz', 'requests', 'jsonschema', 'argcomplete')
+
+
+def run_python(code, **env):
+    environ = dict(os.environ)
+    environ.update(env)
+    environ['PYTHONPATH'] = os.pathsep.join([ROOT_DIR, environ.get('PYTHONPATH', '')])
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT_DIR, env=environ,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+class StartupTestCase(unittest.TestCase):
+    def test_no_heavy_imports(self):
+        code = ('import sys, choppy.choppy_pipe\n'
+                'print(",".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES, ))
+        result = run_python(code)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '')
+
+    def test_profile_imports(self):
+        # Large enough to list every module, the order depends on timing.
+        result = run_python('import choppy.choppy_pipe', CHOPPY_PROFILE_IMPORTS='1000')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('the slowest', result.stderr)
+        self.assertIn('choppy.config', result.stderr)
+
+    def test_version_benchmark(self):
+        code = 'import sys; sys.argv = ["choppy", "version"]; from choppy.choppy_pipe import main; main()'
+        start = time.time()
+        result = run_python(code)
+        elapsed = time.time() - start
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(result.stdout.strip())
+        # A generous bound, it is far below 1s on a laptop.
+        self.assertLess(elapsed, 5)